@@ -0,0 +1,210 @@
+"""
+Micro-benchmarks for prefsniff's parse, diff and rendering stages.
+
+Each stage is timed on its own against a synthetic before/after pair from
+plistgen. Results are written as JSON, and can be compared against a stored
+baseline so a slowdown shows up as a number rather than a feeling:
+
+    $ python -m benchmarks.bench --output bench.json
+    $ python -m benchmarks.bench --compare benchmarks/baseline.json
+
+Each stage records the median and minimum of --repeat runs, in seconds;
+comparisons use the minimum, which is the least noisy. Baselines are only
+meaningful on the machine and Python they were recorded with; re-record one
+with --save-baseline after an intentional change in performance.
+"""
+import argparse
+import gc
+import json
+import platform
+import plistlib
+import statistics
+import sys
+import time
+
+from prefsniff.changetypes import (
+    PSChangeTypeBase,
+    PSChangeTypeCompositeBase,
+    PSChangeTypeFactory
+)
+from prefsniff.diff import PlistDiffer
+from prefsniff.prefsniff import PrefSniff
+from prefsniff.xmlfrag import XmlFragmentRenderer
+
+from .plistgen import generate_plist, mutate
+
+DEFAULT_BASELINE = "benchmarks/baseline.json"
+# a stage this much slower than its baseline is reported as a regression
+DEFAULT_THRESHOLD = 1.25
+
+BENCH_PLIST_PATH = "/tmp/com.example.bench.plist"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench")
+    parser.add_argument("--keys", type=int, default=200, help="Top-level keys. Default: %(default)s")
+    parser.add_argument("--depth", type=int, default=3, help="Maximum nesting depth. Default: %(default)s")
+    parser.add_argument("--array-len", type=int, default=20, help="Maximum array length. Default: %(default)s")
+    parser.add_argument("--data-size", type=int, default=256, help="Bytes per <data> value. Default: %(default)s")
+    parser.add_argument("--change-ratio", type=float, default=0.05,
+                        help="Fraction of values changed between before and after. Default: %(default)s")
+    parser.add_argument("--seed", type=int, default=0, help="Generator seed. Default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=7, help="Runs per stage. Default: %(default)s")
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare results against this baseline JSON file.")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, metavar="BASELINE",
+                        help="Record results as the new baseline. Default: %(const)s")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Slowdown ratio reported as a regression. Default: %(default)s")
+    return parser.parse_args(argv)
+
+
+class StageTimer:
+    """
+    Time a callable `repeat` times, running an untimed setup before each
+    run so every run starts from the same state. As with timeit, garbage
+    collection is off while a run is being timed, and an untimed warm-up
+    run comes first.
+    """
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def time(self, name, func, setup=None):
+        timings = []
+        for run in range(self.repeat + 1):
+            arg = setup() if setup is not None else None
+            gc.collect()
+            gc.disable()
+            try:
+                t0 = time.perf_counter()
+                if setup is not None:
+                    func(arg)
+                else:
+                    func()
+                elapsed = time.perf_counter() - t0
+            finally:
+                gc.enable()
+            if run:
+                timings.append(elapsed)
+        self.results[name] = {"median": statistics.median(timings),
+                              "min": min(timings),
+                              "repeat": self.repeat}
+        return self.results[name]
+
+
+def _sniff(pref1, pref2):
+    # domain and byhost are passed in, so nothing touches the filesystem
+    return PrefSniff(BENCH_PLIST_PATH, pref1=pref1, pref2=pref2,
+                     domain="com.example.bench", byhost=False)
+
+
+def run_benchmarks(args):
+    pref1 = generate_plist(keys=args.keys, depth=args.depth, array_len=args.array_len,
+                           data_size=args.data_size, seed=args.seed)
+    pref2 = mutate(pref1, change_ratio=args.change_ratio, seed=args.seed + 1,
+                   array_len=args.array_len, data_size=args.data_size)
+    xml_bytes = plistlib.dumps(pref2, fmt=plistlib.FMT_XML)
+    binary_bytes = plistlib.dumps(pref2, fmt=plistlib.FMT_BINARY)
+
+    sniff = _sniff(pref1, pref2)
+    lists = [(before, after) for before, after in sniff.modified.values()
+             if isinstance(before, list) and isinstance(after, list)]
+    composites = [ch.value for ch in sniff.changes
+                  if isinstance(ch, PSChangeTypeCompositeBase)]
+    commands = [ch for ch in sniff.changes if isinstance(ch, PSChangeTypeBase)]
+
+    def fresh_commands():
+        # change objects cache their rendering; time it on new ones, with
+        # XML fragments (timed above) already converted
+        fresh = [PSChangeTypeFactory.ps_change_type_from_dict(dict(ch)) for ch in commands]
+        for ch in fresh:
+            ch.converted_value
+        return fresh
+
+    def fresh_sniff(_=None):
+        # a new differ per run, so nothing carries over between runs
+        sniff.differ = PlistDiffer()
+        return sniff
+
+    timer = StageTimer(args.repeat)
+    timer.time("plistlib_load_xml", lambda: plistlib.loads(xml_bytes))
+    timer.time("plistlib_load_binary", lambda: plistlib.loads(binary_bytes))
+    timer.time("dict_compare", lambda s: s._dict_compare(pref1, pref2), setup=fresh_sniff)
+    timer.time("list_compare", lambda s: [s._list_compare(a, b) for a, b in lists], setup=fresh_sniff)
+    timer.time("generate_changes", lambda s: s._generate_changes(), setup=fresh_sniff)
+    timer.time("to_xmlfrag", lambda r: [r.render(v) for v in composites], setup=XmlFragmentRenderer)
+    timer.time("shell_command", lambda chs: [ch.shell_command() for ch in chs], setup=fresh_commands)
+    timer.time("unified_diff", lambda: list(sniff._unified_diff(pref1, pref2, BENCH_PLIST_PATH)))
+    timer.time("prefsniff_total", lambda: _sniff(pref1, pref2))
+
+    params = {k: getattr(args, k) for k in
+              ("keys", "depth", "array_len", "data_size", "change_ratio", "seed", "repeat")}
+    return {"meta": {"python": platform.python_version(),
+                     "implementation": platform.python_implementation(),
+                     "machine": platform.machine(),
+                     "system": platform.system(),
+                     "created": time.time(),
+                     "params": params,
+                     "changes": len(sniff.changes),
+                     "path_changes": len(sniff.path_changes)},
+            "results": timer.results}
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns (stage, baseline min, current min, ratio, regressed) for every
+    stage present in both.
+    """
+    rows = []
+    for stage, current in results["results"].items():
+        base = baseline["results"].get(stage)
+        if base is None:
+            continue
+        ratio = current["min"] / base["min"] if base["min"] else float("inf")
+        rows.append((stage, base["min"], current["min"], ratio, ratio > threshold))
+    return rows
+
+
+def print_results(results, rows=None, stream=None):
+    if stream is None:
+        stream = sys.stdout
+    if rows is None:
+        for stage, timing in results["results"].items():
+            print("%-22s %10.3f ms median %10.3f ms min" % (
+                stage, timing["median"] * 1000, timing["min"] * 1000), file=stream)
+        return
+    print("%-22s %12s %12s %8s" % ("stage", "baseline ms", "current ms", "ratio"), file=stream)
+    for stage, base, current, ratio, regressed in rows:
+        print("%-22s %12.3f %12.3f %7.2fx%s" % (
+            stage, base * 1000, current * 1000, ratio, "  REGRESSION" if regressed else ""), file=stream)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if not args.compare:
+        print_results(results)
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    if baseline["meta"]["params"] != results["meta"]["params"]:
+        print("Warning: baseline was recorded with different parameters: %s" %
+              baseline["meta"]["params"], file=sys.stderr)
+    rows = compare_results(results, baseline, threshold=args.threshold)
+    print_results(results, rows)
+    return 1 if any(row[4] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
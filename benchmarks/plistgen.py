@@ -0,0 +1,76 @@
+"""
+Synthetic preference plists for benchmarking.
+
+generate_plist() builds a plist shaped like a real preferences file: a
+top-level dictionary of scalars, nested dictionaries, arrays and <data>
+blobs. mutate() returns a copy with roughly `change_ratio` of its values
+changed, added or removed, in the ways cfprefsd saves tend to change them.
+"""
+import copy
+import datetime
+import random
+
+
+def _scalar(rng):
+    kind = rng.randrange(6)
+    if kind == 0:
+        return rng.choice([True, False])
+    if kind == 1:
+        return rng.randrange(-2 ** 31, 2 ** 31)
+    if kind == 2:
+        return rng.uniform(-1e6, 1e6)
+    if kind == 3:
+        return datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=rng.randrange(10 ** 9))
+    return "value-%x" % rng.getrandbits(48)
+
+
+def _value(rng, depth, array_len, data_size):
+    kind = rng.randrange(10)
+    if depth > 0 and kind < 2:
+        return {"key%d" % i: _value(rng, depth - 1, array_len, data_size)
+                for i in range(rng.randrange(2, 12))}
+    if depth > 0 and kind < 4:
+        return [_value(rng, depth - 1, array_len, data_size)
+                for _ in range(rng.randrange(array_len // 2, array_len + 1))]
+    if kind == 4 and data_size:
+        return rng.getrandbits(data_size * 8).to_bytes(data_size, "big")
+    return _scalar(rng)
+
+
+def generate_plist(keys=200, depth=3, array_len=20, data_size=256, seed=0):
+    rng = random.Random(seed)
+    return {"com.example.key%d" % i: _value(rng, depth, array_len, data_size)
+            for i in range(keys)}
+
+
+def _mutate_value(value, rng, change_ratio, array_len, data_size):
+    if isinstance(value, dict):
+        for key in list(value):
+            if rng.random() >= change_ratio:
+                value[key] = _mutate_value(value[key], rng, change_ratio, array_len, data_size)
+                continue
+            action = rng.randrange(3)
+            if action == 0:
+                del value[key]
+            elif action == 1:
+                value[key + "-new"] = _value(rng, 1, array_len, data_size)
+            else:
+                value[key] = _value(rng, 1, array_len, data_size)
+        return value
+    if isinstance(value, list):
+        if value and rng.random() < change_ratio:
+            action = rng.randrange(3)
+            if action == 0:
+                # the only array edit defaults(1) can express
+                value.append(_scalar(rng))
+            elif action == 1:
+                del value[rng.randrange(len(value))]
+            else:
+                value[rng.randrange(len(value))] = _scalar(rng)
+        return value
+    return value
+
+
+def mutate(pref, change_ratio=0.05, seed=1, array_len=20, data_size=256):
+    rng = random.Random(seed)
+    return _mutate_value(copy.deepcopy(pref), rng, change_ratio, array_len, data_size)
@@ -1,7 +1,14 @@
 from .__about__ import __summary__, __title__, __version__
+from .aio import AsyncPrefsWatch, awatch
+from .batch import BatchDiffer, diff_prefs, diff_prefs_batch
 
 __all__ = [
     "__version__",
     "__title__",
-    "__summary__"
+    "__summary__",
+    "AsyncPrefsWatch",
+    "awatch",
+    "BatchDiffer",
+    "diff_prefs",
+    "diff_prefs_batch"
 ]
@@ -0,0 +1,3 @@
+from .prefsniff import main
+
+main()
@@ -0,0 +1,207 @@
+"""
+asyncio interface to PrefsWatchEngine:
+
+    async for diffs in prefsniff.awatch(["~/Library/Preferences/com.apple.dock.plist"]):
+        print(diffs.commands)
+
+Watchdog's observer thread hands events to the event loop with
+call_soon_threadsafe(). Bursts of events for the same file are debounced
+with loop timers rather than a polling thread, and reading, parsing and
+diffing run in an executor so the loop is never blocked on file I/O.
+"""
+import asyncio
+import os
+from concurrent.futures import Executor
+from typing import Iterable
+
+from . import stats
+from .baseline import BASELINE_LAZY
+from .blobs import BlobStore
+from .filters import PrefsPathFilter
+from .prefsniff import PrefSniff
+from .scheduler import DebounceScheduler, event_path
+from .watch import PrefsWatchEngine, WatchedPlist, expand_watchpaths
+
+_CLOSED = object()
+
+
+class _LoopEventBridge:
+    """
+    Stands in for the engine's DebounceScheduler: the event handlers put()
+    events from the observer thread, and they're passed on to the loop.
+    """
+
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            self.loop.call_soon_threadsafe(self.callback, item)
+        except RuntimeError:
+            # loop already closed; nobody is listening any more
+            pass
+
+    def close(self):
+        pass
+
+
+class AsyncPrefsWatch:
+    """
+    Async iterable of PrefSniff change sets for plist files, globs and
+    directories.
+
+    Use it as an async iterator, optionally inside "async with" to control
+    when watching starts and stops. Iteration ends cleanly when the
+    consuming task is cancelled or close() is called. Change sets for
+    different files may be computed concurrently; those for one file are
+    always computed, and delivered, in order.
+    """
+
+    def __init__(self, watchpaths: Iterable[str], executor: Executor = None,
+                 quiet_period=DebounceScheduler.DEFAULT_QUIET_PERIOD,
+                 max_delay=DebounceScheduler.DEFAULT_MAX_DELAY,
+                 recursive=True, baseline=BASELINE_LAZY,
+                 event_filter: PrefsPathFilter = None, blob_store: BlobStore = None):
+        if isinstance(watchpaths, str):
+            watchpaths = [watchpaths]
+        self.watchpaths = list(watchpaths)
+        self.executor = executor
+        self.quiet_period = quiet_period
+        self.max_delay = max(max_delay, quiet_period)
+        self.recursive = recursive
+        self.baseline = baseline
+        self.event_filter = event_filter
+        self.blob_store = blob_store
+        self.engine: PrefsWatchEngine = None
+        self._loop = None
+        self._queue = None
+        # plistpath -> [latest item, loop time of first event, TimerHandle]
+        self._pending = {}
+        # WatchedPlists being refreshed in the executor, and those that
+        # changed again in the meantime
+        self._refreshing = set()
+        self._rerun = set()
+        self._closed = False
+
+    async def start(self):
+        if self.engine is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        bridge = _LoopEventBridge(self._loop, self._on_event)
+        self.engine = PrefsWatchEngine(event_queue=bridge,
+                                       event_filter=self.event_filter,
+                                       blob_store=self.blob_store)
+        # reading baselines is file I/O, so keep it off the loop too
+        await self._loop.run_in_executor(self.executor, self._add_watchpaths)
+        self.engine.start(dispatch=False)
+
+    def _add_watchpaths(self):
+        for path in expand_watchpaths(self.watchpaths):
+            if os.path.isdir(path):
+                self.engine.add_directory(path, recursive=self.recursive,
+                                          baseline=self.baseline)
+            else:
+                self.engine.add_path(path)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _, _, handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        if self.engine is not None:
+            self.engine.stop()
+        if self._queue is not None:
+            self._queue.put_nowait(_CLOSED)
+
+    async def aclose(self):
+        self.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __aiter__(self):
+        return self._changesets()
+
+    async def _changesets(self):
+        await self.start()
+        try:
+            while True:
+                diffs = await self._queue.get()
+                if diffs is _CLOSED:
+                    return
+                yield diffs
+        finally:
+            # runs on cancellation, break, or aclose() of the iterator
+            self.close()
+
+    def _on_event(self, item):
+        # on the loop: (re)arm this file's debounce timer
+        if self._closed:
+            return
+        path = event_path(item)
+        now = self._loop.time()
+        pending = self._pending.get(path)
+        if pending is None:
+            pending = self._pending[path] = [item, now, None]
+        else:
+            pending[0] = item
+            pending[2].cancel()
+        due = min(now + self.quiet_period, pending[1] + self.max_delay)
+        pending[2] = self._loop.call_at(due, self._on_settled, path)
+
+    def _on_settled(self, path):
+        item, first, _ = self._pending.pop(path)
+        stats.record(stats.STAGE_EVENT_WAIT, self._loop.time() - first)
+        watched = self.engine.route_event(item)
+        if watched is not None:
+            self._refresh(watched)
+
+    def _refresh(self, watched: WatchedPlist):
+        if self._closed:
+            return
+        if watched in self._refreshing:
+            # refresh again once the one in flight is done
+            self._rerun.add(watched)
+            return
+        self._refreshing.add(watched)
+        future = self._loop.run_in_executor(self.executor, watched.refresh)
+        future.add_done_callback(lambda f: self._on_refreshed(watched, f))
+
+    def _on_refreshed(self, watched: WatchedPlist, future):
+        self._refreshing.discard(watched)
+        if self._closed or future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            # a bug rather than a bad file (those just yield no diff);
+            # report it without ending the stream for every other file
+            self._loop.call_exception_handler({
+                "message": "Error diffing %s" % watched.plistpath,
+                "exception": exc})
+        else:
+            diffs: PrefSniff = future.result()
+            if diffs is not None:
+                self._queue.put_nowait(diffs)
+        if watched in self._rerun:
+            self._rerun.discard(watched)
+            self._refresh(watched)
+
+
+def awatch(watchpaths: Iterable[str], **kwargs) -> AsyncPrefsWatch:
+    """
+    Watch plist files, globs or directories for changes:
+
+        async for diffs in prefsniff.awatch(paths):
+            ...
+
+    Keyword arguments are passed to AsyncPrefsWatch.
+    """
+    return AsyncPrefsWatch(watchpaths, **kwargs)
@@ -0,0 +1,105 @@
+import subprocess
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List
+
+from .changetypes import PSChangeTypeBase
+
+# Outcome of applying one change. `returncode` is None if the command
+# was never run: either the change couldn't be turned into a command, or
+# an earlier write to the same domain failed with stop_on_error set
+ApplyResult = namedtuple("ApplyResult", ["change", "argv", "returncode",
+                                         "stdout", "stderr", "started", "elapsed"])
+
+
+class PrefsApplyEngine:
+    """
+    Apply change sets by running defaults(1), one domain per worker.
+
+    Changes are grouped by (domain, byhost). Groups run concurrently on a
+    thread pool of up to `max_workers`, while the writes within a group run
+    one at a time in the order given, so later writes to a domain always
+    land on top of earlier ones.
+    """
+    DEFAULT_DEFAULTS_PATH = "/usr/bin/defaults"
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, defaults_path=DEFAULT_DEFAULTS_PATH, max_workers=DEFAULT_MAX_WORKERS,
+                 stop_on_error=False, timeout=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.defaults_path = defaults_path
+        self.max_workers = max_workers
+        self.stop_on_error = stop_on_error
+        self.timeout = timeout
+
+    def argv(self, change: PSChangeTypeBase) -> List[str]:
+        argv = change.argv(quote=False)
+        # argv[0] is the bare command name; run the configured binary instead
+        argv[0] = self.defaults_path
+        return argv
+
+    def group_changes(self, changes: Iterable) -> "OrderedDict":
+        groups = OrderedDict()
+        for index, change in enumerate(changes):
+            if isinstance(change, PSChangeTypeBase):
+                group_key = (change.domain, change.byhost)
+            else:
+                # not a real change (e.g. an unimplemented type's message)
+                group_key = None
+            groups.setdefault(group_key, []).append((index, change))
+        return groups
+
+    def apply(self, changes: Iterable) -> List[ApplyResult]:
+        """
+        Apply `changes` and return one ApplyResult per change, in the same
+        order as the input.
+        """
+        changes = list(changes)
+        results = [None] * len(changes)
+        groups = self.group_changes(changes)
+        skipped = groups.pop(None, [])
+        for index, change in skipped:
+            results[index] = ApplyResult(
+                change, None, None, None, str(change), None, 0.0)
+
+        workers = min(self.max_workers, len(groups)) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._apply_group, group)
+                       for group in groups.values()]
+            for future in futures:
+                for index, result in future.result():
+                    results[index] = result
+        return results
+
+    def _apply_group(self, group):
+        results = []
+        failed = False
+        for index, change in group:
+            argv = self.argv(change)
+            if failed:
+                result = ApplyResult(change, argv, None, None,
+                                     "skipped after earlier failure", None, 0.0)
+            else:
+                result = self._run(change, argv)
+                failed = self.stop_on_error and result.returncode != 0
+            results.append((index, result))
+        return results
+
+    def _run(self, change, argv) -> ApplyResult:
+        started = time.time()
+        t0 = time.perf_counter()
+        try:
+            proc = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  timeout=self.timeout, universal_newlines=True)
+            returncode, stdout, stderr = proc.returncode, proc.stdout, proc.stderr
+        except (OSError, subprocess.TimeoutExpired) as e:
+            returncode, stdout, stderr = -1, None, str(e)
+        elapsed = time.perf_counter() - t0
+        return ApplyResult(change, argv, returncode, stdout, stderr, started, elapsed)
+
+
+def apply_changes(changes: Iterable, **kwargs) -> List[ApplyResult]:
+    engine = PrefsApplyEngine(**kwargs)
+    return engine.apply(changes)
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import plistlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, Iterator, List
+
+from .snapshot import content_digest, snapshot_key
+
+# How a directory watch gets its "before" state for existing files:
+# read raw bytes and parse on first change, or parse everything up front
+# on a process pool
+BASELINE_LAZY = "lazy"
+BASELINE_PARALLEL = "parallel"
+
+# Parsed content of one plist, or the reason it couldn't be read. `key` is
+# the file's SnapshotKey at the time it was read, for seeding a
+# SnapshotCache, and `digest` the ContentDigest of the bytes parsed
+BaselineResult = namedtuple(
+    "BaselineResult", ["plistpath", "pref", "key", "digest", "error"])
+
+
+def load_baseline(plistpath) -> BaselineResult:
+    # Module-level so it can be sent to worker processes. Never raises:
+    # a file that can't be read or parsed is reported in `error`
+    try:
+        with open(plistpath, 'rb') as f:
+            key = snapshot_key(os.fstat(f.fileno()))
+            data = f.read()
+        pref = plistlib.loads(data)
+    except Exception as e:
+        return BaselineResult(plistpath, None, None, None, "%s: %s" % (type(e).__name__, e))
+    return BaselineResult(plistpath, pref, key, content_digest(data), None)
+
+
+def load_baselines(plistpaths) -> List[BaselineResult]:
+    return [load_baseline(plistpath) for plistpath in plistpaths]
+
+
+class BaselineSnapshotter:
+    """
+    Read and parse many plists in parallel on a process pool.
+
+    Results are yielded as each file finishes, not in input order, so a
+    caller can start using the files that are ready while the rest of the
+    tree is still being parsed. Files are handed to workers `batch_size` at
+    a time to keep per-task overhead down. Small trees are parsed
+    in-process, where starting a pool would cost more than it saves.
+    """
+    DEFAULT_MIN_PARALLEL = 32
+    DEFAULT_BATCH_SIZE = 8
+
+    def __init__(self, max_workers=None, min_parallel=DEFAULT_MIN_PARALLEL,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.max_workers = max_workers
+        self.min_parallel = min_parallel
+        self.batch_size = batch_size
+
+    def snapshot(self, plistpaths: Iterable[str]) -> Iterator[BaselineResult]:
+        plistpaths = list(plistpaths)
+        max_workers = self.max_workers or os.cpu_count() or 1
+        if len(plistpaths) < self.min_parallel or max_workers == 1:
+            for plistpath in plistpaths:
+                yield load_baseline(plistpath)
+            return
+
+        # spawn rather than fork: we're usually called while watchdog's
+        # threads are running, and forking a threaded process isn't safe
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            futures = {}
+            for i in range(0, len(plistpaths), self.batch_size):
+                batch = plistpaths[i:i + self.batch_size]
+                futures[executor.submit(load_baselines, batch)] = batch
+            for future in as_completed(futures):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # e.g. a worker died; report it against these files
+                    # and carry on with the rest
+                    error = "%s: %s" % (type(e).__name__, e)
+                    results = [BaselineResult(plistpath, None, None, None, error)
+                               for plistpath in futures[future]]
+                yield from results
@@ -0,0 +1,110 @@
+"""
+Diff plists that are already in memory, one pair at a time or in bulk.
+
+Nothing here touches the filesystem: the caller supplies each plist's
+defaults domain and byhost flag, and its before/after content as parsed
+plists or as raw XML or binary plist bytes.
+"""
+import multiprocessing
+import os
+import plistlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List
+
+from .bplist import BPLIST_MAGIC, BinaryPlistReader
+from .diff import PlistDiffer
+from .prefsniff import PrefSniff
+
+# One pair to diff. before/after are a parsed plist, XML or binary plist
+# bytes, or None for a plist that doesn't exist on that side
+PrefsPair = namedtuple("PrefsPair", ["domain", "byhost", "before", "after"])
+
+# Changes for one pair, or the reason it couldn't be diffed
+PrefsDiffResult = namedtuple("PrefsDiffResult", ["domain", "byhost", "changes", "error"])
+
+
+def _as_pref(value):
+    if value is None:
+        return {}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        if bytes(value[:len(BPLIST_MAGIC)]) == BPLIST_MAGIC:
+            # only the parts that differ get decoded
+            return BinaryPlistReader(value).top()
+        return plistlib.loads(bytes(value))
+    return value
+
+
+def diff_prefs(domain, byhost, before, after, differ: PlistDiffer = None) -> PrefSniff:
+    """
+    Diff two versions of the plist backing `domain`.
+
+    Returns the change set; its `changes` are the change objects, and it
+    can be handed to any ChangeSetWriter or PrefsApplyEngine.
+    """
+    return PrefSniff(None, pref1=_as_pref(before), pref2=_as_pref(after),
+                     differ=differ, domain=domain, byhost=byhost)
+
+
+def diff_pair(pair) -> PrefsDiffResult:
+    # Module-level so it can be sent to worker processes. Never raises: a
+    # pair that can't be parsed or diffed is reported in `error`
+    domain, byhost, before, after = pair
+    try:
+        changes = diff_prefs(domain, byhost, before, after).changes
+    except Exception as e:
+        return PrefsDiffResult(domain, byhost, None, "%s: %s" % (type(e).__name__, e))
+    return PrefsDiffResult(domain, byhost, changes, None)
+
+
+def diff_pairs(pairs) -> List[PrefsDiffResult]:
+    return [diff_pair(pair) for pair in pairs]
+
+
+class BatchDiffer:
+    """
+    Diff many (domain, byhost, before, after) pairs on a process pool.
+
+    Results come back in input order. Pairs are sent to workers
+    `batch_size` at a time, and small batches are diffed in-process, where
+    starting a pool would cost more than it saves. Pass raw bytes rather
+    than parsed plists where possible, so parsing happens in the workers
+    and less has to be pickled.
+    """
+    DEFAULT_MIN_PARALLEL = 32
+    DEFAULT_BATCH_SIZE = 16
+
+    def __init__(self, max_workers=None, min_parallel=DEFAULT_MIN_PARALLEL,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.max_workers = max_workers
+        self.min_parallel = min_parallel
+        self.batch_size = batch_size
+
+    def diff(self, pairs: Iterable) -> List[PrefsDiffResult]:
+        pairs = [tuple(pair) for pair in pairs]
+        max_workers = self.max_workers or os.cpu_count() or 1
+        if len(pairs) < self.min_parallel or max_workers == 1:
+            return diff_pairs(pairs)
+
+        batches = [pairs[i:i + self.batch_size]
+                   for i in range(0, len(pairs), self.batch_size)]
+        # spawn rather than fork, as in BaselineSnapshotter: callers may
+        # have watchdog threads running
+        mp_context = multiprocessing.get_context("spawn")
+        results = []
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            futures = [executor.submit(diff_pairs, batch) for batch in batches]
+            for future, batch in zip(futures, batches):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    # e.g. a worker died, or a result couldn't be pickled;
+                    # report it against these pairs and carry on
+                    error = "%s: %s" % (type(e).__name__, e)
+                    results.extend(PrefsDiffResult(domain, byhost, None, error)
+                                   for domain, byhost, _, _ in batch)
+        return results
+
+
+def diff_prefs_batch(pairs: Iterable, max_workers=None) -> List[PrefsDiffResult]:
+    return BatchDiffer(max_workers=max_workers).diff(pairs)
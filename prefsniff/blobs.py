@@ -0,0 +1,268 @@
+"""
+Large <data> values kept on disk by digest, rather than in memory.
+
+Bookmarks, archived objects and images can make a single plist value
+several megabytes, and a watched file's parsed "before" side is kept for as
+long as it's watched. BlobStore.externalize() replaces every <data> value
+larger than the store's threshold with a BlobRef: its digest and size. The
+bytes are written once to a content-addressed file and only read back when
+a change involving them is written out.
+
+BlobRefs compare by digest, and a BlobRef has the same subtree digest as
+the bytes it stands for, so PlistDiffer never needs the bytes themselves.
+
+BlobStore.loads() bounds the memory it takes to get there only for binary
+plists: their large values go from the file's bytes straight to the store.
+An XML plist is parsed in full by plistlib first, so while it's parsed
+every value in it is held decoded, as without a store.
+
+Nothing is removed from the store as it's used; prune() deletes blobs that
+haven't been stored or seen again for a while.
+"""
+import hashlib
+import os
+import plistlib
+import struct
+import tempfile
+import time
+
+from .bplist import (
+    BPLIST_MAGIC,
+    BinaryPlistReader,
+    LazyArray,
+    LazyData,
+    LazyDict
+)
+
+DEFAULT_BLOB_DIR = "~/.prefsniff/blobs"
+
+# Larger values are stored by digest. Hex-encoded for a defaults(1)
+# argument, this is still well under macOS's 1 MiB ARG_MAX
+DEFAULT_BLOB_THRESHOLD = 256 * 1024
+
+_DIGEST_SIZE = 16
+
+
+def data_digest(data) -> bytes:
+    # the digest SubtreeHasher gives a <data> value
+    h = hashlib.blake2b(digest_size=_DIGEST_SIZE)
+    h.update(b"data")
+    h.update(data)
+    return h.digest()
+
+
+class BlobRef:
+    """
+    Stand-in for a <data> value held in a BlobStore. Immutable; equal to
+    another BlobRef with the same digest, and to the bytes themselves.
+    """
+    __slots__ = ("digest", "size", "store")
+
+    def __init__(self, digest: bytes, size, store: "BlobStore"):
+        self.digest = digest
+        self.size = size
+        self.store = store
+
+    @property
+    def path(self):
+        return self.store.path_for(self.digest)
+
+    def load(self) -> bytes:
+        return self.store.load(self.digest)
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        # also equal to the bytes it stands for, so plists compare equal
+        # with or without large values externalized. Don't mix the two as
+        # set members or dict keys; they don't hash alike
+        if isinstance(other, (bytes, bytearray)):
+            return len(other) == self.size and data_digest(other) == self.digest
+        if not isinstance(other, BlobRef):
+            return NotImplemented
+        return self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return "BlobRef(%s, %d bytes)" % (self.digest.hex(), self.size)
+
+    def __reduce__(self):
+        # e.g. for results coming back from worker processes
+        return (BlobRef, (self.digest, self.size, self.store))
+
+
+class BlobStore:
+    """
+    Content-addressed store for <data> values of more than `threshold`
+    bytes. Files are named by digest, so a blob seen again, in any plist, is
+    only ever written once; its modification time is updated instead, for
+    prune(). Nothing is removed automatically.
+    """
+
+    def __init__(self, path=DEFAULT_BLOB_DIR, threshold=DEFAULT_BLOB_THRESHOLD):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.threshold = threshold
+        self.stored = 0
+        self.bytes_stored = 0
+
+    def __reduce__(self):
+        return (BlobStore, (self.path, self.threshold))
+
+    def path_for(self, digest: bytes):
+        name = digest.hex()
+        return os.path.join(self.path, name[:2], name)
+
+    def put(self, data) -> BlobRef:
+        digest = data_digest(data)
+        path = self.path_for(digest)
+        try:
+            # still in use, as far as prune() is concerned
+            os.utime(path)
+        except FileNotFoundError:
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            # written beside its final name and renamed into place, so a
+            # blob file is always complete
+            fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".blob-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmppath, path)
+            except BaseException:
+                os.unlink(tmppath)
+                raise
+            self.stored += 1
+            self.bytes_stored += len(data)
+        return BlobRef(digest, len(data), self)
+
+    def load(self, digest: bytes) -> bytes:
+        with open(self.path_for(digest), "rb") as f:
+            return f.read()
+
+    def loads(self, data):
+        """
+        Parse plist bytes with values over the threshold externalized.
+
+        A binary plist is decoded with the lazy reader, and each large
+        <data> value is stored from a view of `data` without being copied,
+        so the peak is about len(data) plus the plist's smaller values.
+        Anything else is parsed by plistlib and then externalized.
+        """
+        if data[:len(BPLIST_MAGIC)] != BPLIST_MAGIC:
+            return self.externalize(plistlib.loads(data))
+        reader = BinaryPlistReader(data)
+        try:
+            return self._load_lazy(reader.top())
+        except (IndexError, struct.error, RecursionError):
+            # truncated, or references that run off the end or in a cycle
+            raise plistlib.InvalidFileException()
+
+    def _load_lazy(self, value):
+        if isinstance(value, LazyDict):
+            decode = value.reader.decode
+            return {decode(k): self._load_lazy(decode(v))
+                    for k, v in zip(value.key_refs, value.value_refs)}
+        if isinstance(value, LazyArray):
+            decode = value.reader.decode
+            return [self._load_lazy(decode(ref)) for ref in value.refs]
+        if isinstance(value, LazyData):
+            if len(value) > self.threshold:
+                return self.put(value.view())
+            return bytes(value)
+        return value
+
+    def prune(self, keep=(), max_age=None) -> int:
+        """
+        Delete blobs whose digest isn't in `keep` and, with max_age, that
+        haven't been stored or seen again for max_age seconds. Returns the
+        number of blobs deleted.
+
+        Scripts and NDJSON records written while watching read their
+        -data values from the store, so only prune what they won't need.
+        """
+        keep = {digest.hex() for digest in keep}
+        cutoff = None if max_age is None else time.time() - max_age
+        try:
+            subdirs = os.listdir(self.path)
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for subdir in subdirs:
+            dirpath = os.path.join(self.path, subdir)
+            if not os.path.isdir(dirpath):
+                continue
+            for name in os.listdir(dirpath):
+                is_blob = len(name) == _DIGEST_SIZE * 2 and name.startswith(subdir)
+                # a leftover temporary file, from put() having been killed;
+                # only ever deleted by age, as it may still be being written
+                is_leftover = name.startswith(".blob-") and cutoff is not None
+                if name in keep or not (is_blob or is_leftover):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if cutoff is not None and os.stat(path).st_mtime > cutoff:
+                        continue
+                    os.unlink(path)
+                except OSError:
+                    continue
+                if is_blob:
+                    removed += 1
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # not empty
+                pass
+        return removed
+
+    def externalize(self, value):
+        """
+        Replace <data> values over the threshold with BlobRefs, in place
+        for dictionaries and arrays. Returns the value, which is replaced
+        itself if it's a large enough <data>.
+        """
+        if isinstance(value, (bytes, bytearray)):
+            if len(value) > self.threshold:
+                return self.put(value)
+            return value
+        if isinstance(value, dict):
+            for k, v in value.items():
+                if isinstance(v, (dict, list, bytes, bytearray)):
+                    value[k] = self.externalize(v)
+        elif isinstance(value, list):
+            for i, v in enumerate(value):
+                if isinstance(v, (dict, list, bytes, bytearray)):
+                    value[i] = self.externalize(v)
+        return value
+
+
+def _replace_blobs(value, replace):
+    # copy-on-write: containers without blobs are returned as they are
+    if isinstance(value, BlobRef):
+        return replace(value)
+    if isinstance(value, dict):
+        replaced = {k: _replace_blobs(v, replace) for k, v in value.items()}
+        if any(replaced[k] is not v for k, v in value.items()):
+            return replaced
+    elif isinstance(value, (list, tuple)):
+        replaced = [_replace_blobs(v, replace) for v in value]
+        if any(r is not v for r, v in zip(replaced, value)):
+            return replaced
+    return value
+
+
+def load_blobs(value):
+    """
+    The value with every BlobRef in it replaced by its bytes.
+    """
+    return _replace_blobs(value, BlobRef.load)
+
+
+def blob_placeholders(value):
+    """
+    The value with every BlobRef in it replaced by a short descriptive
+    string, for display in diffs.
+    """
+    return _replace_blobs(value, lambda ref: "<blob %s, %d bytes>" % (ref.digest.hex(), ref.size))
@@ -0,0 +1,406 @@
+"""
+Lazy reader for binary (bplist00) property lists.
+
+The file is memory-mapped and only the trailer is parsed up front. Objects
+are decoded when they're accessed: dictionaries and arrays come back as
+read-only LazyDict/LazyArray views, and <data> values as LazyData, so a
+large blob is never copied into a Python bytes object unless something asks
+for it. lazy_equal() compares values by their encoded bytes where it can,
+so unchanged subtrees of two versions of a file never need to be decoded.
+
+Anything that isn't a binary plist (e.g. an XML plist) is parsed with
+plistlib as usual.
+"""
+import array
+import datetime
+import mmap
+import plistlib
+import struct
+from collections.abc import Mapping, Sequence
+
+BPLIST_MAGIC = b"bplist00"
+
+_TRAILER_FORMAT = ">6xBBQQQ"
+_TRAILER_SIZE = struct.calcsize(_TRAILER_FORMAT)
+_EPOCH = datetime.datetime(2001, 1, 1)
+
+# array typecodes for big-endian unsigned ints of each width
+_UINT_TYPECODES = {}
+for _typecode in "BHILQ":
+    _UINT_TYPECODES.setdefault(array.array(_typecode).itemsize, _typecode)
+_SWAP_BYTES = array.array("H", [1]).tobytes() != b"\x00\x01"
+
+# object markers (high nibble)
+_SIMPLE = 0x0
+_INT = 0x1
+_REAL = 0x2
+_DATE = 0x3
+_DATA = 0x4
+_ASCII = 0x5
+_UTF16 = 0x6
+_UID = 0x8
+_ARRAY = 0xA
+_SET = 0xC
+_DICT = 0xD
+_CONTAINER_KINDS = (_ARRAY, _SET, _DICT)
+_VARIABLE_KINDS = (_DATA, _ASCII, _UTF16)
+
+
+class BinaryPlistReader:
+    """
+    Random access to the objects of one binary plist.
+
+    With use_mmap=True (the default) the file is memory-mapped. The mapping
+    stays valid if the file is atomically replaced, which is how cfprefsd
+    writes preferences, but not if it's truncated in place; pass
+    use_mmap=False to read the file into memory instead.
+    """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        if bytes(self.buf[:8]) != BPLIST_MAGIC or len(self.buf) < 8 + _TRAILER_SIZE:
+            raise plistlib.InvalidFileException()
+        (self.offset_size, self.ref_size, self.num_objects,
+         self.top_object, self.offset_table_offset) = struct.unpack(
+            _TRAILER_FORMAT, self.buf[-_TRAILER_SIZE:])
+        table_end = self.offset_table_offset + self.num_objects * self.offset_size
+        if self.top_object >= self.num_objects or table_end > len(self.buf) - _TRAILER_SIZE:
+            raise plistlib.InvalidFileException()
+        # One fixed-width int per object; decoded in a single pass since
+        # every object access goes through it
+        self.offsets = self._uints(self.offset_table_offset,
+                                   self.num_objects, self.offset_size)
+
+    @classmethod
+    def open(cls, plistpath, use_mmap=True):
+        with open(plistpath, 'rb') as f:
+            if use_mmap:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        return cls(buf)
+
+    def _uint(self, start, size):
+        return int.from_bytes(self.buf[start:start + size], "big")
+
+    def _uints(self, start, count, size):
+        typecode = _UINT_TYPECODES.get(size)
+        if typecode is None:
+            return [self._uint(start + i * size, size) for i in range(count)]
+        values = array.array(typecode)
+        values.frombytes(self.buf[start:start + count * size])
+        if _SWAP_BYTES and size > 1:
+            values.byteswap()
+        return values
+
+    def object_offset(self, index):
+        try:
+            return self.offsets[index]
+        except IndexError:
+            raise plistlib.InvalidFileException()
+
+    def _length(self, offset, low):
+        # Returns (count, start of payload). Counts of 15 or more are stored
+        # as an int object right after the marker
+        if low != 0xF:
+            return low, offset + 1
+        int_marker = self.buf[offset + 1]
+        if int_marker >> 4 != _INT:
+            raise plistlib.InvalidFileException()
+        size = 1 << (int_marker & 0xF)
+        return self._uint(offset + 2, size), offset + 2 + size
+
+    def _refs(self, start, count):
+        return self._uints(start, count, self.ref_size)
+
+    def marker(self, index):
+        return self.buf[self.object_offset(index)]
+
+    def raw_range(self, index):
+        """
+        (start, end) of the encoded bytes of a leaf object, or of the marker,
+        length and references of a container.
+        """
+        offset = self.object_offset(index)
+        marker = self.buf[offset]
+        kind, low = marker >> 4, marker & 0xF
+        if kind == _SIMPLE:
+            return offset, offset + 1
+        if kind in (_INT, _REAL):
+            return offset, offset + 1 + (1 << low)
+        if kind == _DATE:
+            return offset, offset + 9
+        if kind == _UID:
+            return offset, offset + 2 + low
+        count, start = self._length(offset, low)
+        if kind in (_DATA, _ASCII):
+            return offset, start + count
+        if kind == _UTF16:
+            return offset, start + 2 * count
+        if kind in (_ARRAY, _SET):
+            return offset, start + count * self.ref_size
+        if kind == _DICT:
+            return offset, start + 2 * count * self.ref_size
+        raise plistlib.InvalidFileException()
+
+    def decode(self, index):
+        # Decode one object. Containers and data come back lazy
+        offset = self.object_offset(index)
+        marker = self.buf[offset]
+        kind, low = marker >> 4, marker & 0xF
+        if kind == _SIMPLE:
+            if marker == 0x08:
+                return False
+            if marker == 0x09:
+                return True
+            if marker == 0x00:
+                return None
+            raise plistlib.InvalidFileException()
+        if kind == _INT:
+            size = 1 << low
+            return int.from_bytes(self.buf[offset + 1:offset + 1 + size], "big", signed=low >= 3)
+        if kind == _REAL:
+            if low == 2:
+                return struct.unpack(">f", self.buf[offset + 1:offset + 5])[0]
+            if low == 3:
+                return struct.unpack(">d", self.buf[offset + 1:offset + 9])[0]
+            raise plistlib.InvalidFileException()
+        if marker == 0x33:
+            seconds = struct.unpack(">d", self.buf[offset + 1:offset + 9])[0]
+            return _EPOCH + datetime.timedelta(seconds=seconds)
+        if kind == _UID:
+            return plistlib.UID(self._uint(offset + 1, low + 1))
+        count, start = self._length(offset, low)
+        if kind == _DATA:
+            return LazyData(self, start, start + count)
+        if kind == _ASCII:
+            return bytes(self.buf[start:start + count]).decode("ascii")
+        if kind == _UTF16:
+            return bytes(self.buf[start:start + 2 * count]).decode("utf-16be")
+        if kind in (_ARRAY, _SET):
+            return LazyArray(self, self._refs(start, count))
+        if kind == _DICT:
+            keys = self._refs(start, count)
+            values = self._refs(start + count * self.ref_size, count)
+            return LazyDict(self, keys, values)
+        raise plistlib.InvalidFileException()
+
+    def top(self):
+        return self.decode(self.top_object)
+
+
+class LazyData:
+    """
+    A <data> value that stays in the file until it's needed.
+    """
+    __slots__ = ["reader", "start", "end"]
+
+    def __init__(self, reader, start, end):
+        self.reader = reader
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def view(self):
+        return self.reader.buf[self.start:self.end]
+
+    def __bytes__(self):
+        return bytes(self.view())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyData):
+            return len(self) == len(other) and self.view() == other.view()
+        if isinstance(other, (bytes, bytearray, memoryview)):
+            return self.view() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LazyData(%d bytes)" % len(self)
+
+
+class LazyArray(Sequence):
+    __slots__ = ["reader", "refs"]
+
+    def __init__(self, reader, refs):
+        self.reader = reader
+        self.refs = refs
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.reader.decode(ref) for ref in self.refs[i]]
+        return self.reader.decode(self.refs[i])
+
+    def __eq__(self, other):
+        return lazy_equal(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LazyArray(%d items)" % len(self)
+
+
+class LazyDict(Mapping):
+    __slots__ = ["reader", "key_refs", "value_refs", "_index"]
+
+    def __init__(self, reader, key_refs, value_refs):
+        self.reader = reader
+        self.key_refs = key_refs
+        self.value_refs = value_refs
+        self._index = None
+
+    @property
+    def index(self):
+        # key -> value object ref, decoded on first lookup. Only keys are
+        # decoded; values stay encoded until asked for
+        if self._index is None:
+            decode = self.reader.decode
+            self._index = {decode(k): v for k, v in zip(
+                self.key_refs, self.value_refs)}
+        return self._index
+
+    def value_ref(self, key):
+        return self.index[key]
+
+    def __getitem__(self, key):
+        return self.reader.decode(self.index[key])
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.key_refs)
+
+    def __eq__(self, other):
+        return lazy_equal(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LazyDict(%d keys)" % len(self)
+
+
+LAZY_TYPES = (LazyDict, LazyArray, LazyData)
+
+
+def is_lazy(value):
+    return isinstance(value, LAZY_TYPES)
+
+
+def materialize(value):
+    """
+    Fully decode a lazy value into the same objects plistlib would return.
+    Non-lazy values are returned as they are.
+    """
+    if isinstance(value, LazyDict):
+        decode = value.reader.decode
+        return {decode(k): materialize(decode(v))
+                for k, v in zip(value.key_refs, value.value_refs)}
+    if isinstance(value, LazyArray):
+        decode = value.reader.decode
+        return [materialize(decode(ref)) for ref in value.refs]
+    if isinstance(value, LazyData):
+        return bytes(value)
+    return value
+
+
+def _container_refs(reader, offset, marker):
+    count, start = reader._length(offset, marker & 0xF)
+    if marker >> 4 == _DICT:
+        refs = reader._refs(start, 2 * count)
+        return refs[:count], refs[count:]
+    return None, reader._refs(start, count)
+
+
+def _ref_equal(reader_a, ref_a, reader_b, ref_b):
+    # Compare two encoded objects, decoding as little as possible
+    offset_a = reader_a.object_offset(ref_a)
+    offset_b = reader_b.object_offset(ref_b)
+    marker_a = reader_a.buf[offset_a]
+    marker_b = reader_b.buf[offset_b]
+    kind_a, kind_b = marker_a >> 4, marker_b >> 4
+    if kind_a in _CONTAINER_KINDS or kind_b in _CONTAINER_KINDS:
+        if kind_a != kind_b:
+            return False
+        keys_a, values_a = _container_refs(reader_a, offset_a, marker_a)
+        keys_b, values_b = _container_refs(reader_b, offset_b, marker_b)
+        if len(values_a) != len(values_b):
+            return False
+        if keys_a is not None and not all(
+                _ref_equal(reader_a, ka, reader_b, kb) for ka, kb in zip(keys_a, keys_b)):
+            # same size but keys in a different order (or different keys)
+            return lazy_equal(reader_a.decode(ref_a), reader_b.decode(ref_b))
+        return all(_ref_equal(reader_a, va, reader_b, vb)
+                   for va, vb in zip(values_a, values_b))
+    if marker_a == marker_b:
+        start_a, end_a = reader_a.raw_range(ref_a)
+        start_b, end_b = reader_b.raw_range(ref_b)
+        if reader_a.buf[start_a:end_a] == reader_b.buf[start_b:end_b]:
+            return True
+        if kind_a not in _VARIABLE_KINDS or marker_a & 0xF != 0xF:
+            # same marker means same type and size, so the values differ
+            return False
+    # Same value, different encoding (e.g. int widths, length encodings, or
+    # a string stored as UTF-16 by one writer and ASCII by another)
+    a = reader_a.decode(ref_a)
+    b = reader_b.decode(ref_b)
+    if isinstance(a, LazyData) or isinstance(b, LazyData):
+        return a == b
+    return type(a) is type(b) and a == b
+
+
+def lazy_equal(a, b):
+    """
+    Plist equality for lazy and/or ordinary values. True and 1, or 1 and
+    1.0, are different plist values and compare unequal.
+    """
+    if a is b:
+        return True
+    if isinstance(a, LazyDict) and isinstance(b, LazyDict):
+        if len(a) != len(b):
+            return False
+        index_a, index_b = a.index, b.index
+        if index_a.keys() != index_b.keys():
+            return False
+        return all(_ref_equal(a.reader, ref, b.reader, index_b[key])
+                   for key, ref in index_a.items())
+    if isinstance(a, LazyArray) and isinstance(b, LazyArray):
+        if len(a) != len(b):
+            return False
+        return all(_ref_equal(a.reader, ra, b.reader, rb)
+                   for ra, rb in zip(a.refs, b.refs))
+    if isinstance(a, LazyData) or isinstance(b, LazyData):
+        if not isinstance(a, LazyData):
+            a, b = b, a
+        return isinstance(b, (LazyData, bytes, bytearray)) and a == b
+    if is_lazy(a) or is_lazy(b):
+        a, b = materialize(a), materialize(b)
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(lazy_equal(v, b[k]) for k, v in a.items())
+    if isinstance(a, list):
+        return len(a) == len(b) and all(lazy_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def load_lazy(plistpath, use_mmap=True):
+    """
+    Open a plist for lazy access. Binary plists come back as lazy views;
+    anything else is parsed in full with plistlib.
+    """
+    with open(plistpath, 'rb') as f:
+        header = f.read(len(BPLIST_MAGIC))
+        if header != BPLIST_MAGIC:
+            f.seek(0)
+            return plistlib.load(f)
+    return BinaryPlistReader.open(plistpath, use_mmap=use_mmap).top()
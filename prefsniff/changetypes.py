@@ -1,16 +1,15 @@
-import inspect
-import plistlib
-import xml.etree.ElementTree as ET
 from abc import ABCMeta
 from shlex import quote as cmd_quote
 from typing import Dict
 
 from py_dict_repr.py_dict_repr import DictRepr
 
+from .blobs import BlobRef
 from .exceptions import (
     PSChangeTypeException,
     PSChangeTypeNotImplementedException
 )
+from .xmlfrag import to_xmlfrag
 
 
 class PSChangeTypeRegistry(type):
@@ -49,7 +48,42 @@ class PSChangeTypeFactory:
         return obj
 
 
-class PSChangeTypeBase(DictRepr, metaclass=PSChangeTypeMeta):
+class SlottedDictRepr:
+    """
+    DictRepr's mapping behaviour, for classes with __slots__. Inheriting
+    DictRepr itself would give every instance a __dict__.
+    """
+    __slots__ = ()
+
+    _DictIterator = DictRepr._DictIterator
+    __iter__ = DictRepr.__iter__
+    __getitem__ = DictRepr.__getitem__
+    _convert = DictRepr._convert
+    _convert_dict = DictRepr._convert_dict
+    _convert_sequence = DictRepr._convert_sequence
+    items = DictRepr.items
+
+
+# so isinstance(change, DictRepr) still holds, and DictRepr._convert()
+# turns nested change objects into dicts
+DictRepr.register(SlottedDictRepr)
+
+# not yet computed
+_UNSET = object()
+
+
+class PSChangeTypeBase(SlottedDictRepr, metaclass=PSChangeTypeMeta):
+    """
+    One defaults(1) change.
+
+    Change objects are created in bulk and most are only ever rendered
+    once, if at all, so they're slotted, and converted_value, argv() and
+    shell_command() are computed on first use and then cached. Treat
+    them as immutable once created.
+    """
+    __slots__ = ("domain", "key", "value", "byhost",
+                 "_converted_value", "_argv", "_shell_command")
+
     CHANGE_TYPE = None
     COMMAND = "defaults"
     ACTION = None
@@ -59,14 +93,53 @@ class PSChangeTypeBase(DictRepr, metaclass=PSChangeTypeMeta):
         if self.ACTION is None:
             raise NotImplementedError(
                 "Need to sublclass and override cls.ACTION")
-        self.command = self.COMMAND
-        self.action = self.ACTION
         self.domain = domain
         self.key = key
-        self.type = self.TYPE
         self.value = value
-        self.converted_value = value
         self.byhost = byhost
+        self._converted_value = _UNSET
+        self._argv = None
+        self._shell_command = None
+
+    def __getstate__(self):
+        # Only the change itself, not what's been rendered from it: a copy
+        # would hold its own _UNSET, and results can be rebuilt anyway
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if not name.startswith("_"):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._converted_value = _UNSET
+        self._argv = None
+        self._shell_command = None
+
+    # command, action and type are fixed per change type
+    @property
+    def command(self):
+        return self.COMMAND
+
+    @property
+    def action(self):
+        return self.ACTION
+
+    @property
+    def type(self):
+        return self.TYPE
+
+    @property
+    def converted_value(self):
+        if self._converted_value is _UNSET:
+            self._converted_value = self._convert_value()
+        return self._converted_value
+
+    def _convert_value(self):
+        # the value as passed to defaults(1); str() is applied later
+        return self.value
 
     def keys(self):
         _keys = ["change_type", "command", "action",
@@ -92,6 +165,27 @@ class PSChangeTypeBase(DictRepr, metaclass=PSChangeTypeMeta):
         return value
 
     def argv(self, quote=True):
+        # Only the unquoted argv is cached: it shares its strings with the
+        # change itself. A fresh list each time, since callers may modify it
+        if self._argv is None:
+            self._argv = tuple(self._build_argv(quote=False))
+        argv = list(self._argv)
+        if quote:
+            # argv[0] is the bare command name
+            argv[1:] = [self._quote(arg) for arg in argv[1:]]
+        return argv
+
+    def _build_argv(self, quote=True):
+        argv = self._command_argv(quote=quote)
+        value_argv = self._value_argv(quote=quote)
+
+        if value_argv is not None:
+            argv.extend(value_argv)
+
+        return argv
+
+    def _command_argv(self, quote=True):
+        # everything before the value
         argv = [self.command]
         if self.byhost:
             argv.append("-currentHost")
@@ -101,11 +195,6 @@ class PSChangeTypeBase(DictRepr, metaclass=PSChangeTypeMeta):
         if self.type is not None:
             type_arg = f"-{self.type}"
             argv.append(self._quote(type_arg, quote=quote))
-        value_argv = self._value_argv(quote=quote)
-
-        if value_argv is not None:
-            argv.extend(value_argv)
-
         return argv
 
     def _value_argv(self, quote=True):
@@ -125,18 +214,20 @@ class PSChangeTypeBase(DictRepr, metaclass=PSChangeTypeMeta):
         return value_argv
 
     def shell_command(self):
-        argv = self.argv(quote=True)
-        command = ' '.join(argv)
-        return command
+        if self._shell_command is None:
+            self._shell_command = ' '.join(self._build_argv(quote=True))
+        return self._shell_command
 
 
 class PSChangeTypeString(PSChangeTypeBase):
+    __slots__ = ()
     CHANGE_TYPE = "string"
     ACTION = "write"
     TYPE = "string"
 
 
 class PSChangeTypeKeyDeleted(PSChangeTypeString):
+    __slots__ = ()
     CHANGE_TYPE = "deleted"
     ACTION = "delete"
     TYPE = None
@@ -146,12 +237,11 @@ class PSChangeTypeKeyDeleted(PSChangeTypeString):
 
 
 class PSChangeTypeFloat(PSChangeTypeString):
+    __slots__ = ()
     CHANGE_TYPE = "float"
     TYPE = "float"
 
     def __init__(self, domain, byhost, key, value):
-        self.type = "-float"
-
         if not isinstance(value, float):
             raise PSChangeTypeException(
                 "Float required for -float prefs change.")
@@ -160,6 +250,7 @@ class PSChangeTypeFloat(PSChangeTypeString):
 
 
 class PSChangeTypeInt(PSChangeTypeString):
+    __slots__ = ()
     CHANGE_TYPE = "int"
     TYPE = "int"
 
@@ -173,6 +264,7 @@ class PSChangeTypeInt(PSChangeTypeString):
 
 
 class PSChangeTypeBool(PSChangeTypeString):
+    __slots__ = ()
     CHANGE_TYPE = "bool"
     TYPE = "bool"
 
@@ -184,37 +276,18 @@ class PSChangeTypeBool(PSChangeTypeString):
 
 
 class PSChangeTypeCompositeBase(PSChangeTypeBase):
+    __slots__ = ()
     CHANGE_TYPE = None
     TYPE = None
 
     def to_xmlfrag(self, value):
-
-        # create plist-serialized form of changed objects
-        plist_str = plistlib.dumps(value, fmt=plistlib.FMT_XML).decode('utf-8')
-
-        # remove newlines and tabs from plist
-        plist_str = "".join([line.strip() for line in plist_str.splitlines()])
-        # parse the plist xml doc, so we can pull out the important parts.
-        tree = ET.ElementTree(ET.fromstring(plist_str))
-        # get elements inside <plist> </plist>
-        children = list(tree.getroot())
-        # there can only be one element inside <plist>
-        if len(children) < 1:
-            fn = inspect.getframeinfo(inspect.currentframe()).function
-            raise PSChangeTypeException(
-                "%s: Empty dictionary for key %s" % (fn, str(self.key)))
-        if len(children) > 1:
-            fn = inspect.getframeinfo(inspect.currentframe()).function
-            raise PSChangeTypeException(
-                "%s: Something went wrong for key %s. Can only support one dictionary for dict change." % (fn, self.dict_key))
-        # extract changed objects out of the plist element
-        # python 2 & 3 compat
-        # https://stackoverflow.com/questions/15304229/convert-python-elementtree-to-string#15304351
-        xmlfrag = ET.tostring(children[0]).decode()
-        return xmlfrag
+        # compact XML fragment of the changed object, suitable as a
+        # defaults(1) argument
+        return to_xmlfrag(value)
 
 
 class PSChangeTypeArray(PSChangeTypeCompositeBase):
+    __slots__ = ()
     CHANGE_TYPE = "array"
     ACTION = "write"
     TYPE = None
@@ -224,10 +297,13 @@ class PSChangeTypeArray(PSChangeTypeCompositeBase):
             raise PSChangeTypeException(
                 "PSChangeTypeArray requires a list value type.")
         super().__init__(domain, byhost, key, value)
-        self.converted_value = self.to_xmlfrag(value)
+
+    def _convert_value(self):
+        return self.to_xmlfrag(self.value)
 
 
 class PSChangeTypeDict(PSChangeTypeCompositeBase):
+    __slots__ = ()
     CHANGE_TYPE = "dict"
     ACTION = "write"
     # We have to omit the -dict type
@@ -239,10 +315,13 @@ class PSChangeTypeDict(PSChangeTypeCompositeBase):
             raise PSChangeTypeException(
                 "Dict required for -dict prefs change.")
         super().__init__(domain, byhost, key, value)
-        self.converted_value = self.to_xmlfrag(value)
+
+    def _convert_value(self):
+        return self.to_xmlfrag(self.value)
 
 
 class PSChangeTypeDictAdd(PSChangeTypeCompositeBase):
+    __slots__ = ("subkey",)
     CHANGE_TYPE = "dict-add"
     ACTION = "write"
     TYPE = "dict-add"
@@ -250,7 +329,9 @@ class PSChangeTypeDictAdd(PSChangeTypeCompositeBase):
     def __init__(self, domain, byhost, key, subkey, value):
         super().__init__(domain, byhost, key, value)
         self.subkey = subkey
-        self.converted_value = self._generate_value_string(subkey, value)
+
+    def _convert_value(self):
+        return self._generate_value_string(self.subkey, self.value)
 
     def _generate_value_string(self, subkey, value):
         xmlfrag = self.to_xmlfrag(value)
@@ -280,13 +361,36 @@ class PSChangeTypeDictAdd(PSChangeTypeCompositeBase):
     #     return " %s '%s'" % (self.dict_key, xmlfrag)
 
 
+class PSChangeTypeDictMerge(PSChangeTypeCompositeBase):
+    """
+    Several -dict-add pairs for one dictionary, written by one command:
+    defaults write domain key -dict-add subkey1 value1 subkey2 value2
+    """
+    __slots__ = ()
+    CHANGE_TYPE = "dict-merge"
+    ACTION = "write"
+    TYPE = "dict-add"
+
+    def __init__(self, domain, byhost, key, value):
+        if not isinstance(value, dict) or not value:
+            raise PSChangeTypeException(
+                "Non-empty dict required for -dict-add merge.")
+        super().__init__(domain, byhost, key, value)
+
+    def _convert_value(self):
+        values = []
+        for subkey, value in self.value.items():
+            values.extend([subkey, self.to_xmlfrag(value)])
+        return values
+
+
 class PSChangeTypeArrayAdd(PSChangeTypeArray):
+    __slots__ = ()
     CHANGE_TYPE = "array-add"
     TYPE = "array-add"
 
-    def __init__(self, domain, key, byhost, value):
-        super().__init__(domain, byhost, key, value)
-        self.converted_value = self._generate_value_string(value)
+    def _convert_value(self):
+        return self._generate_value_string(self.value)
 
     def _generate_value_string(self, value):
         values = []
@@ -296,14 +400,54 @@ class PSChangeTypeArrayAdd(PSChangeTypeArray):
 
 
 class PSChangeTypeData(PSChangeTypeString):
+    """
+    A <data> value, written as -data with the bytes in hex.
+
+    For a value held in a BlobStore, shell_command() reads the hex from the
+    blob file when the command runs, rather than carrying it inline.
+    defaults(1) only accepts data on its command line, though, so the
+    expanded command, and argv(), are still twice the size of the blob;
+    use a plist patch (prefsniff.patch) for values near ARG_MAX.
+    """
+    __slots__ = ()
     CHANGE_TYPE = "data"
+    TYPE = "data"
+    # stands in for a BlobStore value's hex in argv(load_blob=False)
+    BLOB_PLACEHOLDER = "$blob"
 
     def __init__(self, domain, byhost, key, value):
-        raise PSChangeTypeNotImplementedException(
-            "%s not implemented" % self.__class__.__name__)
+        if not isinstance(value, (bytes, bytearray, BlobRef)):
+            raise PSChangeTypeException(
+                "Bytes required for -data prefs change.")
+        super().__init__(domain, byhost, key, value)
+
+    def _convert_value(self):
+        if isinstance(self.value, BlobRef):
+            return self.value
+        return self.value.hex()
+
+    def argv(self, quote=True, load_blob=True):
+        """
+        With load_blob=False, a value held in a BlobStore is given as
+        BLOB_PLACEHOLDER instead of being read back as hex.
+        """
+        if isinstance(self.value, BlobRef):
+            if not load_blob:
+                return self._command_argv(quote=quote) + [self.BLOB_PLACEHOLDER]
+            # not cached: unquoted, this holds the whole blob as hex
+            return self._build_argv(quote=quote)
+        return super().argv(quote=quote)
+
+    def _value_argv(self, quote=True):
+        if not isinstance(self.value, BlobRef):
+            return super()._value_argv(quote=quote)
+        if quote:
+            return ['"$(xxd -p %s | tr -d \'\\n\')"' % cmd_quote(self.value.path)]
+        return [self.value.load().hex()]
 
 
 class PSChangeTypeDate(PSChangeTypeString):
+    __slots__ = ()
     CHANGE_TYPE = "date"
 
     def __init__(self, domain, byhost, key, value):
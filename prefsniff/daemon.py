@@ -0,0 +1,618 @@
+"""
+Long-running watcher serving change sets over a Unix domain socket.
+
+`prefsniff daemon` baselines the preferences tree once and keeps watching
+it. Any number of clients connect to its socket (~/.prefsniff/daemon.sock
+by default, mode 0600) and exchange newline-delimited JSON. Requests:
+
+    {"op": "subscribe", "include": [str], "exclude": [str], "paths": [str]}
+        Replied to with {"op": "subscribe"}, then a change record for every
+        matching change, in the NDJSON record schema of prefsniff/output.py.
+        include/exclude take the same patterns as --include/--exclude;
+        paths are plist paths, directories or globs. Subscribing again
+        replaces the filters. "batch" counts every change set the daemon
+        publishes, so a filtered subscription sees gaps.
+    {"op": "snapshot", "domain": str, "byhost": bool}
+    {"op": "snapshot", "plist": str}
+        {"op": "snapshot", "plist": str, "domain": str, "byhost": bool,
+         "value": the plist's current content, encoded as in change records}
+    {"op": "list"}
+        {"op": "list", "plists": [{"plist": str, "domain": str, "byhost": bool}]}
+
+A request that fails is answered with {"op": "error", "error": str}. If it
+fails unexpectedly (say, JSON nested too deeply to decode), the connection
+is closed once that reply has been sent.
+
+Each change set is encoded once, however many clients it goes to, and the
+watcher never waits for a client. Once more than max_buffer bytes are
+queued for a client, change sets are dropped for it until it has read
+everything queued, and it's then sent
+{"op": "overflow", "changesets": int, "plists": [str]}: how many it
+missed, and the plists it should take a fresh snapshot of.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import re
+import selectors
+import signal
+import socket
+import sys
+import threading
+from collections import deque
+
+from .baseline import BASELINE_LAZY, BASELINE_PARALLEL
+from .blobs import DEFAULT_BLOB_DIR, DEFAULT_BLOB_THRESHOLD, BlobStore
+from .exceptions import PrefsDaemonException
+from .filters import PrefsPathFilter
+from .output import NdjsonChangeSetWriter, _json_default
+from .prefsniff import PrefSniff
+from .scheduler import DebounceScheduler
+from .watch import PrefsWatchEngine, expand_watchpaths
+
+DAEMON_COMMAND = "daemon"
+SUBSCRIBE_COMMAND = "subscribe"
+SNAPSHOT_COMMAND = "snapshot"
+DAEMON_COMMANDS = (DAEMON_COMMAND, SUBSCRIBE_COMMAND, SNAPSHOT_COMMAND)
+
+DEFAULT_SOCKET_PATH = "~/.prefsniff/daemon.sock"
+# output queued for one client before change sets are dropped for it
+DEFAULT_MAX_BUFFER = 1024 * 1024
+# a longer request line gets the client disconnected
+MAX_REQUEST_SIZE = 64 * 1024
+
+OP_SUBSCRIBE = "subscribe"
+OP_SNAPSHOT = "snapshot"
+OP_LIST = "list"
+OP_OVERFLOW = "overflow"
+OP_ERROR = "error"
+
+
+def _encode(record) -> bytes:
+    return (json.dumps(record, separators=(",", ":"), default=_json_default) + "\n").encode("utf-8")
+
+
+class Subscription:
+    """
+    The change sets a client wants: those for plists whose file name passes
+    `include`/`exclude` and, if `paths` are given, that are one of them or
+    inside one of them.
+    """
+
+    def __init__(self, include=(), exclude=(), paths=()):
+        self.path_filter = PrefsPathFilter(include, exclude)
+        self.paths = [os.path.abspath(os.path.expanduser(path)) for path in paths]
+
+    def matches(self, plistpath) -> bool:
+        if not self.path_filter.matches_path(plistpath):
+            return False
+        if not self.paths:
+            return True
+        for path in self.paths:
+            if (plistpath.startswith(path.rstrip(os.sep) + os.sep) or
+                    fnmatch.fnmatchcase(plistpath, path)):
+                return True
+        return False
+
+
+class _Client:
+    # One connection. Everything but the request buffer is guarded by
+    # PrefsDaemon._lock
+
+    def __init__(self, sock, max_buffer):
+        self.sock = sock
+        self.max_buffer = max_buffer
+        self.request = bytearray()
+        self.output = deque()
+        self.buffered = 0
+        self.subscription = None
+        self.events = selectors.EVENT_READ
+        self.closed = False
+        # close once everything queued has been sent; nothing more is read
+        self.closing = False
+        # change sets dropped since the client fell behind, and their plists
+        self.dropped = 0
+        self.stale = set()
+
+    def queue(self, data: bytes, plistpath=None) -> bool:
+        # Change records (with a plistpath) are dropped for a client that's
+        # behind. A client with nothing queued always gets the next one
+        if plistpath is not None and (
+                self.dropped or (self.buffered and self.buffered + len(data) > self.max_buffer)):
+            self.dropped += 1
+            self.stale.add(plistpath)
+            return False
+        self.output.append(memoryview(data))
+        self.buffered += len(data)
+        return True
+
+    def send(self):
+        # as much as the socket takes without blocking
+        while self.output:
+            chunk = self.output[0]
+            sent = self.sock.send(chunk)
+            self.buffered -= sent
+            if sent < len(chunk):
+                self.output[0] = chunk[sent:]
+                return
+            self.output.popleft()
+            if not self.output and self.dropped:
+                # caught up; say what was missed
+                self.queue(_encode({"op": OP_OVERFLOW, "changesets": self.dropped,
+                                    "plists": sorted(self.stale)}))
+                self.dropped = 0
+                self.stale.clear()
+
+
+class PrefsDaemon:
+    """
+    Serve a PrefsWatchEngine's change sets, and snapshots of the plists it
+    watches, to clients of a Unix domain socket.
+
+    Clients are served by one selector thread. publish() is called with
+    each change set, from serve_forever() or by the caller.
+    """
+
+    def __init__(self, engine: PrefsWatchEngine, socket_path=DEFAULT_SOCKET_PATH,
+                 max_buffer=DEFAULT_MAX_BUFFER):
+        self.engine = engine
+        self.socket_path = os.path.abspath(os.path.expanduser(socket_path))
+        self.max_buffer = max_buffer
+        self.writer = NdjsonChangeSetWriter()
+        # change sets published, and deliveries dropped for slow clients
+        self.published = 0
+        self.dropped = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._selector = None
+        self._listener = None
+        self._wakeup = None
+        self._wakeup_sender = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def clients(self):
+        return len(self._clients)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._running:
+            return
+        self._listener = self._bind()
+        self._listener.setblocking(False)
+        self._wakeup, self._wakeup_sender = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _bind(self):
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # left behind by a daemon that didn't exit cleanly
+                os.unlink(self.socket_path)
+            else:
+                raise PrefsDaemonException(
+                    "A daemon is already listening on %s" % self.socket_path)
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        # preferences are private; only their owner may connect
+        os.chmod(self.socket_path, 0o600)
+        listener.listen()
+        return listener
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._wake()
+        self._thread.join()
+        for client in list(self._clients.values()):
+            self._close(client)
+        self._selector.close()
+        self._listener.close()
+        self._wakeup.close()
+        self._wakeup_sender.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def _wake(self):
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            # plenty of wakeups pending already
+            pass
+
+    def publish(self, diffs) -> int:
+        """
+        Queue a change set for every subscriber it matches. Returns the
+        number of clients it was queued for.
+        """
+        if not diffs.changes:
+            return 0
+        data = "".join(self.writer.format_changeset(diffs)).encode("utf-8")
+        queued = 0
+        with self._lock:
+            for client in self._clients.values():
+                if (client.closing or client.subscription is None or
+                        not client.subscription.matches(diffs.plistpath)):
+                    continue
+                if client.queue(data, diffs.plistpath):
+                    queued += 1
+                else:
+                    self.dropped += 1
+            self.published += 1
+        if queued:
+            self._wake()
+        return queued
+
+    def serve_forever(self):
+        for diffs in self.engine.changesets():
+            self.publish(diffs)
+
+    def snapshot(self, plistpath=None, domain=None, byhost=False):
+        """
+        The current content of a watched plist, given its path or domain,
+        as a snapshot reply.
+        """
+        index = self.engine.domain_index
+        if plistpath is None:
+            if domain is None:
+                raise PrefsDaemonException("A snapshot needs a plist or a domain")
+            plistpath = index.path_for(domain, byhost=bool(byhost))
+            if plistpath is None:
+                raise PrefsDaemonException("No watched plist for domain %s" % domain)
+        plistpath = os.path.abspath(os.path.expanduser(plistpath))
+        watched = self.engine.watched.get(plistpath)
+        if watched is None:
+            raise PrefsDaemonException("Not watched: %s" % plistpath)
+        entry = index.get(plistpath)
+        if entry is None:
+            raise PrefsDaemonException("No longer exists: %s" % plistpath)
+        return {"op": OP_SNAPSHOT, "plist": plistpath, "domain": entry.domain,
+                "byhost": entry.byhost, "value": watched.pref}
+
+    def plists(self):
+        plists = []
+        for plistpath in sorted(self.engine.watched):
+            entry = self.engine.domain_index.get(plistpath)
+            if entry is not None:
+                plists.append({"plist": plistpath, "domain": entry.domain,
+                               "byhost": entry.byhost})
+        return plists
+
+    def _serve(self):
+        while self._running:
+            for key, events in self._selector.select():
+                if key.fileobj is self._listener:
+                    self._accept()
+                elif key.fileobj is self._wakeup:
+                    self._drain_wakeups()
+                else:
+                    client = key.data
+                    try:
+                        if events & selectors.EVENT_READ:
+                            self._read(client)
+                        if events & selectors.EVENT_WRITE and not client.closed:
+                            self._write(client)
+                    except Exception:
+                        # one client's trouble mustn't stop the others
+                        self._close(client)
+            self._update_interest()
+
+    def _accept(self):
+        try:
+            sock, _ = self._listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = _Client(sock, self.max_buffer)
+        with self._lock:
+            self._clients[sock] = client
+        self._selector.register(sock, client.events, data=client)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _update_interest(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            wanted = [(client, (0 if client.closing else selectors.EVENT_READ) | (
+                selectors.EVENT_WRITE if client.output else 0)) for client in clients]
+        for client, events in wanted:
+            if events != client.events:
+                client.events = events
+                self._selector.modify(client.sock, events, data=client)
+
+    def _close(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        with self._lock:
+            self._clients.pop(client.sock, None)
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close(client)
+            return
+        client.request += data
+        while not client.closed and not client.closing:
+            end = client.request.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(client.request[:end])
+            del client.request[:end + 1]
+            if line.strip():
+                self._handle(client, line)
+        if len(client.request) > MAX_REQUEST_SIZE:
+            self._close(client)
+
+    def _write(self, client):
+        with self._lock:
+            try:
+                client.send()
+            except BlockingIOError:
+                return
+            except OSError:
+                pass
+            else:
+                if not (client.closing and not client.output):
+                    return
+        self._close(client)
+
+    def _handle(self, client, line):
+        subscription = None
+        closing = False
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise PrefsDaemonException("A request must be a JSON object")
+            op = request.get("op")
+            if op == OP_SUBSCRIBE:
+                subscription = Subscription(request.get("include", ()),
+                                            request.get("exclude", ()),
+                                            request.get("paths", ()))
+                reply = {"op": OP_SUBSCRIBE}
+            elif op == OP_SNAPSHOT:
+                reply = self.snapshot(plistpath=request.get("plist"),
+                                      domain=request.get("domain"),
+                                      byhost=request.get("byhost", False))
+            elif op == OP_LIST:
+                reply = {"op": OP_LIST, "plists": self.plists()}
+            else:
+                raise PrefsDaemonException("Unknown request: %s" % op)
+            data = _encode(reply)
+        except (ValueError, TypeError, re.error, PrefsDaemonException) as e:
+            subscription = None
+            data = _encode({"op": OP_ERROR, "error": str(e)})
+        except Exception as e:
+            # e.g. RecursionError from deeply nested JSON
+            subscription = None
+            closing = True
+            data = _encode({"op": OP_ERROR, "error": "%s: %s" % (type(e).__name__, e)})
+        with self._lock:
+            # together, so no change record can come before the reply
+            if subscription is not None:
+                client.subscription = subscription
+            client.queue(data)
+            client.closing = client.closing or closing
+
+
+class DaemonClient:
+    """
+    A connection to a running PrefsDaemon.
+
+    Once subscribe() is called the connection only carries change records,
+    so take snapshots on a second connection.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        self.socket_path = os.path.abspath(os.path.expanduser(socket_path))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.socket_path)
+        except OSError as e:
+            self.sock.close()
+            raise PrefsDaemonException(
+                "Can't connect to %s: %s" % (self.socket_path, e.strerror)) from None
+        self._file = self.sock.makefile("rb")
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _receive(self):
+        line = self._file.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def _request(self, request):
+        self.sock.sendall(_encode(request))
+        reply = self._receive()
+        if reply is None:
+            raise PrefsDaemonException("The daemon closed the connection")
+        if reply.get("op") == OP_ERROR:
+            raise PrefsDaemonException(reply["error"])
+        return reply
+
+    def snapshot(self, domain=None, byhost=False, plistpath=None):
+        request = {"op": OP_SNAPSHOT, "byhost": byhost}
+        if plistpath is not None:
+            request["plist"] = plistpath
+        else:
+            request["domain"] = domain
+        return self._request(request)
+
+    def plists(self):
+        return self._request({"op": OP_LIST})["plists"]
+
+    def subscribe(self, include=(), exclude=(), paths=()):
+        """
+        Yield change records, and overflow notices, as they arrive, until
+        the daemon goes away.
+        """
+        self._request({"op": OP_SUBSCRIBE, "include": list(include),
+                       "exclude": list(exclude), "paths": list(paths)})
+        while True:
+            record = self._receive()
+            if record is None:
+                return
+            yield record
+
+
+def parse_daemon_args(argv):
+    parser = argparse.ArgumentParser(prog="prefsniff")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    daemon_parser = subparsers.add_parser(
+        DAEMON_COMMAND, help="Keep watching preferences, and serve changes to subscribers on a Unix socket.")
+    daemon_parser.add_argument(
+        "watchpaths", nargs="*", default=PrefSniff.STANDARD_PATHS,
+        help="Directories, plist files or globs to watch. Default: %s" % " ".join(PrefSniff.STANDARD_PATHS))
+    daemon_parser.add_argument(
+        "--quiet-period", type=float, default=DebounceScheduler.DEFAULT_QUIET_PERIOD,
+        help="Seconds a file must go without events before it is diffed. Default: %(default)s")
+    daemon_parser.add_argument(
+        "--max-delay", type=float, default=DebounceScheduler.DEFAULT_MAX_DELAY,
+        help="Maximum seconds to hold back a file that keeps changing. Default: %(default)s")
+    daemon_parser.add_argument(
+        "--baseline", choices=[BASELINE_LAZY, BASELINE_PARALLEL], default=BASELINE_LAZY,
+        help="Read existing plists now and parse them when they change, or parse them all up front in parallel. Default: %(default)s")
+    daemon_parser.add_argument(
+        "--max-buffer", type=int, default=DEFAULT_MAX_BUFFER, metavar="BYTES",
+        help="Output queued for one client before changes are dropped for it. Default: %(default)s")
+    daemon_parser.add_argument(
+        "--blob-threshold", type=int, default=DEFAULT_BLOB_THRESHOLD, metavar="BYTES",
+        help="Keep <data> values larger than BYTES on disk rather than in memory; 0 to keep everything in memory. Default: %(default)s")
+    daemon_parser.add_argument(
+        "--blob-dir", default=DEFAULT_BLOB_DIR, metavar="DIR",
+        help="Where --blob-threshold keeps large <data> values. Default: %(default)s")
+    daemon_parser.add_argument(
+        "--prune-blobs", type=float, metavar="DAYS",
+        help="On startup, delete blobs in --blob-dir not stored or seen again in DAYS days.")
+
+    subscribe_parser = subparsers.add_parser(
+        SUBSCRIBE_COMMAND, help="Print a running daemon's change records as NDJSON.")
+    subscribe_parser.add_argument(
+        "--include", action="append", default=[], metavar="PATTERN",
+        help="Only plists matching PATTERN, a domain name or glob on the file name, or re:REGEX. May be repeated.")
+    subscribe_parser.add_argument(
+        "--exclude", action="append", default=[], metavar="PATTERN",
+        help="Not plists matching PATTERN, in the same forms as --include. May be repeated.")
+    subscribe_parser.add_argument(
+        "--path", action="append", default=[], dest="paths", metavar="PATH",
+        help="Only plists at or under PATH, which may be a glob. May be repeated.")
+
+    snapshot_parser = subparsers.add_parser(
+        SNAPSHOT_COMMAND, help="Print the current content of a plist a daemon is watching, as JSON.")
+    snapshot_parser.add_argument("target", help="A defaults domain, or a plist path.")
+    snapshot_parser.add_argument(
+        "--byhost", action="store_true", help="The domain's -currentHost (ByHost) plist.")
+
+    for subparser in (daemon_parser, subscribe_parser, snapshot_parser):
+        subparser.add_argument(
+            "--socket", default=DEFAULT_SOCKET_PATH,
+            help="Daemon socket. Default: %(default)s")
+    return parser.parse_args(argv)
+
+
+def _run_daemon(args):
+    if args.prune_blobs is not None:
+        BlobStore(args.blob_dir).prune(max_age=args.prune_blobs * 24 * 60 * 60)
+    blob_store = None
+    if args.blob_threshold > 0:
+        blob_store = BlobStore(args.blob_dir, threshold=args.blob_threshold)
+    engine = PrefsWatchEngine(quiet_period=args.quiet_period, max_delay=args.max_delay,
+                              blob_store=blob_store)
+    for watchpath in args.watchpaths:
+        watchpath = os.path.expanduser(watchpath)
+        if os.path.isdir(watchpath):
+            engine.add_directory(watchpath, baseline=args.baseline)
+            continue
+        plistpaths = [path for path in expand_watchpaths([watchpath]) if os.path.isfile(path)]
+        if not plistpaths:
+            print("Skipping %s: no plist files" % watchpath, file=sys.stderr)
+        engine.add_paths(plistpaths)
+
+    daemon = PrefsDaemon(engine, args.socket, max_buffer=args.max_buffer)
+    try:
+        daemon.start()
+    except PrefsDaemonException as e:
+        print("Error: %s" % e)
+        exit(1)
+    # SIGTERM stops the daemon as cleanly as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    engine.start()
+    print("Serving %d plists on %s" % (len(engine.watched), daemon.socket_path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop()
+        daemon.stop()
+
+
+def daemon_main(argv):
+    args = parse_daemon_args(argv)
+    if args.command == DAEMON_COMMAND:
+        _run_daemon(args)
+        return
+    try:
+        with DaemonClient(args.socket) as client:
+            if args.command == SNAPSHOT_COMMAND:
+                if os.sep in args.target or args.target.endswith(".plist"):
+                    reply = client.snapshot(plistpath=args.target)
+                else:
+                    reply = client.snapshot(domain=args.target, byhost=args.byhost)
+                print(json.dumps(reply, indent=2))
+                return
+            for record in client.subscribe(args.include, args.exclude, args.paths):
+                print(json.dumps(record, separators=(",", ":")), flush=True)
+    except PrefsDaemonException as e:
+        print("Error: %s" % e)
+        exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,284 @@
+import datetime
+import hashlib
+from collections import namedtuple
+from collections.abc import Mapping
+from typing import Dict, List
+
+from .blobs import BlobRef, data_digest
+from .bplist import is_lazy, lazy_equal
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+
+# A single difference between two plists. `path` is a tuple of dictionary
+# keys leading from the top-level <dict> to the changed value. Arrays aren't
+# descended into, so a changed array is reported as one MODIFIED path
+PathChange = namedtuple("PathChange", ["kind", "path", "before", "after"])
+
+# One step of an array edit script. Edits are applied in order to a copy of
+# the "before" array; `index` is a position in that array as it stands after
+# all previous edits. "insert" puts `values` at `index`, "delete" removes
+# `count` elements starting at `index`
+ArrayEdit = namedtuple("ArrayEdit", ["op", "index", "count", "values"])
+INSERT = "insert"
+DELETE = "delete"
+
+_DIGEST_SIZE = 16
+_DIGEST_MOD = 1 << (_DIGEST_SIZE * 8)
+
+
+def _blake2b(*parts):
+    h = hashlib.blake2b(digest_size=_DIGEST_SIZE)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+
+class SubtreeHasher:
+    """
+    Compute and memoize a structural digest for every subtree in a plist.
+
+    Digests are type-tagged so that values that compare equal in Python but
+    are different plist types (True vs 1, 1 vs 1.0) hash differently.
+    Containers are memoized by object identity; the memo holds a reference
+    to each object so its id can't be reused while cached. Use a hasher for
+    one comparison only, as a container mutated since would keep its old
+    digest.
+    """
+
+    def __init__(self):
+        self._memo: Dict[int, tuple] = {}
+
+    def digest(self, value) -> bytes:
+        memoized = self._memo.get(id(value))
+        if memoized is not None:
+            return memoized[1]
+
+        if isinstance(value, dict):
+            # plist dictionaries are unordered, so combine the per-item
+            # digests with an order-independent sum
+            total = 0
+            for k, v in value.items():
+                item = _blake2b(k.encode("utf-8"), b"\x00", self.digest(v))
+                total += int.from_bytes(item, "big")
+            digest = _blake2b(b"dict", (total % _DIGEST_MOD).to_bytes(
+                _DIGEST_SIZE, "big"), str(len(value)).encode())
+        elif isinstance(value, (list, tuple)):
+            digest = _blake2b(b"array", *[self.digest(v) for v in value])
+        elif isinstance(value, (bytes, bytearray)):
+            return data_digest(value)
+        elif isinstance(value, BlobRef):
+            # the digest of the bytes it stands for
+            return value.digest
+        else:
+            return self._leaf_digest(value)
+
+        self._memo[id(value)] = (value, digest)
+        return digest
+
+    def _leaf_digest(self, value) -> bytes:
+        if isinstance(value, bool):
+            tagged = b"bool" + (b"1" if value else b"0")
+        elif isinstance(value, int):
+            tagged = b"int" + str(value).encode()
+        elif isinstance(value, float):
+            tagged = b"float" + repr(value).encode()
+        elif isinstance(value, str):
+            tagged = b"string" + value.encode("utf-8")
+        elif isinstance(value, datetime.datetime):
+            tagged = b"date" + value.isoformat().encode()
+        else:
+            tagged = type(value).__name__.encode() + repr(value).encode()
+        return _blake2b(tagged)
+
+
+def values_equal(a, b) -> bool:
+    """
+    Type-strict deep equality of two plist values. True and 1, or 1 and
+    1.0, are equal in Python but are different plist values.
+    """
+    if a is b:
+        return True
+    if is_lazy(a) or is_lazy(b):
+        # lazily loaded binary plists are compared by their encoded bytes
+        # rather than decoded
+        return lazy_equal(a, b)
+    # == runs at C speed and rules out nearly every difference; only the
+    # types of values it found equal are left to check
+    return a == b and _types_match(a, b)
+
+
+def _types_match(a, b) -> bool:
+    # for values already known to be ==
+    t = type(a)
+    if t is not type(b):
+        # a BlobRef equals the bytes it stands for
+        return t is BlobRef or type(b) is BlobRef
+    if t is dict:
+        # a == b, so both have the same keys, but maybe in another order;
+        # pair the values up by key
+        values_a, values_b = a.values(), [b[k] for k in a]
+    elif t is list or t is tuple:
+        values_a, values_b = a, b
+    else:
+        return True
+    types_a = list(map(type, values_a))
+    if types_a != list(map(type, values_b)):
+        return _each_type_matches(values_a, values_b)
+    if dict not in types_a and list not in types_a:
+        return True
+    for v, w in zip(values_a, values_b):
+        if (type(v) is dict or type(v) is list) and v is not w and not _types_match(v, w):
+            return False
+    return True
+
+
+def _each_type_matches(values_a, values_b):
+    # the only legitimate mismatch is a BlobRef on one side
+    for v, w in zip(values_a, values_b):
+        if v is not w and not _types_match(v, w):
+            return False
+    return True
+
+
+def _myers_moves(a, b, max_edits):
+    # Myers' O((N+M)D) shortest edit script over sequences of digests.
+    # Returns (op, a_index, b_index) moves in reverse order, or None if the
+    # edit distance exceeds max_edits
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in range(min(n + m, max_edits) + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _myers_backtrack(trace, n, m)
+    return None
+
+
+def _myers_backtrack(trace, x, y):
+    moves = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+        if d > 0:
+            if x == prev_x:
+                moves.append((INSERT, x, y - 1))
+            else:
+                moves.append((DELETE, x - 1, y))
+        x, y = prev_x, prev_y
+    return moves
+
+
+def array_edit_script(before, after, digests_before, digests_after, max_edits):
+    """
+    Minimal insert/delete edit script turning `before` into `after`.
+
+    Elements are compared by their digests. Returns None when more than
+    `max_edits` single-element edits would be needed, in which case
+    rewriting the whole array is the cheaper option anyway.
+    """
+    # trim common prefix and suffix, which covers the usual append,
+    # truncate and single-element edits without running Myers at all
+    start = 0
+    end_a, end_b = len(digests_before), len(digests_after)
+    while start < end_a and start < end_b and digests_before[start] == digests_after[start]:
+        start += 1
+    while end_a > start and end_b > start and digests_before[end_a - 1] == digests_after[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+
+    moves = _myers_moves(digests_before[start:end_a],
+                         digests_after[start:end_b], max_edits)
+    if moves is None:
+        return None
+
+    edits = []
+    # position in the array being edited is the position in `after` of the
+    # next element to be emitted, since everything left of it is final
+    for op, _, b_index in reversed(moves):
+        if op == INSERT:
+            index = start + b_index
+            value = after[index]
+            last = edits[-1] if edits else None
+            if last is not None and last.op == INSERT and last.index + len(last.values) == index:
+                last.values.append(value)
+            else:
+                edits.append(ArrayEdit(INSERT, index, None, [value]))
+        else:
+            index = start + b_index
+            last = edits[-1] if edits else None
+            if last is not None and last.op == DELETE and last.index == index:
+                edits[-1] = last._replace(count=last.count + 1)
+            else:
+                edits.append(ArrayEdit(DELETE, index, 1, None))
+    return edits
+
+
+class PlistDiffer:
+    """
+    Recursive diff of two parsed plists.
+
+    Subtrees are compared with type-strict equality (see values_equal), and
+    only dictionaries whose contents differ are descended into. Digests are
+    only computed for array edit scripts, and only for the arrays involved.
+    """
+
+    # Beyond this many single-element edits an array is simply rewritten
+    MAX_ARRAY_EDITS = 256
+
+    def __init__(self, max_array_edits=MAX_ARRAY_EDITS):
+        self.max_array_edits = max_array_edits
+
+    def same(self, a, b) -> bool:
+        return values_equal(a, b)
+
+    def diff(self, before, after) -> List[PathChange]:
+        changes = []
+        self._diff(before, after, (), changes)
+        return changes
+
+    def _diff(self, before, after, path, changes):
+        if values_equal(before, after):
+            return
+        if not (isinstance(before, Mapping) and isinstance(after, Mapping)):
+            changes.append(PathChange(MODIFIED, path, before, after))
+            return
+        for key, value in after.items():
+            subpath = path + (key,)
+            if key not in before:
+                changes.append(PathChange(ADDED, subpath, None, value))
+            else:
+                self._diff(before[key], value, subpath, changes)
+        for key, value in before.items():
+            if key not in after:
+                changes.append(PathChange(REMOVED, path + (key,), value, None))
+
+    def array_edits(self, before: list, after: list):
+        if values_equal(before, after):
+            return []
+        # digests memoized for this script only, so nothing outlives it
+        digest = SubtreeHasher().digest
+        return array_edit_script(before, after,
+                                 [digest(v) for v in before],
+                                 [digest(v) for v in after],
+                                 self.max_array_edits)
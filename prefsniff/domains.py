@@ -0,0 +1,162 @@
+"""
+Index of plist files by the defaults(1) domain each one backs.
+
+Working out a file's domain takes a stat, an owner lookup in the password
+database, a realpath and several prefix checks (see PrefSniff.getdomain).
+DomainIndex does that once per file, caches owner names by uid and real
+directory paths by directory, and is then kept current from filesystem
+events, so diffing a file that changed is a dictionary lookup.
+
+It also answers the reverse question: which file backs a given domain.
+"""
+import os
+import stat
+import threading
+from collections import namedtuple
+from pwd import getpwuid
+from typing import Dict, List
+
+from .prefsniff import PrefSniff
+
+DomainEntry = namedtuple(
+    "DomainEntry", ["plistpath", "domain", "byhost", "owner", "real_path"])
+
+
+class DomainIndex:
+    """
+    plistpath -> DomainEntry for every file added, plus the reverse mapping
+    from (domain, byhost) to the files backing it. Safe to use from the
+    observer, dispatcher and baseline threads at once.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, DomainEntry] = {}
+        self._by_domain: Dict[tuple, List[str]] = {}
+        self._owners = {}
+        self._real_dirs = {}
+        self._lock = threading.Lock()
+        self.resolved = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, plistpath):
+        return os.path.abspath(plistpath) in self._entries
+
+    def owner(self, uid):
+        name = self._owners.get(uid)
+        if name is None:
+            try:
+                name = getpwuid(uid).pw_name
+            except KeyError:
+                # no passwd entry, e.g. a file from another machine
+                name = str(uid)
+            self._owners[uid] = name
+        return name
+
+    def _real_path(self, plistpath, st):
+        if stat.S_ISLNK(st.st_mode):
+            return os.path.realpath(plistpath)
+        dirname, base = os.path.split(plistpath)
+        real_dir = self._real_dirs.get(dirname)
+        if real_dir is None:
+            real_dir = self._real_dirs[dirname] = os.path.realpath(dirname)
+        return os.path.join(real_dir, base)
+
+    def resolve(self, plistpath) -> DomainEntry:
+        """
+        Work out a file's DomainEntry without adding it to the index.
+        Raises OSError if the file can't be stat'ed.
+        """
+        plistpath = os.path.abspath(plistpath)
+        st = os.lstat(plistpath)
+        real_path = self._real_path(plistpath, st)
+        if stat.S_ISLNK(st.st_mode):
+            st = os.stat(plistpath)
+        owner = self.owner(st.st_uid)
+        byhost = PrefSniff.is_byhost(plistpath)
+        domain = PrefSniff.getdomain(plistpath, byhost=byhost,
+                                     root_owned=(owner == 'root'), real_path=real_path)
+        self.resolved += 1
+        return DomainEntry(plistpath, domain, byhost, owner, real_path)
+
+    def add(self, plistpath) -> DomainEntry:
+        """
+        Resolve a file and (re-)index it. Returns None, and forgets the file,
+        if it no longer exists.
+        """
+        try:
+            entry = self.resolve(plistpath)
+        except OSError:
+            self.discard(plistpath)
+            return None
+        with self._lock:
+            self._remove(entry.plistpath)
+            self._entries[entry.plistpath] = entry
+            self._by_domain.setdefault((entry.domain, entry.byhost), []).append(entry.plistpath)
+        return entry
+
+    def discard(self, plistpath):
+        with self._lock:
+            self._remove(os.path.abspath(plistpath))
+
+    def _remove(self, plistpath):
+        # caller holds self._lock
+        entry = self._entries.pop(plistpath, None)
+        if entry is None:
+            return
+        paths = self._by_domain[(entry.domain, entry.byhost)]
+        paths.remove(plistpath)
+        if not paths:
+            del self._by_domain[(entry.domain, entry.byhost)]
+
+    def get(self, plistpath) -> DomainEntry:
+        """
+        The indexed entry for a file, resolving and adding it if it isn't
+        indexed yet. None if it doesn't exist.
+        """
+        entry = self._entries.get(os.path.abspath(plistpath))
+        if entry is None:
+            entry = self.add(plistpath)
+        return entry
+
+    def scan(self, prefsdir, recursive=True, path_filter=None) -> int:
+        """
+        Index every file under `prefsdir` that path_filter accepts (by
+        default, every .plist file). Returns the number of files indexed.
+        """
+        if path_filter is None:
+            # watch imports this module
+            from .watch import is_plist
+            path_filter = is_plist
+        indexed = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.abspath(os.path.expanduser(prefsdir))):
+            for filename in filenames:
+                plistpath = os.path.join(dirpath, filename)
+                if path_filter(plistpath) and self.add(plistpath) is not None:
+                    indexed += 1
+            if not recursive:
+                break
+        return indexed
+
+    def entries_for(self, domain, byhost=None) -> List[DomainEntry]:
+        """
+        Indexed files backing `domain`, in path order. With byhost=None,
+        both the ordinary and the ByHost (-currentHost) files.
+        """
+        with self._lock:
+            if byhost is None:
+                keys = [(domain, False), (domain, True)]
+            else:
+                keys = [(domain, byhost)]
+            paths = [path for key in keys for path in self._by_domain.get(key, ())]
+            return [self._entries[path] for path in sorted(paths)]
+
+    def path_for(self, domain, byhost=False):
+        """
+        The file backing `domain`, or None if none is indexed.
+        """
+        entries = self.entries_for(domain, byhost=byhost)
+        if not entries:
+            return None
+        return entries[0].plistpath
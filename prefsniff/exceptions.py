@@ -8,3 +8,15 @@ class PSChangeTypeException(PSniffException):
 
 class PSChangeTypeNotImplementedException(PSChangeTypeException):
     pass
+
+
+class PlistPatchException(PSniffException):
+    pass
+
+
+class PrefsDaemonException(PSniffException):
+    pass
+
+
+class SnapshotStoreException(PSniffException):
+    pass
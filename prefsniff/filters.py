@@ -0,0 +1,120 @@
+import fnmatch
+import os
+import re
+from typing import Iterable
+
+GLOB_PREFIX = "glob:"
+REGEX_PREFIX = "re:"
+DOMAIN_PREFIX = "domain:"
+
+# defaults(1) names that don't match their file name
+_DOMAIN_FILE_NAMES = {"NSGlobalDomain": ".GlobalPreferences"}
+
+# the directory ByHost (-currentHost) plists live in
+BYHOST_DIR = "ByHost"
+
+# ByHost files carry a host UUID, or on older systems a MAC address,
+# between domain and extension
+_BYHOST_SUFFIX = r"(?:\.(?:[0-9A-Fa-f]{8}(?:-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}|[0-9A-Fa-f]{12}))?"
+
+
+def is_byhost_path(path) -> bool:
+    return os.path.basename(os.path.dirname(path)) == BYHOST_DIR
+
+
+def pattern_regex(pattern: str, byhost=False) -> str:
+    """
+    Translate one --include/--exclude pattern into a regex over a plist's
+    basename.
+
+    "re:<regex>" is searched for in the basename, "glob:<glob>" must match
+    the whole basename, and "domain:<domain>" matches that domain's plist.
+    With byhost=True, for files in a ByHost directory, a domain also
+    matches its plist with a host UUID or MAC address before ".plist".
+    Without a prefix, a pattern containing glob characters is a glob, and
+    anything else is a domain.
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        regex = pattern[len(REGEX_PREFIX):]
+        re.compile(regex)
+        return "(?:%s)" % regex
+    if pattern.startswith(GLOB_PREFIX):
+        return "^" + fnmatch.translate(pattern[len(GLOB_PREFIX):])
+    if pattern.startswith(DOMAIN_PREFIX):
+        domain = pattern[len(DOMAIN_PREFIX):]
+    elif any(c in pattern for c in "*?["):
+        return "^" + fnmatch.translate(pattern)
+    else:
+        domain = pattern
+    domain = _DOMAIN_FILE_NAMES.get(domain, domain)
+    return r"^%s%s\.plist\Z" % (re.escape(domain), _BYHOST_SUFFIX if byhost else "")
+
+
+def _compile(patterns, byhost=False):
+    # Domain and glob patterns share one alternation. re: patterns are
+    # compiled on their own, so inline flags and backreferences in them
+    # mean what they would alone
+    regexes = []
+    combined = []
+    for pattern in patterns:
+        if pattern.startswith(REGEX_PREFIX):
+            regexes.append(re.compile(pattern[len(REGEX_PREFIX):]))
+        else:
+            combined.append(pattern_regex(pattern, byhost=byhost))
+    if combined:
+        regexes.insert(0, re.compile("|".join(combined)))
+    return regexes
+
+
+class PrefsPathFilter:
+    """
+    Include/exclude patterns matched against a plist's basename. Domain and
+    glob patterns are compiled into a single regex each; re: patterns are
+    checked one by one. Files in a ByHost directory get their own set, in
+    which domains allow for the host suffix.
+
+    A path passes if it matches at least one include pattern (or there are
+    none) and no exclude pattern. Counts of accepted and rejected paths are
+    kept so noisy domains can be spotted.
+    """
+
+    def __init__(self, includes: Iterable[str] = (), excludes: Iterable[str] = ()):
+        self.includes = list(includes)
+        self.excludes = list(excludes)
+        self._include = _compile(self.includes)
+        self._exclude = _compile(self.excludes)
+        self._byhost_include = _compile(self.includes, byhost=True)
+        self._byhost_exclude = _compile(self.excludes, byhost=True)
+        self.accepted = 0
+        self.rejected = 0
+
+    def __bool__(self):
+        return bool(self._include or self._exclude)
+
+    @property
+    def counters(self):
+        return {"accepted": self.accepted,
+                "rejected": self.rejected}
+
+    def matches(self, basename, byhost=False) -> bool:
+        if byhost:
+            include, exclude = self._byhost_include, self._byhost_exclude
+        else:
+            include, exclude = self._include, self._exclude
+        if include and not any(regex.search(basename) for regex in include):
+            return False
+        if any(regex.search(basename) for regex in exclude):
+            return False
+        return True
+
+    def matches_path(self, path) -> bool:
+        return self.matches(os.path.basename(path), byhost=is_byhost_path(path))
+
+    def __call__(self, path) -> bool:
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if self.matches_path(path):
+            self.accepted += 1
+            return True
+        self.rejected += 1
+        return False
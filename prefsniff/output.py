@@ -0,0 +1,165 @@
+"""
+Writers for change sets produced by PrefSniff.
+
+NDJSON record schema (one JSON object per line, one line per change):
+
+    {
+      "batch":        int, increments once per change set written
+      "index":        int, position of this change within its batch
+      "plist":        str, path of the plist file that changed
+      "domain":       str, defaults(1) domain
+      "byhost":       bool, true for -currentHost (ByHost) domains
+      "change_type":  str, e.g. "int", "dict-add", "array-add", "deleted"
+      "action":       str, defaults(1) verb: "write" or "delete"
+      "type":         str or null, defaults(1) type flag without the dash
+      "key_path":     [str], top-level key, plus subkey for "dict-add"
+      "value":        JSON value, or null for "deleted"
+      "argv":         [str], unquoted argument vector
+      "blob":         str, only for <data> kept in a BlobStore: the blob
+                      file, whose bytes in hex the "$blob" argv entry stands for
+      "detected_at":  float, UNIX time the change set was computed
+      "emitted_at":   float, UNIX time the record was written
+    }
+
+Plist types without a JSON equivalent are encoded as single-key objects:
+<data> as {"$data": "<base64>"} and <date> as {"$date": "<ISO 8601>"}.
+<data> kept in a BlobStore is {"$blob": "<hex digest>", "size": int,
+"path": str} rather than inlined.
+Changes that couldn't be turned into a command have "change_type": null and
+an "error" string instead of "action", "type", "value" and "argv".
+"""
+import base64
+import datetime
+import json
+import sys
+import time
+
+from . import stats
+from .blobs import BlobRef
+from .changetypes import PSChangeTypeBase
+
+STARS = "*****************************"
+
+DIFF_SCOPE_FILE = "file"
+DIFF_SCOPE_CHANGES = "changes"
+
+OUTPUT_TEXT = "text"
+OUTPUT_NDJSON = "ndjson"
+OUTPUT_SCRIPT = "script"
+
+
+def _json_default(value):
+    if isinstance(value, BlobRef):
+        return {"$blob": value.digest.hex(), "size": value.size, "path": value.path}
+    if isinstance(value, (bytes, bytearray)):
+        return {"$data": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, datetime.datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError("%s is not JSON serializable" % type(value).__name__)
+
+
+class ChangeSetWriter:
+    """
+    Write change sets to a stream, one buffered write and flush per set.
+    """
+
+    def __init__(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+        self.stream = stream
+
+    def format_changeset(self, diffs):
+        raise NotImplementedError()
+
+    def write_changeset(self, diffs):
+        with stats.stage_timer(stats.STAGE_OUTPUT):
+            self.stream.write("".join(self.format_changeset(diffs)))
+            self.stream.flush()
+
+
+class TextChangeSetWriter(ChangeSetWriter):
+
+    def __init__(self, stream=None, show_diffs=False, diff_scope=DIFF_SCOPE_FILE):
+        super().__init__(stream=stream)
+        self.show_diffs = show_diffs
+        self.diff_scope = diff_scope
+
+    def format_changeset(self, diffs):
+        lines = [STARS, "\n\n"]
+        for ch in diffs.changes:
+            if isinstance(ch, PSChangeTypeBase):
+                lines.append(ch.shell_command())
+            else:
+                lines.append("# %s" % ch)
+            lines.append("\n\n")
+        if self.show_diffs:
+            with stats.stage_timer(stats.STAGE_UNIFIED_DIFF):
+                if self.diff_scope == DIFF_SCOPE_CHANGES:
+                    difflines = diffs.scoped_diff()
+                else:
+                    difflines = diffs.diff
+                lines.append("\n".join(difflines))
+            lines.append("\n")
+        lines.extend([STARS, "\n"])
+        return lines
+
+
+class ScriptChangeSetWriter(ChangeSetWriter):
+    """
+    Bare defaults commands, one per line, for a shell script.
+    """
+
+    def format_changeset(self, diffs):
+        lines = ["# %s\n" % diffs.label]
+        for ch in diffs.changes:
+            if isinstance(ch, PSChangeTypeBase):
+                lines.append(ch.shell_command())
+            else:
+                lines.append("# %s" % ch)
+            lines.append("\n")
+        return lines
+
+
+class NdjsonChangeSetWriter(ChangeSetWriter):
+
+    def __init__(self, stream=None):
+        super().__init__(stream=stream)
+        self.batch = 0
+
+    def change_record(self, diffs, index, ch):
+        record = {"batch": self.batch,
+                  "index": index,
+                  "plist": diffs.plistpath,
+                  "domain": diffs.pref_domain,
+                  "byhost": diffs.byhost}
+        if isinstance(ch, PSChangeTypeBase):
+            key_path = [ch.key]
+            subkey = getattr(ch, "subkey", None)
+            if subkey is not None:
+                key_path.append(subkey)
+            record.update({"change_type": ch.change_type,
+                           "action": ch.action,
+                           "type": ch.type,
+                           "key_path": key_path,
+                           "value": ch.value})
+            if isinstance(ch.value, BlobRef):
+                # rather than inlining the blob as hex
+                record["argv"] = ch.argv(quote=False, load_blob=False)
+                record["blob"] = ch.value.path
+            else:
+                record["argv"] = ch.argv(quote=False)
+        else:
+            record.update({"change_type": None, "error": str(ch)})
+        record["detected_at"] = diffs.timestamp
+        record["emitted_at"] = time.time()
+        return record
+
+    def format_changeset(self, diffs):
+        lines = []
+        for index, ch in enumerate(diffs.changes):
+            record = self.change_record(diffs, index, ch)
+            lines.append(json.dumps(record, separators=(",", ":"),
+                                    default=_json_default))
+            lines.append("\n")
+        self.batch += 1
+        return lines
@@ -0,0 +1,376 @@
+"""
+Plist patches: path-addressed edits, applied to plist files in-process.
+
+A patch is itself a plist (binary by default), so values of every plist
+type round-trip exactly, including <data> and <date>, which have no
+defaults(1) equivalent:
+
+    {"format": "prefsniff-patch",
+     "version": 1,
+     "files": [{"plist": "/Users/zach/Library/Preferences/com.apple.dock.plist",
+                "domain": "com.apple.dock",
+                "byhost": False,
+                "ops": [["set", ["orientation"], "left"],
+                        ["delete", ["autohide"]],
+                        ["dict-merge", ["persistent-others"], {"subkey": value, ...}],
+                        ["array-edit", ["recent-apps"], [["delete", 0, 1],
+                                                         ["insert", 3, [value, ...]],
+                                                         ["append", [value, ...]]]]]}]}
+
+A path is the list of dictionary keys and array indices leading to the
+value from the top-level <dict>. Array edits are applied in order, each to
+the result of the one before, as with PlistDiffer.array_edits().
+dict-merge and array-edit create the dictionary or array if it's missing,
+as -dict-add and -array-add do; deleting a missing key does nothing.
+
+Patches are generated from a change set's changes (see changeset_ops()),
+using the array edit scripts PrefSniff computed where it has them.
+PlistPatchApplier loads each target plist once, applies all of its
+operations, and atomically replaces it in its original format.
+"""
+import argparse
+import copy
+import os
+import plistlib
+import stat
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from typing import Iterable, List
+
+from .blobs import load_blobs
+from .bplist import BPLIST_MAGIC, materialize
+from .changetypes import (
+    PSChangeTypeArray,
+    PSChangeTypeArrayAdd,
+    PSChangeTypeBase,
+    PSChangeTypeDictAdd,
+    PSChangeTypeDictMerge,
+    PSChangeTypeKeyDeleted
+)
+from .diff import INSERT
+from .exceptions import PlistPatchException
+
+PATCH_COMMAND = "patch"
+
+PATCH_FORMAT = "prefsniff-patch"
+PATCH_VERSION = 1
+
+OP_SET = "set"
+OP_DELETE = "delete"
+OP_DICT_MERGE = "dict-merge"
+OP_ARRAY_EDIT = "array-edit"
+
+EDIT_INSERT = "insert"
+EDIT_DELETE = "delete"
+EDIT_APPEND = "append"
+
+# value is None for OP_DELETE. For OP_ARRAY_EDIT it's a list of
+# [EDIT_INSERT, index, values], [EDIT_DELETE, index, count] or
+# [EDIT_APPEND, values]
+PatchOp = namedtuple("PatchOp", ["op", "path", "value"])
+
+FilePatch = namedtuple("FilePatch", ["plist", "domain", "byhost", "ops"])
+
+# Outcome of patching one file. `error` is None on success; on failure the
+# file is left as it was
+PatchResult = namedtuple("PatchResult", ["plist", "target", "ops", "error", "elapsed"])
+
+
+def _array_edit_ops(edits):
+    ops = []
+    for edit in edits:
+        if edit.op == INSERT:
+            ops.append([EDIT_INSERT, edit.index, list(edit.values)])
+        else:
+            ops.append([EDIT_DELETE, edit.index, edit.count])
+    return ops
+
+
+def changeset_ops(diffs) -> List[PatchOp]:
+    """
+    Patch operations equivalent to a change set's changes. Accepts a
+    PrefSniff, or anything else with `changes`, such as a compacted
+    session's SessionChangeSet.
+    """
+    array_edits = getattr(diffs, "array_edits", {})
+    ops = []
+    covered = set()
+    for ch in diffs.changes:
+        if not isinstance(ch, PSChangeTypeBase):
+            continue
+        path = [ch.key]
+        covered.add(ch.key)
+        if isinstance(ch, PSChangeTypeKeyDeleted):
+            ops.append(PatchOp(OP_DELETE, path, None))
+        elif isinstance(ch, (PSChangeTypeDictAdd, PSChangeTypeDictMerge)):
+            value = {ch.subkey: ch.value} if isinstance(ch, PSChangeTypeDictAdd) else dict(ch.value)
+            last = ops[-1] if ops else None
+            if last is not None and last.op == OP_DICT_MERGE and last.path == path:
+                # consecutive -dict-adds to one dictionary
+                last.value.update(value)
+            else:
+                ops.append(PatchOp(OP_DICT_MERGE, path, value))
+        elif isinstance(ch, PSChangeTypeArray) and ch.key in array_edits:
+            # the edit script, rather than the whole array defaults(1) needs
+            ops.append(PatchOp(OP_ARRAY_EDIT, path, _array_edit_ops(array_edits[ch.key])))
+        elif isinstance(ch, PSChangeTypeArrayAdd):
+            ops.append(PatchOp(OP_ARRAY_EDIT, path, [[EDIT_APPEND, list(ch.value)]]))
+        else:
+            ops.append(PatchOp(OP_SET, path, ch.value))
+
+    # keys whose new values couldn't be turned into a change object
+    # (<data>, <date>) are still in the new plist, and patches can carry them
+    pref2 = getattr(diffs, "pref2", None)
+    if pref2 is not None:
+        for key in list(getattr(diffs, "added", {})) + list(getattr(diffs, "modified", {})):
+            if key not in covered:
+                ops.append(PatchOp(OP_SET, [key], materialize(pref2[key])))
+    return ops
+
+
+class PlistPatch:
+    """
+    Patch operations for any number of plist files.
+    """
+
+    def __init__(self, files: Iterable[FilePatch] = ()):
+        self.files = list(files)
+
+    @classmethod
+    def from_changesets(cls, changesets: Iterable) -> "PlistPatch":
+        patch = cls()
+        for diffs in changesets:
+            patch.add_changeset(diffs)
+        return patch
+
+    def add_changeset(self, diffs):
+        ops = changeset_ops(diffs)
+        if ops:
+            self.files.append(FilePatch(diffs.plistpath, diffs.pref_domain,
+                                        diffs.byhost, ops))
+
+    def __len__(self):
+        return sum(len(file_patch.ops) for file_patch in self.files)
+
+    def to_plist(self):
+        files = []
+        for file_patch in self.files:
+            record = {"domain": file_patch.domain,
+                      "byhost": file_patch.byhost,
+                      "ops": [[op.op, list(op.path)] + ([] if op.value is None else [load_blobs(op.value)])
+                              for op in file_patch.ops]}
+            # plists have no null; in-memory change sets have no path
+            if file_patch.plist is not None:
+                record["plist"] = file_patch.plist
+            files.append(record)
+        return {"format": PATCH_FORMAT, "version": PATCH_VERSION, "files": files}
+
+    @classmethod
+    def from_plist(cls, pref) -> "PlistPatch":
+        if pref.get("format") != PATCH_FORMAT:
+            raise PlistPatchException("Not a prefsniff patch")
+        if pref.get("version") != PATCH_VERSION:
+            raise PlistPatchException(
+                "Unsupported patch version: %s" % pref.get("version"))
+        files = []
+        for record in pref["files"]:
+            ops = [PatchOp(op[0], op[1], op[2] if len(op) > 2 else None)
+                   for op in record["ops"]]
+            files.append(FilePatch(record.get("plist"), record["domain"],
+                                   record["byhost"], ops))
+        return cls(files)
+
+    def dumps(self, fmt=plistlib.FMT_BINARY) -> bytes:
+        return plistlib.dumps(self.to_plist(), fmt=fmt, sort_keys=False)
+
+    @classmethod
+    def loads(cls, data: bytes) -> "PlistPatch":
+        return cls.from_plist(plistlib.loads(data))
+
+    def save(self, path, fmt=plistlib.FMT_BINARY):
+        write_atomic(path, self.dumps(fmt=fmt))
+
+    @classmethod
+    def load(cls, path) -> "PlistPatch":
+        with open(path, "rb") as f:
+            return cls.loads(f.read())
+
+
+def write_atomic(path, data: bytes, mode=None):
+    """
+    Replace `path` with `data` by writing a temporary file beside it and
+    renaming it into place, so readers never see a partial write.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".prefsniff-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmppath, mode)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def _resolve(pref, path):
+    value = pref
+    for component in path:
+        try:
+            value = value[component]
+        except (KeyError, IndexError, TypeError):
+            raise PlistPatchException(
+                "No such path: %s" % "/".join(str(c) for c in path)) from None
+    return value
+
+
+def _container(pref, path, factory):
+    # the dictionary or array at `path`, created if it's missing
+    parent = _resolve(pref, path[:-1])
+    key = path[-1]
+    if isinstance(parent, dict) and key not in parent:
+        parent[key] = factory()
+    value = _resolve(parent, [key])
+    if not isinstance(value, factory):
+        raise PlistPatchException(
+            "Not a %s: %s" % (factory.__name__, "/".join(str(c) for c in path)))
+    return value
+
+
+def _apply_array_edits(array, edits):
+    for edit in edits:
+        if edit[0] == EDIT_APPEND:
+            array.extend(edit[1])
+            continue
+        index = edit[1]
+        if not 0 <= index <= len(array):
+            raise PlistPatchException("Array edit index out of range: %d" % index)
+        if edit[0] == EDIT_INSERT:
+            array[index:index] = edit[2]
+        elif edit[0] == EDIT_DELETE:
+            del array[index:index + edit[2]]
+        else:
+            raise PlistPatchException("Unknown array edit: %s" % edit[0])
+
+
+def apply_op(pref, op: PatchOp):
+    """
+    Apply one operation to a parsed plist, in place.
+    """
+    if not op.path:
+        raise PlistPatchException("Empty path")
+    # ops made in-process may refer to <data> held in a BlobStore. The
+    # value is copied so the plist never shares containers with the patch,
+    # e.g. when one op is applied to several plists
+    op = op._replace(value=copy.deepcopy(load_blobs(op.value)))
+    if op.op == OP_SET:
+        parent = _resolve(pref, op.path[:-1])
+        try:
+            parent[op.path[-1]] = op.value
+        except (IndexError, TypeError):
+            raise PlistPatchException(
+                "Can't set %s" % "/".join(str(c) for c in op.path)) from None
+    elif op.op == OP_DELETE:
+        parent = _resolve(pref, op.path[:-1])
+        if isinstance(parent, dict):
+            parent.pop(op.path[-1], None)
+        elif isinstance(parent, list) and 0 <= op.path[-1] < len(parent):
+            del parent[op.path[-1]]
+    elif op.op == OP_DICT_MERGE:
+        _container(pref, op.path, dict).update(op.value)
+    elif op.op == OP_ARRAY_EDIT:
+        _apply_array_edits(_container(pref, op.path, list), op.value)
+    else:
+        raise PlistPatchException("Unknown patch operation: %s" % op.op)
+
+
+class PlistPatchApplier:
+    """
+    Apply plist patches directly to files, without defaults(1).
+
+    Operations are grouped by target file. Each file is parsed once, has
+    all of its operations applied in order, and is then atomically
+    replaced, in the format it was in (binary or XML) and with its
+    permissions kept. A file that doesn't exist yet is created as a binary
+    plist. If any operation on a file fails, that file is left untouched
+    and the rest are still patched.
+
+    With `root`, plist paths in the patch are taken as relative to it,
+    e.g. to patch a mirrored preferences tree.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def target_path(self, plistpath):
+        if plistpath is None:
+            return None
+        if self.root is None:
+            return plistpath
+        return os.path.join(self.root, os.path.expanduser(plistpath).lstrip(os.sep))
+
+    def apply(self, patch: PlistPatch) -> List[PatchResult]:
+        targets = OrderedDict()
+        for file_patch in patch.files:
+            target = self.target_path(file_patch.plist)
+            entry = targets.get(target)
+            if entry is None:
+                targets[target] = (file_patch.plist, list(file_patch.ops))
+            else:
+                entry[1].extend(file_patch.ops)
+        return [self.apply_file(target, ops, plistpath)
+                for target, (plistpath, ops) in targets.items()]
+
+    def apply_file(self, target, ops, plistpath=None) -> PatchResult:
+        t0 = time.perf_counter()
+        try:
+            if target is None:
+                raise PlistPatchException("No plist path to patch")
+            try:
+                with open(target, "rb") as f:
+                    data = f.read()
+                mode = stat.S_IMODE(os.stat(target).st_mode)
+            except FileNotFoundError:
+                data, mode = None, None
+            if data is None:
+                pref, fmt = {}, plistlib.FMT_BINARY
+            else:
+                fmt = plistlib.FMT_BINARY if data.startswith(BPLIST_MAGIC) else plistlib.FMT_XML
+                pref = plistlib.loads(data)
+            for op in ops:
+                apply_op(pref, op)
+            # keep the existing key order, so unchanged files diff cleanly
+            write_atomic(target, plistlib.dumps(pref, fmt=fmt, sort_keys=False), mode=mode)
+        except Exception as e:
+            return PatchResult(plistpath, target, len(ops),
+                               "%s: %s" % (type(e).__name__, e), time.perf_counter() - t0)
+        return PatchResult(plistpath, target, len(ops), None, time.perf_counter() - t0)
+
+
+def apply_patch(patch: PlistPatch, root=None) -> List[PatchResult]:
+    return PlistPatchApplier(root=root).apply(patch)
+
+
+def parse_patch_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="prefsniff %s" % PATCH_COMMAND,
+        description="Apply a plist patch directly to the plist files it names.")
+    parser.add_argument("patchfile", help="Patch file written by --patch or --session-format patch.")
+    parser.add_argument("--root", help="Apply to the plists under this directory, as a mirror of /.")
+    return parser.parse_args(argv)
+
+
+def patch_main(argv):
+    args = parse_patch_args(argv)
+    patch = PlistPatch.load(args.patchfile)
+    failed = 0
+    for result in PlistPatchApplier(root=args.root).apply(patch):
+        if result.error is None:
+            print("Patched %s: %d operations" % (result.target, result.ops))
+        else:
+            failed += 1
+            print("Error: %s: %s" % (result.target, result.error))
+    if failed:
+        exit(1)
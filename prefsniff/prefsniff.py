@@ -6,16 +6,28 @@ import difflib
 import os
 import plistlib
 import re
+import signal
 import subprocess
 import sys
+import time
 from pwd import getpwuid
 from queue import Empty as QueueEmpty
-from queue import Queue
 from typing import List
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
+from . import stats
+from .apply import PrefsApplyEngine
+from .baseline import BASELINE_LAZY, BASELINE_PARALLEL
+from .blobs import (
+    DEFAULT_BLOB_DIR,
+    DEFAULT_BLOB_THRESHOLD,
+    BlobRef,
+    BlobStore,
+    blob_placeholders
+)
+from .bplist import is_lazy, load_lazy, materialize
 from .changetypes import (
     PSChangeTypeArray,
     PSChangeTypeArrayAdd,
@@ -25,22 +37,34 @@ from .changetypes import (
     PSChangeTypeDate,
     PSChangeTypeDict,
     PSChangeTypeDictAdd,
-    PSChangeTypeFactory,
     PSChangeTypeFloat,
     PSChangeTypeInt,
     PSChangeTypeKeyDeleted,
     PSChangeTypeString
 )
+from .diff import ADDED, DELETE, INSERT, REMOVED, PlistDiffer
 from .exceptions import PSChangeTypeNotImplementedException
+from .filters import PrefsPathFilter
+from .output import (
+    DIFF_SCOPE_CHANGES,
+    DIFF_SCOPE_FILE,
+    OUTPUT_NDJSON,
+    OUTPUT_SCRIPT,
+    OUTPUT_TEXT,
+    NdjsonChangeSetWriter,
+    TextChangeSetWriter
+)
+from .patch import PATCH_COMMAND, PlistPatch, patch_main
+from .scheduler import DebounceScheduler
+from .session import SESSION_FORMATS, SessionRecorder
 from .version import PrefsniffAbout
 
-STARS = "*****************************"
-
 
 def parse_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "watchpath", help="Directory or plist file to watch for changes.")
+        "watchpath", nargs="+",
+        help="Directory, or one or more plist files or globs, to watch for changes.")
     parser.add_argument(
         "--version",
         help="Show version and exit.",
@@ -48,10 +72,56 @@ def parse_args(argv):
         version=str(PrefsniffAbout()))
     parser.add_argument(
         "--show-diffs", help="Show diff of changed plist files.", action="store_true")
+    parser.add_argument(
+        "--diff-scope", choices=[DIFF_SCOPE_FILE, DIFF_SCOPE_CHANGES], default=DIFF_SCOPE_FILE,
+        help="With --show-diffs, diff the whole file, or only the changed key paths. Default: %(default)s")
+    parser.add_argument(
+        "--output", choices=[OUTPUT_TEXT, OUTPUT_NDJSON], default=OUTPUT_TEXT,
+        help="Print changes as defaults commands, or as one JSON record per change. Default: %(default)s")
+    parser.add_argument(
+        "--quiet-period", type=float, default=DebounceScheduler.DEFAULT_QUIET_PERIOD,
+        help="Seconds a file must go without events before it is diffed. Default: %(default)s")
+    parser.add_argument(
+        "--max-delay", type=float, default=DebounceScheduler.DEFAULT_MAX_DELAY,
+        help="Maximum seconds to hold back a file that keeps changing. Default: %(default)s")
+    parser.add_argument(
+        "--baseline", choices=[BASELINE_LAZY, BASELINE_PARALLEL], default=BASELINE_LAZY,
+        help="Directory mode: read existing plists now and parse them when they change, or parse them all up front in parallel. Default: %(default)s")
+    parser.add_argument(
+        "--include", action="append", default=[], metavar="PATTERN",
+        help="Directory mode: only report plists matching PATTERN, a domain name or glob on the file name, or re:REGEX. May be repeated.")
+    parser.add_argument(
+        "--exclude", action="append", default=[], metavar="PATTERN",
+        help="Directory mode: ignore plists matching PATTERN, in the same forms as --include. May be repeated.")
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="Print per-stage timings and counters to stderr on exit.")
+    parser.add_argument(
+        "--stats-interval", type=float, default=0, metavar="SECONDS",
+        help="Also print them every SECONDS while running. Implies --stats.")
+    parser.add_argument(
+        "--session", metavar="FILE",
+        help="Record every change, and on exit (or on SIGUSR1) save their net effect per key to FILE.")
+    parser.add_argument(
+        "--session-format", choices=SESSION_FORMATS, default=OUTPUT_SCRIPT,
+        help="With --session, save a shell script of defaults commands, or NDJSON records. Default: %(default)s")
+    parser.add_argument(
+        "--blob-threshold", type=int, default=DEFAULT_BLOB_THRESHOLD, metavar="BYTES",
+        help="Keep <data> values larger than BYTES on disk rather than in memory while watching; 0 to keep everything in memory. Default: %(default)s")
+    parser.add_argument(
+        "--blob-dir", default=DEFAULT_BLOB_DIR, metavar="DIR",
+        help="Where --blob-threshold keeps large <data> values, by digest. Default: %(default)s")
+    parser.add_argument(
+        "--prune-blobs", type=float, metavar="DAYS",
+        help="On startup, delete blobs in --blob-dir not stored or seen again in DAYS days.")
     parser.add_argument("--plist2",
                         help="Optionally compare WATCHPATH against this plist rather than waiting for changes to the original."
                         )
     args = parser.parse_args(argv)
+    try:
+        args.event_filter = PrefsPathFilter(args.include, args.exclude)
+    except re.error as e:
+        parser.error("invalid --include/--exclude pattern: %s" % e)
     return args
 
 
@@ -66,6 +136,7 @@ class PrefSniff:
                     dict: PSChangeTypeDict,
                     list: PSChangeTypeArray,
                     bytes: PSChangeTypeData,
+                    BlobRef: PSChangeTypeData,
                     datetime.datetime: PSChangeTypeDate}
 
     @classmethod
@@ -107,13 +178,17 @@ class PrefSniff:
         return standard
 
     @classmethod
-    def getdomain(cls, plistpath, byhost=False):
+    def getdomain(cls, plistpath, byhost=False, root_owned=None, real_path=None):
         domain = None
 
         globaldomain = cls.is_nsglobaldomain(plistpath)
-        root_owned = cls.is_root_owned(plistpath)
+        # callers resolving many files (see DomainIndex) look these up
+        # themselves, with caching
+        if root_owned is None:
+            root_owned = cls.is_root_owned(plistpath)
         standard_path = cls.standard_path(plistpath)
-        real_path = os.path.realpath(plistpath)
+        if real_path is None:
+            real_path = os.path.realpath(plistpath)
         # if root owned (like in /Library/Preferences), need to specify fully qualified
         # literal filename rather than a namespace
         if root_owned:
@@ -137,45 +212,142 @@ class PrefSniff:
 
         return domain
 
-    def __init__(self, plistpath, plistpath2=None):
-        self.plist_dir = os.path.dirname(plistpath)
-        self.plist_base = os.path.basename(plistpath)
-        self.byhost = self.is_byhost(plistpath)
-        self.pref_domain = self.getdomain(plistpath, byhost=self.byhost)
+    def __init__(self, plistpath, plistpath2=None, pref1=None, pref2=None,
+                 snapshot_cache=None, differ: PlistDiffer = None, domain=None, byhost=None,
+                 lazy=False):
+        if plistpath is None:
+            # purely in-memory diff; nothing to derive from or read off disk
+            if domain is None or byhost is None or pref1 is None or pref2 is None:
+                raise ValueError(
+                    "domain, byhost, pref1 and pref2 are required without a plistpath")
+            self.plist_dir = self.plist_base = None
+        else:
+            self.plist_dir = os.path.dirname(plistpath)
+            self.plist_base = os.path.basename(plistpath)
+        # domain and byhost can be supplied by callers that already know
+        # them, e.g. because the file no longer exists
+        if byhost is None:
+            byhost = self.is_byhost(plistpath)
+        self.byhost = byhost
+        if domain is None:
+            domain = self.getdomain(plistpath, byhost=self.byhost)
+        self.pref_domain = domain
+        self.snapshot_cache = snapshot_cache
+        # memory-map binary plists and decode only what changed
+        self.lazy = lazy
+        if differ is None:
+            differ = PlistDiffer()
+        self.differ = differ
 
         self.plistpath = plistpath
 
-        # Read the preference file before it changed
-        with open(plistpath, 'rb') as f:
-            pref1 = plistlib.load(f)
+        # Read the preference file before it changed, unless the caller
+        # already has it parsed
+        if pref1 is None:
+            pref1 = self._load_plist(plistpath)
 
         if plistpath2 is None:
             self.plistpath2 = plistpath
-            self._wait_for_prefchange()
+            if pref2 is None:
+                self._wait_for_prefchange()
         else:
             self.plistpath2 = plistpath2
 
         # Read the preference file after it changed
-        with open(self.plistpath2, 'rb') as f:
-            pref2 = plistlib.load(f)
-
-        added, removed, modified, same = self._dict_compare(pref1, pref2)
-        self.removed = {}
-        self.added = {}
-        self.modified = {}
-
-        # At this stage, added and removed would be
-        # a key:value added or removed from the top-level
-        # <dict> of the plist
-        if len(added):
-            self.added = added
-        if len(removed):
-            self.removed = removed
-        if len(modified):
-            self.modified = modified
-
-        self.changes = self._generate_changes()
-        self.diff = self._unified_diff(pref1, pref2, plistpath)
+        if pref2 is None:
+            pref2 = self._load_plist(self.plistpath2)
+
+        # Keep both parsed snapshots so a caller watching for further
+        # changes can use pref2 as the next "before" without re-reading it
+        self.pref1 = pref1
+        self.pref2 = pref2
+        self.timestamp = time.time()
+
+        # Every changed key path, down to the deepest changed dictionary
+        # value. Unchanged subtrees are skipped by digest.
+        with stats.stage_timer(stats.STAGE_COMPARE):
+            self.path_changes = [self._materialize_change(change)
+                                 for change in self.differ.diff(pref1, pref2)]
+            self.removed = []
+            self.added = {}
+            self.modified = {}
+
+            # added and removed are keys added to or removed from the
+            # top-level <dict> of the plist. modified holds (before, after)
+            # for any top-level key with a change somewhere beneath it
+            for change in self.path_changes:
+                key = change.path[0]
+                if len(change.path) == 1 and change.kind == ADDED:
+                    self.added[key] = change.after
+                elif len(change.path) == 1 and change.kind == REMOVED:
+                    self.removed.append(key)
+                elif key not in self.modified:
+                    self.modified[key] = (materialize(pref1[key]),
+                                          materialize(pref2[key]))
+
+        # insert/delete edit scripts for modified top-level arrays
+        self.array_edits = {}
+        with stats.stage_timer(stats.STAGE_GENERATE_CHANGES):
+            self.changes = self._generate_changes()
+        stats.count(stats.COUNTER_CHANGESETS)
+        stats.count(stats.COUNTER_CHANGES, len(self.changes))
+
+    @property
+    def diff(self):
+        # Computed on demand: serializing both snapshots is the most
+        # expensive part of a diff, and most callers never look at it
+        return self._unified_diff(materialize(self.pref1),
+                                  materialize(self.pref2), self.label)
+
+    @property
+    def label(self):
+        # what to call this plist in diff headers
+        if self.plistpath is None:
+            return self.pref_domain
+        return self.plistpath
+
+    def scoped_diff(self, context=3):
+        # Unified diff of only the changed key paths. Each changed value is
+        # serialized on its own, so cost tracks the size of the change
+        # rather than the size of the plist
+        for change in self.path_changes:
+            key = change.path[-1]
+            label = "%s:%s" % (self.label, "/".join(
+                str(k) for k in change.path))
+            fromlines = self._xml_lines(key, change.before, change.kind != ADDED)
+            tolines = self._xml_lines(key, change.after, change.kind != REMOVED)
+            yield from difflib.unified_diff(fromlines, tolines, label, label,
+                                            n=context, lineterm="")
+
+    def _xml_lines(self, key, value, present=True):
+        if not present:
+            return []
+        xml = plistlib.dumps({key: blob_placeholders(value)},
+                             fmt=plistlib.FMT_XML).decode('utf-8')
+        # drop the XML declaration, doctype, and <plist><dict> wrapper
+        return xml.splitlines()[4:-2]
+
+    def _materialize_change(self, change):
+        # Lazy values are only ever decoded once they're known to have
+        # changed
+        if is_lazy(change.before) or is_lazy(change.after):
+            change = change._replace(before=materialize(change.before),
+                                     after=materialize(change.after))
+        return change
+
+    def _load_plist(self, plistpath):
+        if self.lazy:
+            with stats.stage_timer(stats.STAGE_PARSE):
+                return load_lazy(plistpath)
+        if self.snapshot_cache is not None:
+            return self.snapshot_cache.load(plistpath)
+        with stats.stage_timer(stats.STAGE_READ):
+            with open(plistpath, 'rb') as f:
+                data = f.read()
+        stats.count(stats.COUNTER_BYTES_READ, len(data))
+        with stats.stage_timer(stats.STAGE_PARSE):
+            pref = plistlib.loads(data)
+        return pref
 
     def _dict_compare(self, d1, d2):
         d1_keys = set(d1.keys())
@@ -185,42 +357,55 @@ class PrefSniff:
         added = {o: d2[o] for o in added_keys}
         removed = d1_keys - d2_keys
         modified = {o: (d1[o], d2[o])
-                    for o in intersect_keys if d1[o] != d2[o]}
+                    for o in intersect_keys if not self.differ.same(d1[o], d2[o])}
 
-        same = set(o for o in intersect_keys if d1[o] == d2[o])
+        same = intersect_keys - modified.keys()
         return added, removed, modified, same
 
+    def _nested_changes(self):
+        # group path changes below the top level by their top-level key
+        nested = {}
+        for change in self.path_changes:
+            if len(change.path) > 1:
+                nested.setdefault(change.path[0], []).append(change)
+        return nested
+
     def _list_compare(self, list1, list2):
         list_diffs = {"same": False, "append_to_l1": None,
-                      "subtract_from_l1": None}
-        if list1 == list2:
-            list_diffs["same"] = True
-            return list_diffs
-        if len(list2) > len(list1):
-            if list1 == list2[:len(list1)]:
-                list_diffs["append_to_l1"] = list2[len(list1):]
-
+                      "subtract_from_l1": None, "edits": None}
+        # minimal insert/delete edit script, or None if the arrays are too
+        # different for anything but a rewrite to make sense
+        edits = self.differ.array_edits(list1, list2)
+        list_diffs["edits"] = edits
+        if edits is None:
             return list_diffs
-        elif len(list1) > len(list2):
-            if list2 == list1[:len(list2)]:
-                list_diffs["subtract_from_l1"] = list1[len(list2):]
-
+        if not edits:
+            list_diffs["same"] = True
             return list_diffs
+        if len(edits) == 1:
+            edit = edits[0]
+            if edit.op == INSERT and edit.index == len(list1):
+                list_diffs["append_to_l1"] = edit.values
+            elif edit.op == DELETE and edit.index + edit.count == len(list1):
+                list_diffs["subtract_from_l1"] = list1[edit.index:]
 
         return list_diffs
 
     def _unified_diff(self, frompref, topref, path):
-        # Convert both preferences to XML format
+        # Convert both preferences to XML format. Values held in a blob
+        # store are shown by digest rather than read back in
         fromxml = plistlib.dumps(
-            frompref, fmt=plistlib.FMT_XML).decode('utf-8')
+            blob_placeholders(frompref), fmt=plistlib.FMT_XML).decode('utf-8')
         toxml = plistlib.dumps(
-            topref, fmt=plistlib.FMT_XML).decode('utf-8')
+            blob_placeholders(topref), fmt=plistlib.FMT_XML).decode('utf-8')
 
         fromlines, tolines = fromxml.splitlines(), toxml.splitlines()
         return difflib.unified_diff(fromlines, tolines, path, path)
 
     def _wait_for_prefchange(self):
-        event_queue = Queue()
+        # collapses the burst of events from a single save, so we don't
+        # wake up and parse a half-written file
+        event_queue = DebounceScheduler()
         event_handler = PrefChangedEventHandler(self.plist_base, event_queue)
         observer = Observer()
         observer.schedule(event_handler, self.plist_dir, recursive=False)
@@ -270,6 +455,7 @@ class PrefSniff:
         # if an array changes in any other way, we have to rewrite it
         rewrite_lists = {}
         domain = self.pref_domain
+        nested = self._nested_changes()
         for k, v in self.added.items():
             # pprint(v)
             change_type = self._change_type_lookup(v.__class__)
@@ -288,28 +474,35 @@ class PrefSniff:
 
         for key, val in self.modified.items():
             if isinstance(val[1], dict):
-                added, removed, modified, same = self._dict_compare(
-                    val[0], val[1])
-                if len(removed):
+                subchanges = nested.get(key)
+                if not subchanges:
+                    # changed type, so there's nothing to add to
+                    rewrite_dictionaries[key] = val[1]
+                    continue
+                if any(ch.kind == REMOVED and len(ch.path) == 2 for ch in subchanges):
                     # There is no -dict-delete so we have to
                     # rewrite this sub-dictionary
                     rewrite_dictionaries[key] = val[1]
                     continue
-                for subkey, subval in added.items():
-                    change = PSChangeTypeDictAdd(
-                        domain, self.byhost, key, subkey, subval)
-                    changes.append(change)
-                for subkey, subval_tuple in modified.items():
+                # -dict-add can only address one level down, so any change
+                # deeper than that rewrites the whole second-level value
+                subkeys = dict.fromkeys(ch.path[1] for ch in subchanges)
+                for subkey in subkeys:
                     change = PSChangeTypeDictAdd(
-                        domain, self.byhost, key, subkey, subval_tuple[1])
+                        domain, self.byhost, key, subkey, val[1][subkey])
                     changes.append(change)
-            elif isinstance(val[1], list):
+            elif isinstance(val[1], list) and isinstance(val[0], list):
                 list_diffs = self._list_compare(val[0], val[1])
+                if list_diffs["edits"] is not None:
+                    self.array_edits[key] = list_diffs["edits"]
                 if list_diffs["same"]:
                     continue
                 elif list_diffs["append_to_l1"]:
+                    # -array-add is the only array edit defaults(1) can
+                    # express; everything else costs a full rewrite
                     append = list_diffs["append_to_l1"]
-                    change = PSChangeTypeArrayAdd(domain, key, append)
+                    change = PSChangeTypeArrayAdd(
+                        domain, self.byhost, key, append)
                     changes.append(change)
                 else:
                     rewrite_lists[key] = val[1]
@@ -341,12 +534,21 @@ class PrefSniff:
     def execute(self, args, stdout=None):
         subprocess.check_call(args, stdout=stdout)
 
+    def apply(self, engine: PrefsApplyEngine = None):
+        if engine is None:
+            engine = PrefsApplyEngine()
+        return engine.apply(self.changes)
+
+    def patch(self) -> PlistPatch:
+        # the same changes as a plist patch, for PlistPatchApplier
+        return PlistPatch.from_changesets([self])
+
 
 class PrefsWatcher:
     class _PrefsWatchFilter:
 
         def __init__(self, pattern_string, pattern_is_regex=False, negative_match=False):
-            self.pattern = pattern_string
+            self.pattern_string = pattern_string
             self.regex = None
             if pattern_is_regex:
                 self.regex = re.compile(pattern_string)
@@ -369,67 +571,93 @@ class PrefsWatcher:
 
             return passes
 
-    def __init__(self, prefsdir):
+    def __init__(self, prefsdir, writer=None, recursive=True, baseline=BASELINE_LAZY,
+                 event_filter: PrefsPathFilter = None, **engine_kwargs):
         self.prefsdir = prefsdir
         self.filters = [self._PrefsWatchFilter(
             r".*\.plist$", pattern_is_regex=True)]
+        # --include/--exclude patterns; checked per event by the engine's
+        # event handlers, and here when deciding which files to watch
+        self.event_filter = event_filter
+        if writer is None:
+            writer = TextChangeSetWriter()
+        self.writer = writer
+        # recursive so ByHost/ and other subdirectories are covered too
+        self.recursive = recursive
+        self.baseline = baseline
+        self.engine_kwargs = engine_kwargs
         self._watch_prefsdir()
 
-    def _watch_prefsdir(self):
-        event_queue = Queue()
-        event_handler = PrefChangedEventHandler(None, event_queue)
-        observer = Observer()
-        observer.schedule(event_handler, self.prefsdir, recursive=False)
-        observer.start()
+    def passes_filters(self, path):
+        for _filter in self.filters:
+            if not _filter.passes_filter(path):
+                return False
+        if self.event_filter and not self.event_filter.matches_path(path):
+            return False
+        return True
 
-        while True:
-            try:
-                changed = event_queue.get(True, 0.5)
-                src_path = changed[1].src_path
-                passes = True
-                for _filter in self.filters:
-                    if not _filter.passes_filter(src_path):
-                        passes = False
-                        break
-                if not passes:
-                    continue
-                print("Detected change: [%s] %s" %
-                      (changed[0], changed[1].src_path))
-            except QueueEmpty:
-                pass
-            except KeyboardInterrupt:
-                break
-        observer.stop()
-        observer.join()
+    def _watch_prefsdir(self):
+        from .watch import PrefsWatchEngine
+
+        # Every plist gets a baseline up front, but is only diffed once it
+        # actually changes
+        engine = PrefsWatchEngine(event_filter=self.event_filter,
+                                  **self.engine_kwargs)
+        engine.add_directory(self.prefsdir, recursive=self.recursive,
+                             path_filter=self.passes_filters,
+                             baseline=self.baseline)
+        engine.start()
+        try:
+            for diffs in engine.changesets():
+                self.writer.write_changeset(diffs)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            engine.stop()
 
 
 class PrefChangedEventHandler(FileSystemEventHandler):
 
-    def __init__(self, file_base_name, event_queue):
+    def __init__(self, file_base_name, event_queue, event_filter: PrefsPathFilter = None):
         super(self.__class__, self).__init__()
         if file_base_name is None:
             file_base_name = ""
         self.file_base_name = file_base_name
         self.event_queue = event_queue
+        # Rejected events are dropped here, on the observer thread, so they
+        # never reach the queue
+        if not event_filter:
+            event_filter = None
+        self.event_filter = event_filter
+
+    def _accepts(self, path):
+        if self.file_base_name not in os.path.basename(path):
+            return False
+        if self.event_filter is not None and not self.event_filter(path):
+            return False
+        return True
 
     def on_created(self, event):
-        if self.file_base_name not in os.path.basename(event.src_path):
+        if not self._accepts(event.src_path):
             return
         self.event_queue.put(("created", event))
 
     def on_deleted(self, event):
-        if self.file_base_name not in os.path.basename(event.src_path):
+        if not self._accepts(event.src_path):
             return
         self.event_queue.put(("deleted", event))
 
     def on_modified(self, event):
-        if self.file_base_name not in os.path.basename(event.src_path):
+        if not self._accepts(event.src_path):
             return
         self.event_queue.put(("modified", event))
 
     def on_moved(self, event):
         if self.file_base_name not in os.path.basename(event.src_path):
             return
+        # the file's new name is the one it'll be diffed under
+        if self.event_filter is not None and not self.event_filter(event.dest_path):
+            return
         self.event_queue.put(("moved", event))
 
 
@@ -476,50 +704,133 @@ def parse_test_args(argv):
         exit(0)
 
 
+def print_changes(diffs, show_diffs=False, diff_scope=DIFF_SCOPE_FILE):
+    TextChangeSetWriter(show_diffs=show_diffs,
+                        diff_scope=diff_scope).write_changeset(diffs)
+
+
 def main():
-    args = parse_args(sys.argv[1:])
+    from .daemon import DAEMON_COMMANDS, daemon_main
+    from .store import STORE_COMMANDS, store_main
+    from .watch import expand_watchpaths
+
+    argv = sys.argv[1:]
+    if argv and argv[0] in STORE_COMMANDS:
+        store_main(argv)
+        exit(0)
+    if argv and argv[0] in DAEMON_COMMANDS:
+        daemon_main(argv)
+        exit(0)
+    if argv and argv[0] == PATCH_COMMAND:
+        patch_main(argv[1:])
+        exit(0)
+
+    args = parse_args(argv)
     monitor_dir_events = False
     show_diffs = False
 
-    plistpath = args.watchpath
-    if os.path.isdir(plistpath):
+    watchpaths = args.watchpath
+    if len(watchpaths) == 1 and os.path.isdir(watchpaths[0]):
         monitor_dir_events = True
-    elif not os.path.isfile(plistpath):
-        print("Error: %s is not a directory or file, or does not exist." % plistpath)
-        exit(1)
+    else:
+        watchpaths = expand_watchpaths(watchpaths)
+        if not watchpaths:
+            print("Error: %s matched no plist files." %
+                  ' '.join(args.watchpath))
+            exit(1)
+        for plistpath in watchpaths:
+            if not os.path.isfile(plistpath):
+                print(
+                    "Error: %s is not a directory or file, or does not exist." % plistpath)
+                exit(1)
+        if args.plist2 and len(watchpaths) > 1:
+            print("Error: --plist2 can only be used with a single plist file.")
+            exit(1)
 
     if args.show_diffs:
         show_diffs = True
+
+    if args.output == OUTPUT_NDJSON:
+        writer = NdjsonChangeSetWriter()
+        # keep stdout pure NDJSON
+        status_stream = sys.stderr
+    else:
+        writer = TextChangeSetWriter(
+            show_diffs=show_diffs, diff_scope=args.diff_scope)
+        status_stream = sys.stdout
+
     print("{} version {}".format(
-        PrefsniffAbout.TITLE.upper(), PrefsniffAbout.VERSION))
+        PrefsniffAbout.TITLE.upper(), PrefsniffAbout.VERSION), file=status_stream)
+    session = None
+    if args.session:
+        # still print each change as it happens
+        writer = session = SessionRecorder(writer=writer)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: _save_session(session, args, status_stream))
+    pipeline_stats = None
+    reporter = None
+    if args.stats or args.stats_interval > 0:
+        pipeline_stats = stats.enable()
+        if args.stats_interval > 0:
+            reporter = stats.StatsReporter(pipeline_stats, args.stats_interval)
+            reporter.start()
+    try:
+        _run(args, watchpaths, monitor_dir_events, writer, status_stream)
+    finally:
+        if session is not None:
+            _save_session(session, args, status_stream)
+        if reporter is not None:
+            reporter.stop()
+        if pipeline_stats is not None:
+            stats.print_summary(pipeline_stats)
+
+
+def _save_session(session, args, status_stream):
+    written = session.save(args.session, fmt=args.session_format)
+    print("Saved %d net changes (from %d recorded) to %s" % (
+        written, session.recorded_changes(), args.session), file=status_stream)
+
+
+def _blob_store(args):
+    if args.prune_blobs is not None:
+        BlobStore(args.blob_dir).prune(max_age=args.prune_blobs * 24 * 60 * 60)
+    if args.blob_threshold <= 0:
+        return None
+    return BlobStore(args.blob_dir, threshold=args.blob_threshold)
+
+
+def _run(args, watchpaths, monitor_dir_events, writer, status_stream):
+    from .watch import PrefsWatchEngine
+
     if monitor_dir_events:
-        print("Watching directory: {}".format(plistpath))
-        PrefsWatcher(plistpath)
+        print("Watching directory: {}".format(
+            watchpaths[0]), file=status_stream)
+        PrefsWatcher(watchpaths[0], writer=writer, baseline=args.baseline,
+                     event_filter=args.event_filter,
+                     quiet_period=args.quiet_period,
+                     max_delay=args.max_delay,
+                     blob_store=_blob_store(args))
+    elif args.plist2:
+        plistpath = watchpaths[0]
+        print("Watching prefs file: %s" % plistpath, file=status_stream)
+        diffs = PrefSniff(plistpath, plistpath2=args.plist2, lazy=True)
+        writer.write_changeset(diffs)
     else:
-        print("Watching prefs file: %s" % plistpath)
-        done = False
-        while not done:
-            plist2 = None
-            if args.plist2:
-                plist2 = args.plist2
-                done = True
-
-            try:
-                diffs = PrefSniff(plistpath, plistpath2=plist2)
-            except KeyboardInterrupt:
-                print("Exiting.")
-                exit(0)
-
-            print(STARS)
-            print("")
-            for ch in diffs.changes:
-                ch_dict = dict(ch)
-                new_ch = PSChangeTypeFactory.ps_change_type_from_dict(ch_dict)
-                print(new_ch.shell_command())
-                print("")
-            if show_diffs:
-                print('\n'.join(diffs.diff))
-            print(STARS)
+        engine = PrefsWatchEngine(watchpaths,
+                                  quiet_period=args.quiet_period,
+                                  max_delay=args.max_delay,
+                                  blob_store=_blob_store(args))
+        for plistpath in engine.watched:
+            print("Watching prefs file: %s" % plistpath, file=status_stream)
+        engine.start()
+        try:
+            for diffs in engine.changesets():
+                writer.write_changeset(diffs)
+        except KeyboardInterrupt:
+            print("Exiting.", file=status_stream)
+        finally:
+            engine.stop()
+        exit(0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from queue import Empty as QueueEmpty
+
+from . import stats
+
+
+def event_path(item):
+    # the path an ("event_type", event) item is about: where the file is now
+    event_type, event = item
+    if event_type == "moved":
+        path = event.dest_path
+    else:
+        path = event.src_path
+    if isinstance(path, bytes):
+        path = os.fsdecode(path)
+    return path
+
+
+class _PendingEvent:
+    __slots__ = ["item", "first", "last"]
+
+    def __init__(self, item, now):
+        self.item = item
+        self.first = now
+        self.last = now
+
+
+class DebounceScheduler:
+    """
+    Bounded, path-coalescing replacement for the event Queue fed by
+    PrefChangedEventHandler.
+
+    cfprefsd saves a plist with a burst of deleted/created/moved/modified
+    events. Events for the same path are collapsed into one pending entry,
+    which only becomes available to get() once the path has been quiet for
+    `quiet_period` seconds, or `max_delay` seconds after the first event of
+    the burst, whichever comes first. The entry carries the most recent
+    event, so the final state of every path is always delivered.
+
+    At most `maxsize` distinct paths can be pending. When an event for a new
+    path arrives while full, the oldest pending path is made available
+    immediately and put() waits for the consumer to take something, pushing
+    back on the producer rather than discarding anything. If `put_timeout`
+    is set and expires first, the event is dropped and counted.
+
+    Items are the same ("event_type", event) tuples Queue used to carry, and
+    get() raises queue.Empty on timeout, so it can stand in for a Queue.
+    """
+    DEFAULT_QUIET_PERIOD = 0.1
+    DEFAULT_MAX_DELAY = 1.0
+    DEFAULT_MAXSIZE = 1024
+
+    def __init__(self, quiet_period=DEFAULT_QUIET_PERIOD, max_delay=DEFAULT_MAX_DELAY,
+                 maxsize=DEFAULT_MAXSIZE, put_timeout=None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.quiet_period = quiet_period
+        self.max_delay = max(max_delay, quiet_period)
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        # events handed to put()
+        self.received = 0
+        # events folded into an already-pending entry for the same path
+        self.coalesced = 0
+        # events discarded because put_timeout expired while full
+        self.dropped = 0
+        # times put() found the scheduler full
+        self.overflows = 0
+        self._pending = {}
+        self._expedited = set()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def counters(self):
+        return {"received": self.received,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "overflows": self.overflows,
+                "pending": len(self._pending)}
+
+    def event_path(self, item):
+        return event_path(item)
+
+    def put(self, item, block=True, timeout=None):
+        path = self.event_path(item)
+        if timeout is None:
+            timeout = self.put_timeout
+        with self._lock:
+            self.received += 1
+            now = time.monotonic()
+            pending = self._pending.get(path)
+            if pending is not None:
+                self.coalesced += 1
+                pending.item = item
+                pending.last = now
+                self._not_empty.notify()
+                return
+            if len(self._pending) >= self.maxsize:
+                self.overflows += 1
+                oldest = min(self._pending, key=lambda p: self._pending[p].first)
+                self._expedited.add(oldest)
+                self._not_empty.notify()
+                if not block or not self._not_full.wait_for(
+                        lambda: len(self._pending) < self.maxsize or self._closed, timeout):
+                    self.dropped += 1
+                    return
+                # the path may have been added while we waited
+                pending = self._pending.get(path)
+                if pending is not None:
+                    self.coalesced += 1
+                    pending.item = item
+                    pending.last = time.monotonic()
+                    return
+            self._pending[path] = _PendingEvent(item, time.monotonic())
+            self._not_empty.notify()
+
+    def _due(self, path, pending):
+        if path in self._expedited:
+            return pending.first
+        return min(pending.last + self.quiet_period, pending.first + self.max_delay)
+
+    def get(self, block=True, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self._lock:
+            pending = self._take(block, deadline)
+        if pending is None:
+            return None
+        # how long the burst was held back, from its first event
+        stats.record(stats.STAGE_EVENT_WAIT, time.monotonic() - pending.first)
+        return pending.item
+
+    def _take(self, block, deadline):
+        # caller holds self._lock
+        while True:
+            now = time.monotonic()
+            next_due = None
+            next_path = None
+            for path, pending in self._pending.items():
+                due = self._due(path, pending)
+                if next_due is None or due < next_due:
+                    next_due, next_path = due, path
+            if next_path is not None and (next_due <= now or self._closed):
+                pending = self._pending.pop(next_path)
+                self._expedited.discard(next_path)
+                self._not_full.notify()
+                return pending
+            if self._closed:
+                return None
+            if not block:
+                raise QueueEmpty()
+            wait = None if next_due is None else next_due - now
+            if deadline is not None:
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise QueueEmpty()
+                wait = remaining if wait is None else min(wait, remaining)
+            self._not_empty.wait(wait)
+
+    def close(self):
+        # Once closed, get() hands out whatever is still pending without
+        # waiting for it to settle, then returns None
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
@@ -0,0 +1,234 @@
+"""
+Record every change set in a session and reduce them to their net effect.
+
+Clicking around a preference pane rewrites the same keys over and over.
+SessionRecorder keeps each change set it's given, and compact() reduces
+them to one change per key, per plist:
+
+- the last write to a key wins
+- a key written and then deleted again is dropped, if it didn't exist
+  when the session started; otherwise only the delete is kept
+- a write that puts a key back to its value at the start of the session
+  is dropped
+- -dict-add writes to the same dictionary merge into one command, and
+  into a preceding write of the whole dictionary
+- -array-add writes to the same array merge into one command, and into a
+  preceding write of the whole array
+
+save() writes the result as a shell script of defaults commands, as
+NDJSON in the same record schema as --output ndjson, or as a plist patch
+for PlistPatchApplier.
+"""
+import io
+import sys
+from collections import OrderedDict, namedtuple
+from typing import List
+
+from .bplist import materialize
+from .changetypes import (
+    PSChangeTypeArray,
+    PSChangeTypeArrayAdd,
+    PSChangeTypeBase,
+    PSChangeTypeDict,
+    PSChangeTypeDictAdd,
+    PSChangeTypeDictMerge,
+    PSChangeTypeKeyDeleted
+)
+from .diff import values_equal
+from .output import (
+    OUTPUT_NDJSON,
+    OUTPUT_SCRIPT,
+    NdjsonChangeSetWriter,
+    ScriptChangeSetWriter
+)
+from .patch import PlistPatch, write_atomic
+
+SESSION_PATCH = "patch"
+SESSION_FORMATS = [OUTPUT_SCRIPT, OUTPUT_NDJSON, SESSION_PATCH]
+
+# What's kept of each change set: its changes, and the value each changed
+# key had beforehand (None if it was absent; plists have no null)
+RecordedChangeSet = namedtuple(
+    "RecordedChangeSet", ["plistpath", "domain", "byhost", "timestamp", "changes", "before"])
+
+
+class SessionChangeSet(namedtuple(
+        "SessionChangeSet", ["plistpath", "pref_domain", "byhost", "timestamp", "changes"])):
+    """
+    The net changes to one plist over a session. Has the attributes the
+    ChangeSetWriters use, so it can be written like a PrefSniff.
+    """
+    __slots__ = ()
+
+    @property
+    def label(self):
+        if self.plistpath is None:
+            return self.pref_domain
+        return self.plistpath
+
+    @property
+    def commands(self):
+        return [ch.shell_command() for ch in self.changes
+                if isinstance(ch, PSChangeTypeBase)]
+
+
+class _NetChanges:
+    # net changes to one (domain, byhost), in the order keys first changed
+
+    def __init__(self, plistpath, domain, byhost):
+        self.plistpath = plistpath
+        self.domain = domain
+        self.byhost = byhost
+        self.timestamp = None
+        self.original = {}
+        self.net = OrderedDict()
+        # changes that aren't change objects, e.g. unimplemented types
+        self.unsupported = OrderedDict()
+
+    def add(self, changeset: RecordedChangeSet):
+        self.timestamp = changeset.timestamp
+        for ch in changeset.changes:
+            if not isinstance(ch, PSChangeTypeBase):
+                self.unsupported[str(ch)] = ch
+                continue
+            if ch.key not in self.original:
+                self.original[ch.key] = changeset.before.get(ch.key)
+            self.net[ch.key] = self._combine(self.net.get(ch.key), ch)
+
+    def _combine(self, prev, ch):
+        domain, byhost, key = ch.domain, ch.byhost, ch.key
+        if isinstance(ch, PSChangeTypeDictAdd):
+            if isinstance(prev, (PSChangeTypeDict, PSChangeTypeDictMerge)):
+                value = dict(prev.value)
+                value[ch.subkey] = ch.value
+                return type(prev)(domain, byhost, key, value)
+            if isinstance(prev, PSChangeTypeKeyDeleted):
+                # -dict-add to a missing key creates the dictionary
+                return PSChangeTypeDict(domain, byhost, key, {ch.subkey: ch.value})
+            return PSChangeTypeDictMerge(domain, byhost, key, {ch.subkey: ch.value})
+        if isinstance(ch, PSChangeTypeArrayAdd):
+            if isinstance(prev, PSChangeTypeArray):
+                # also covers a preceding PSChangeTypeArrayAdd
+                return type(prev)(domain, byhost, key, prev.value + ch.value)
+            if isinstance(prev, PSChangeTypeKeyDeleted):
+                return PSChangeTypeArray(domain, byhost, key, list(ch.value))
+            return ch
+        # anything else replaces the key outright
+        return ch
+
+    def _finish(self, key, ch):
+        original = self.original[key]
+        if isinstance(ch, PSChangeTypeKeyDeleted):
+            # created during the session, then deleted again
+            return None if original is None else ch
+        if isinstance(ch, PSChangeTypeDictMerge):
+            if isinstance(original, dict):
+                value = {subkey: v for subkey, v in ch.value.items()
+                         if not values_equal(original.get(subkey), v)}
+                if not value:
+                    return None
+                ch = PSChangeTypeDictMerge(ch.domain, ch.byhost, key, value)
+            if len(ch.value) == 1:
+                [(subkey, value)] = ch.value.items()
+                return PSChangeTypeDictAdd(ch.domain, ch.byhost, key, subkey, value)
+            return ch
+        if isinstance(ch, PSChangeTypeArrayAdd):
+            return ch
+        if values_equal(original, ch.value):
+            return None
+        return ch
+
+    def changeset(self) -> SessionChangeSet:
+        changes = []
+        for key, ch in self.net.items():
+            ch = self._finish(key, ch)
+            if ch is not None:
+                changes.append(ch)
+        changes.extend(self.unsupported.values())
+        return SessionChangeSet(self.plistpath, self.domain, self.byhost,
+                                self.timestamp, changes)
+
+
+def compact(changesets) -> List[SessionChangeSet]:
+    """
+    Reduce RecordedChangeSets, oldest first, to the net changes per plist.
+    Plists whose changes all cancel out are left out.
+    """
+    plists = OrderedDict()
+    for changeset in changesets:
+        net = plists.get((changeset.domain, changeset.byhost))
+        if net is None:
+            net = plists[(changeset.domain, changeset.byhost)] = _NetChanges(
+                changeset.plistpath, changeset.domain, changeset.byhost)
+        net.add(changeset)
+    results = [net.changeset() for net in plists.values()]
+    return [changeset for changeset in results if changeset.changes]
+
+
+class SessionRecorder:
+    """
+    A change set writer that records each change set, and passes it on to
+    `writer`, if given, so changes can still be shown as they happen.
+
+    Only the changes themselves and the prior value of each changed key
+    are kept, not the parsed plists.
+    """
+
+    def __init__(self, writer=None):
+        self.writer = writer
+        self.changesets = []
+
+    def write_changeset(self, diffs):
+        before = {}
+        for ch in diffs.changes:
+            if isinstance(ch, PSChangeTypeBase) and ch.key not in before:
+                before[ch.key] = materialize(diffs.pref1.get(ch.key))
+        # a single append, so compact() can run at any point, e.g. from a
+        # signal handler, without a lock
+        self.changesets.append(RecordedChangeSet(
+            diffs.plistpath, diffs.pref_domain, diffs.byhost, diffs.timestamp,
+            list(diffs.changes), before))
+        if self.writer is not None:
+            self.writer.write_changeset(diffs)
+
+    def compact(self) -> List[SessionChangeSet]:
+        return compact(list(self.changesets))
+
+    def recorded_changes(self):
+        return sum(len(changeset.changes) for changeset in self.changesets)
+
+    def write(self, stream=None, fmt=OUTPUT_SCRIPT):
+        """
+        Write the compacted session to `stream`. Returns the number of net
+        changes written.
+        """
+        if stream is None:
+            stream = sys.stdout
+        if fmt == OUTPUT_NDJSON:
+            writer = NdjsonChangeSetWriter(stream)
+        elif fmt == OUTPUT_SCRIPT:
+            writer = ScriptChangeSetWriter(stream)
+            stream.write("#!/bin/sh\n")
+        else:
+            raise ValueError("Unknown session format: %s" % fmt)
+        written = 0
+        for changeset in self.compact():
+            writer.write_changeset(changeset)
+            written += len(changeset.changes)
+        stream.flush()
+        return written
+
+    def save(self, path, fmt=OUTPUT_SCRIPT):
+        """
+        Atomically replace `path` with the compacted session. Returns the
+        number of net changes written.
+        """
+        if fmt == SESSION_PATCH:
+            patch = PlistPatch.from_changesets(self.compact())
+            patch.save(path)
+            return len(patch)
+        stream = io.StringIO()
+        written = self.write(stream, fmt=fmt)
+        write_atomic(path, stream.getvalue().encode("utf-8"),
+                     mode=0o755 if fmt == OUTPUT_SCRIPT else None)
+        return written
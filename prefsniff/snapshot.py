@@ -0,0 +1,100 @@
+import hashlib
+import os
+import plistlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from . import stats
+
+# Identifies one version of a file on disk. cfprefsd replaces plists by
+# writing a new file and renaming it into place, which changes the inode;
+# in-place writes change mtime and usually size
+SnapshotKey = namedtuple("SnapshotKey", ["inode", "mtime_ns", "size"])
+
+
+def snapshot_key(stat_result) -> SnapshotKey:
+    return SnapshotKey(stat_result.st_ino,
+                       stat_result.st_mtime_ns,
+                       stat_result.st_size)
+
+
+# Identifies a file's content: its size and a fast 128-bit hash. cfprefsd
+# often rewrites a plist without changing it, and comparing digests drops
+# those rewrites for the cost of a read and a hash rather than a parse and
+# a diff
+ContentDigest = namedtuple("ContentDigest", ["size", "hash"])
+
+
+def content_digest(data: bytes) -> ContentDigest:
+    return ContentDigest(len(data), hashlib.blake2b(data, digest_size=16).digest())
+
+
+class SnapshotCache:
+    """
+    LRU cache of parsed plists, keyed by path and validated against
+    (inode, mtime, size) on every lookup.
+
+    Parsed objects are shared between callers and must be treated as
+    read-only.
+    """
+    DEFAULT_MAXSIZE = 128
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        if maxsize < 1:
+            raise ValueError("SnapshotCache maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, plistpath):
+        return os.path.abspath(plistpath) in self._snapshots
+
+    def get(self, plistpath, key: SnapshotKey):
+        plistpath = os.path.abspath(plistpath)
+        with self._lock:
+            cached = self._snapshots.get(plistpath)
+            if cached is None or cached[0] != key:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._snapshots.move_to_end(plistpath)
+            return cached[1]
+
+    def put(self, plistpath, key: SnapshotKey, pref):
+        plistpath = os.path.abspath(plistpath)
+        with self._lock:
+            self._snapshots[plistpath] = (key, pref)
+            self._snapshots.move_to_end(plistpath)
+            while len(self._snapshots) > self.maxsize:
+                self._snapshots.popitem(last=False)
+
+    def invalidate(self, plistpath):
+        plistpath = os.path.abspath(plistpath)
+        with self._lock:
+            self._snapshots.pop(plistpath, None)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def load(self, plistpath):
+        # stat the open file descriptor rather than the path, so the key
+        # always describes the bytes we actually parse, even if the file is
+        # replaced between open() and read()
+        with open(plistpath, 'rb') as f:
+            key = snapshot_key(os.fstat(f.fileno()))
+            pref = self.get(plistpath, key)
+            if pref is not None:
+                return pref
+            with stats.stage_timer(stats.STAGE_READ):
+                data = f.read()
+        stats.count(stats.COUNTER_BYTES_READ, len(data))
+        with stats.stage_timer(stats.STAGE_PARSE):
+            pref = plistlib.loads(data)
+        self.put(plistpath, key, pref)
+        return pref
@@ -0,0 +1,272 @@
+"""
+Per-stage timers and counters for the event -> diff -> output pipeline.
+
+Instrumentation is off by default. Instrumented code calls stage_timer(),
+count() and record(), which check a single module global and return
+immediately while nothing is enabled. enable() installs a PipelineStats
+that collects a latency histogram per stage and a total per counter, and
+passes every sample to any hooks added with PipelineStats.add_hook(), e.g.
+for a metrics exporter:
+
+    stats = prefsniff.stats.enable()
+    stats.add_hook(lambda kind, name, value: exporter.observe(name, value))
+"""
+import bisect
+import sys
+import threading
+import time
+
+# Pipeline stages, in the order they happen
+STAGE_EVENT_WAIT = "event_wait"
+STAGE_READ = "read"
+STAGE_PARSE = "parse"
+STAGE_COMPARE = "compare"
+STAGE_GENERATE_CHANGES = "generate_changes"
+STAGE_XML_RENDER = "xml_render"
+STAGE_UNIFIED_DIFF = "unified_diff"
+STAGE_OUTPUT = "output"
+
+STAGES = (STAGE_EVENT_WAIT, STAGE_READ, STAGE_PARSE, STAGE_COMPARE,
+          STAGE_GENERATE_CHANGES, STAGE_XML_RENDER, STAGE_UNIFIED_DIFF,
+          STAGE_OUTPUT)
+
+COUNTER_BYTES_READ = "bytes_read"
+COUNTER_CHANGESETS = "changesets"
+COUNTER_CHANGES = "changes"
+# events dropped because the file's bytes hadn't changed
+COUNTER_SHORT_CIRCUITED = "short_circuited"
+
+KIND_TIMER = "timer"
+KIND_COUNTER = "counter"
+
+# Histogram bucket upper bounds in seconds: 4 buckets per power of two from
+# 1us to about 2 minutes, so percentiles are accurate to within ~20%
+_BUCKET_BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(4 * 27)]
+
+
+class LatencyHistogram:
+    """
+    Fixed log-scale histogram of durations, with count, total, min and max.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(_BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        # upper bound of the bucket holding the pct'th sample, clamped to
+        # what was actually seen
+        if not self.count:
+            return None
+        rank = max(1, int(round(pct / 100.0 * self.count)))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                bound = _BUCKET_BOUNDS[i] if i < len(_BUCKET_BOUNDS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "total": self.total,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99)}
+
+
+class _StageTimer:
+    __slots__ = ["stats", "stage", "start"]
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.stage, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class PipelineStats:
+    """
+    Latency histograms per stage and running totals per counter.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """
+        Call hook(kind, name, value) for every sample, where kind is
+        KIND_TIMER (value in seconds) or KIND_COUNTER (value is the
+        increment). Hooks run on whichever thread recorded the sample.
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def timer(self, stage):
+        return _StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.add(seconds)
+        for hook in self._hooks:
+            hook(KIND_TIMER, stage, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for hook in self._hooks:
+            hook(KIND_COUNTER, name, n)
+
+    def snapshot(self):
+        with self._lock:
+            return {"uptime": time.time() - self.started,
+                    "stages": {stage: h.summary() for stage, h in self.histograms.items()},
+                    "counters": dict(self.counters)}
+
+    def format_summary(self, histograms=True):
+        def ms(seconds):
+            return "-" if seconds is None else "%.3f" % (seconds * 1000)
+
+        snapshot = self.snapshot()
+        lines = ["prefsniff stats after %.1fs" % snapshot["uptime"],
+                 "%-18s %8s %10s %10s %10s %10s" % ("stage", "count", "p50 ms", "p99 ms", "max ms", "total ms")]
+        ordered = [s for s in STAGES if s in snapshot["stages"]]
+        ordered += sorted(set(snapshot["stages"]) - set(STAGES))
+        for stage in ordered:
+            s = snapshot["stages"][stage]
+            lines.append("%-18s %8d %10s %10s %10s %10s" % (
+                stage, s["count"], ms(s["p50"]), ms(s["p99"]), ms(s["max"]), ms(s["total"])))
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("%-18s %8d" % (name, value))
+        if histograms:
+            for stage in ordered:
+                lines.extend(self._format_histogram(stage))
+        return lines
+
+    def _format_histogram(self, stage, width=40):
+        with self._lock:
+            buckets = list(self.histograms[stage].buckets)
+        used = [i for i, n in enumerate(buckets) if n]
+        if not used:
+            return []
+        # one row per power of two, between the first and last used bucket
+        rows = []
+        for row in range(used[0] // 4, used[-1] // 4 + 1):
+            bound = _BUCKET_BOUNDS[min(row * 4 + 3, len(_BUCKET_BOUNDS) - 1)]
+            rows.append((bound, sum(buckets[row * 4:row * 4 + 4])))
+        peak = max(n for _, n in rows)
+        lines = ["%s:" % stage]
+        for bound, n in rows:
+            lines.append(("  <%10.3f ms %8d %s" % (bound * 1000, n, "#" * (n * width // peak))).rstrip())
+        return lines
+
+
+class StatsReporter:
+    """
+    Print a summary to `stream` every `interval` seconds on a daemon thread.
+    """
+
+    def __init__(self, stats: PipelineStats, interval, stream=None):
+        if stream is None:
+            stream = sys.stderr
+        self.stats = stats
+        self.interval = interval
+        self.stream = stream
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            print_summary(self.stats, self.stream, histograms=False)
+
+
+def print_summary(stats: PipelineStats, stream=None, histograms=True):
+    if stream is None:
+        stream = sys.stderr
+    stream.write("\n".join(stats.format_summary(histograms=histograms)) + "\n")
+    stream.flush()
+
+
+_active = None
+
+
+def enable(stats: PipelineStats = None) -> PipelineStats:
+    global _active
+    if stats is None:
+        stats = PipelineStats()
+    _active = stats
+    return stats
+
+
+def disable():
+    global _active
+    _active = None
+
+
+def active() -> PipelineStats:
+    return _active
+
+
+def stage_timer(stage):
+    stats = _active
+    if stats is None:
+        return _NULL_TIMER
+    return stats.timer(stage)
+
+
+def record(stage, seconds):
+    stats = _active
+    if stats is not None:
+        stats.record(stage, seconds)
+
+
+def count(name, n=1):
+    stats = _active
+    if stats is not None:
+        stats.count(name, n)
@@ -0,0 +1,341 @@
+import argparse
+import hashlib
+import os
+import plistlib
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from typing import Iterable, Iterator, List
+
+from .domains import DomainIndex
+from .exceptions import SnapshotStoreException
+from .output import (
+    OUTPUT_NDJSON,
+    OUTPUT_TEXT,
+    NdjsonChangeSetWriter,
+    TextChangeSetWriter
+)
+from .patch import PlistPatch
+from .prefsniff import PrefSniff
+from .snapshot import snapshot_key
+from .watch import expand_watchpaths, is_plist
+
+CAPTURE_COMMAND = "capture"
+COMPARE_COMMAND = "compare"
+STORE_COMMANDS = (CAPTURE_COMMAND, COMPARE_COMMAND)
+
+DEFAULT_STORE_PATH = "~/.prefsniff/snapshots.db"
+
+Capture = namedtuple("Capture", ["capture_id", "name", "created", "roots"])
+
+# One file as it was at the time of a capture. `error` says why its content
+# couldn't be parsed, in which case none is stored for its content_hash
+CapturedFile = namedtuple("CapturedFile", ["path", "inode", "mtime_ns", "size",
+                                           "content_hash", "domain", "byhost", "error"],
+                          defaults=(None,))
+
+_SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    capture_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE,
+    created REAL NOT NULL,
+    roots TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    capture_id INTEGER NOT NULL REFERENCES captures(capture_id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    byhost INTEGER NOT NULL,
+    error TEXT,
+    PRIMARY KEY (capture_id, path)
+);
+CREATE TABLE IF NOT EXISTS contents (
+    content_hash TEXT PRIMARY KEY,
+    pref BLOB NOT NULL
+);
+"""
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class SnapshotStore:
+    """
+    Single-file SQLite store of whole-tree preference captures.
+
+    Each capture records every plist's (inode, mtime, size), content hash,
+    defaults domain and byhost flag. Parsed content is stored once per
+    distinct content hash, so identical files across captures share a row.
+    A new capture only reads files whose stat info changed since the
+    previous capture, and only parses files whose content hash is new.
+
+    Parsed content is stored as binary plists. A file that can't be parsed
+    is still recorded, with the error, so comparing captures skips it
+    rather than reporting every key in it as deleted or added.
+    """
+
+    def __init__(self, store_path=DEFAULT_STORE_PATH):
+        store_path = os.path.expanduser(store_path)
+        store_dir = os.path.dirname(store_path)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self.store_path = store_path
+        self.conn = sqlite3.connect(store_path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, _SCHEMA_VERSION):
+            self.conn.close()
+            raise SnapshotStoreException(
+                "%s is an older snapshot store; remove it and capture again" % store_path)
+        self.conn.executescript(_SCHEMA)
+        self.conn.execute("PRAGMA user_version = %d" % _SCHEMA_VERSION)
+        # files read and parsed by the most recent capture()
+        self.files_read = 0
+        self.files_parsed = 0
+        # (path, error) for files the most recent capture() couldn't parse
+        self.unparseable = []
+        # (path, capture_id, error) for files the most recent compare()
+        # skipped because they couldn't be parsed in that capture
+        self.skipped = []
+        # domains of newly captured files, with owner lookups cached
+        self.domain_index = DomainIndex()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def captures(self) -> List[Capture]:
+        rows = self.conn.execute(
+            "SELECT capture_id, name, created, roots FROM captures ORDER BY capture_id")
+        return [Capture(cid, name, created, roots.split(os.pathsep))
+                for cid, name, created, roots in rows]
+
+    def lookup_capture(self, ref) -> Capture:
+        # a capture can be referred to by name or by id
+        row = self.conn.execute(
+            "SELECT capture_id, name, created, roots FROM captures WHERE name = ?", (str(ref),)).fetchone()
+        if row is None and str(ref).isdigit():
+            row = self.conn.execute(
+                "SELECT capture_id, name, created, roots FROM captures WHERE capture_id = ?", (int(ref),)).fetchone()
+        if row is None:
+            raise KeyError("No such capture: %s" % ref)
+        cid, name, created, roots = row
+        return Capture(cid, name, created, roots.split(os.pathsep))
+
+    def captured_files(self, capture: Capture):
+        rows = self.conn.execute(
+            "SELECT path, inode, mtime_ns, size, content_hash, domain, byhost, error "
+            "FROM files WHERE capture_id = ?", (capture.capture_id,))
+        return {row[0]: CapturedFile(*row[:6], bool(row[6]), row[7]) for row in rows}
+
+    def load_content(self, content_hash):
+        row = self.conn.execute(
+            "SELECT pref FROM contents WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row is None:
+            raise KeyError("No stored content for hash %s" % content_hash)
+        return plistlib.loads(row[0])
+
+    def _latest_files(self):
+        # most recent capture's entry for every path ever captured
+        rows = self.conn.execute(
+            "SELECT f.path, f.inode, f.mtime_ns, f.size, f.content_hash, f.domain, f.byhost, f.error "
+            "FROM files f JOIN (SELECT path, MAX(capture_id) AS capture_id FROM files GROUP BY path) latest "
+            "ON f.path = latest.path AND f.capture_id = latest.capture_id")
+        return {row[0]: CapturedFile(*row[:6], bool(row[6]), row[7]) for row in rows}
+
+    def iter_plists(self, roots: Iterable[str]) -> Iterator[str]:
+        for root in expand_watchpaths(roots):
+            if os.path.isdir(root):
+                for dirpath, dirnames, filenames in os.walk(root):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        plistpath = os.path.join(dirpath, filename)
+                        if is_plist(plistpath) and not os.path.islink(plistpath):
+                            yield plistpath
+            elif os.path.isfile(root):
+                yield root
+
+    def capture(self, roots: Iterable[str], name=None) -> Capture:
+        roots = [os.path.abspath(os.path.expanduser(r)) for r in roots]
+        previous = self._latest_files()
+        known_hashes = set(
+            row[0] for row in self.conn.execute("SELECT content_hash FROM contents"))
+        self.files_read = 0
+        self.files_parsed = 0
+        self.unparseable = []
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO captures (name, created, roots) VALUES (?, ?, ?)",
+                (name, time.time(), os.pathsep.join(roots)))
+            capture_id = cur.lastrowid
+            for plistpath in self.iter_plists(roots):
+                captured = self._capture_file(plistpath, previous.get(plistpath), known_hashes)
+                if captured is None:
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (capture_id,) + tuple(captured[:6]) + (int(captured.byhost), captured.error))
+        return self.lookup_capture(capture_id)
+
+    def _capture_file(self, plistpath, previous: CapturedFile, known_hashes):
+        try:
+            st = os.stat(plistpath)
+        except OSError:
+            return None
+        key = snapshot_key(st)
+        if previous is not None and (previous.inode, previous.mtime_ns, previous.size) == key:
+            # unchanged since last capture; don't even read it
+            return previous
+
+        try:
+            with open(plistpath, 'rb') as f:
+                key = snapshot_key(os.fstat(f.fileno()))
+                data = f.read()
+        except OSError:
+            return None
+        self.files_read += 1
+        digest = content_hash(data)
+        error = None
+        if digest not in known_hashes:
+            try:
+                pref = plistlib.loads(data)
+                stored = plistlib.dumps(pref, fmt=plistlib.FMT_BINARY, sort_keys=False)
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                self.unparseable.append((plistpath, error))
+            else:
+                self.files_parsed += 1
+                self.conn.execute("INSERT OR IGNORE INTO contents VALUES (?, ?)", (digest, stored))
+                known_hashes.add(digest)
+
+        if previous is not None:
+            domain, byhost = previous.domain, previous.byhost
+        else:
+            try:
+                entry = self.domain_index.resolve(plistpath)
+            except OSError:
+                return None
+            domain, byhost = entry.domain, entry.byhost
+        return CapturedFile(plistpath, key.inode, key.mtime_ns, key.size, digest, domain, byhost, error)
+
+    def compare(self, before: Capture, after: Capture) -> Iterator[PrefSniff]:
+        """
+        Diff two captures, yielding a PrefSniff for every file whose content
+        hash differs. Files only present in one capture are diffed against
+        an empty plist. Files that couldn't be parsed in either capture are
+        skipped, and recorded in `skipped`.
+        """
+        self.skipped = []
+        before_files = self.captured_files(before)
+        after_files = self.captured_files(after)
+        for path in sorted(set(before_files) | set(after_files)):
+            old = before_files.get(path)
+            new = after_files.get(path)
+            if old is not None and new is not None and old.content_hash == new.content_hash:
+                continue
+            failed = [(capture, captured) for capture, captured in ((before, old), (after, new))
+                      if captured is not None and captured.error is not None]
+            if failed:
+                self.skipped.extend((path, capture.capture_id, captured.error)
+                                    for capture, captured in failed)
+                continue
+            pref1 = self.load_content(old.content_hash) if old is not None else {}
+            pref2 = self.load_content(new.content_hash) if new is not None else {}
+            known = new if new is not None else old
+            yield PrefSniff(path, pref1=pref1, pref2=pref2,
+                            domain=known.domain, byhost=known.byhost)
+
+
+def parse_store_args(argv):
+    parser = argparse.ArgumentParser(prog="prefsniff")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    capture_parser = subparsers.add_parser(
+        CAPTURE_COMMAND, help="Record the current state of one or more preference trees.")
+    capture_parser.add_argument(
+        "paths", nargs="*", default=PrefSniff.STANDARD_PATHS,
+        help="Directories, plist files or globs to capture. Default: %s" % " ".join(PrefSniff.STANDARD_PATHS))
+    capture_parser.add_argument("--name", help="Name to refer to this capture by.")
+
+    compare_parser = subparsers.add_parser(
+        COMPARE_COMMAND, help="Print the defaults commands that turn one capture into another.")
+    compare_parser.add_argument(
+        "before", nargs="?", help="Name or id of the earlier capture. Default: the second most recent capture.")
+    compare_parser.add_argument(
+        "after", nargs="?", help="Name or id of the later capture. Default: the most recent capture.")
+    compare_parser.add_argument(
+        "--output", choices=[OUTPUT_TEXT, OUTPUT_NDJSON], default=OUTPUT_TEXT,
+        help="Print changes as defaults commands, or as one JSON record per change. Default: %(default)s")
+    compare_parser.add_argument(
+        "--patch", metavar="FILE",
+        help="Also write the changes to FILE as a plist patch, for prefsniff patch.")
+
+    for subparser in (capture_parser, compare_parser):
+        subparser.add_argument(
+            "--store", default=DEFAULT_STORE_PATH,
+            help="Snapshot store file. Default: %(default)s")
+    return parser.parse_args(argv)
+
+
+def store_main(argv):
+    args = parse_store_args(argv)
+    try:
+        store = SnapshotStore(args.store)
+    except SnapshotStoreException as e:
+        print("Error: %s" % e)
+        exit(1)
+    with store:
+        if args.command == CAPTURE_COMMAND:
+            t0 = time.perf_counter()
+            capture = store.capture(args.paths, name=args.name)
+            for plistpath, error in store.unparseable:
+                print("Can't parse %s: %s" % (plistpath, error), file=sys.stderr)
+            print("Capture %d%s: %d files, %d read, %d parsed in %.2fs" % (
+                capture.capture_id,
+                " (%s)" % capture.name if capture.name else "",
+                len(store.captured_files(capture)), store.files_read,
+                store.files_parsed, time.perf_counter() - t0))
+            return
+
+        captures = store.captures()
+        try:
+            if args.before is None:
+                if len(captures) < 2:
+                    print("Error: need at least two captures to compare.")
+                    exit(1)
+                before, after = captures[-2], captures[-1]
+            else:
+                before = store.lookup_capture(args.before)
+                after = store.lookup_capture(
+                    args.after) if args.after else captures[-1]
+        except KeyError as e:
+            print("Error: %s" % e.args[0])
+            exit(1)
+
+        if args.output == OUTPUT_NDJSON:
+            writer = NdjsonChangeSetWriter()
+        else:
+            writer = TextChangeSetWriter()
+        patch = PlistPatch()
+        for diffs in store.compare(before, after):
+            if diffs.changes:
+                writer.write_changeset(diffs)
+                patch.add_changeset(diffs)
+        for path, capture_id, error in store.skipped:
+            print("Skipping %s: couldn't be parsed in capture %d: %s" % (
+                path, capture_id, error), file=sys.stderr)
+        if args.patch:
+            patch.save(args.patch)
@@ -0,0 +1,467 @@
+import glob
+import os
+import plistlib
+import threading
+from queue import Empty as QueueEmpty
+from queue import Queue
+from typing import Dict, Iterable, List
+from xml.parsers.expat import ExpatError
+
+from watchdog.events import FileModifiedEvent
+from watchdog.observers import Observer
+
+from . import stats
+from .baseline import BASELINE_LAZY, BASELINE_PARALLEL, BaselineSnapshotter
+from .blobs import BlobStore
+from .diff import PlistDiffer
+from .domains import DomainIndex
+from .filters import PrefsPathFilter
+from .prefsniff import PrefChangedEventHandler, PrefSniff
+from .scheduler import DebounceScheduler, event_path
+from .snapshot import (
+    ContentDigest,
+    SnapshotCache,
+    content_digest,
+    snapshot_key
+)
+
+# Events that mean a plist's content may now be different.
+# "deleted" is deliberately absent: cfprefsd replaces files by
+# unlinking and recreating them, so a delete is always followed
+# by a "created" or "moved" event for the same path
+CHANGE_EVENTS = ("created", "modified", "moved")
+
+
+def expand_watchpaths(watchpaths: Iterable[str]) -> List[str]:
+    expanded = []
+    for path in watchpaths:
+        path = os.path.expanduser(path)
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+        else:
+            matches = [path]
+        for match in matches:
+            match = os.path.abspath(match)
+            if match not in expanded:
+                expanded.append(match)
+    return expanded
+
+
+def is_plist(plistpath):
+    return plistpath.endswith(".plist")
+
+
+class WatchedPlist:
+    """
+    Diff state for one watched plist file.
+
+    Holds the most recently parsed content, which becomes the "before" side of
+    the next diff. refresh() returns the PrefSniff change set for each
+    change; nothing is kept here once it has been returned.
+
+    With lazy=True only the file's raw bytes are read up front, and they're
+    parsed the first time the file changes. That keeps baselining a whole
+    preferences tree cheap when most files never change.
+
+    The ContentDigest of the last version diffed is kept too. An event for
+    a file whose bytes are unchanged is dropped before anything is parsed,
+    and counted in `short_circuited`.
+
+    With a BlobStore, large <data> values are moved out of each parsed
+    version into the store (see prefsniff.blobs). Binary plists are parsed
+    straight into the store; an XML plist, or a baseline handed in already
+    parsed, is held in full until it has been externalized. With a DomainIndex, the
+    file's domain is looked up there rather than worked out on every diff.
+
+    `pref` may be read from any thread (the daemon serves it as a snapshot)
+    while the dispatcher thread refreshes the file; it is always one
+    complete version of the file.
+    """
+
+    def __init__(self, plistpath, snapshot_cache: SnapshotCache = None, lazy=False, baseline=None,
+                 digest: ContentDigest = None, blob_store: BlobStore = None,
+                 domain_index: DomainIndex = None):
+        self.plistpath = plistpath
+        self.snapshot_cache = snapshot_cache
+        self.blob_store = blob_store
+        self.domain_index = domain_index
+        self.plist_dir = os.path.dirname(plistpath)
+        self.plist_base = os.path.basename(plistpath)
+        self.differ = PlistDiffer()
+        # of the "before" side; None if unknown, so nothing is dropped
+        self.digest = digest
+        self.short_circuited = 0
+        # guards _pref, _raw and digest
+        self._lock = threading.Lock()
+        self._raw = None
+        self._pref = self._externalize(baseline)
+        if self._pref is not None:
+            return
+        if lazy:
+            self._raw = self._read()
+            if self._raw is not None:
+                self.digest = content_digest(self._raw)
+        else:
+            self._pref = self._load()
+        if self._pref is None and self._raw is None:
+            # File doesn't exist yet, or is mid-write. Everything in it
+            # will show up as added once it appears
+            self._pref = {}
+
+    @property
+    def pref(self):
+        with self._lock:
+            if self._pref is None:
+                try:
+                    with stats.stage_timer(stats.STAGE_PARSE):
+                        self._pref = self._loads(self._raw)
+                except (plistlib.InvalidFileException, ExpatError, ValueError):
+                    self._pref = {}
+                self._raw = None
+            return self._pref
+
+    @pref.setter
+    def pref(self, pref):
+        with self._lock:
+            self._raw = None
+            self._pref = pref
+
+    def _externalize(self, pref):
+        if self.blob_store is None or pref is None:
+            return pref
+        return self.blob_store.externalize(pref)
+
+    def _loads(self, data):
+        if self.blob_store is None:
+            return plistlib.loads(data)
+        return self.blob_store.loads(data)
+
+    def _read(self):
+        try:
+            with open(self.plistpath, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            raw = None
+        return raw
+
+    def _read_current(self):
+        # (SnapshotKey, bytes), with the key taken from the open file so
+        # it describes the bytes read even if the file is replaced
+        # meanwhile; None if the file can't be read
+        try:
+            with open(self.plistpath, 'rb') as f:
+                key = snapshot_key(os.fstat(f.fileno()))
+                with stats.stage_timer(stats.STAGE_READ):
+                    data = f.read()
+        except OSError:
+            return None
+        stats.count(stats.COUNTER_BYTES_READ, len(data))
+        return key, data
+
+    def _parse(self, key, data):
+        pref = None
+        if self.snapshot_cache is not None:
+            pref = self.snapshot_cache.get(self.plistpath, key)
+        if pref is None:
+            try:
+                with stats.stage_timer(stats.STAGE_PARSE):
+                    pref = self._loads(data)
+            except (plistlib.InvalidFileException, ExpatError, ValueError):
+                return None
+            if self.snapshot_cache is not None:
+                self.snapshot_cache.put(self.plistpath, key, pref)
+        return pref
+
+    def _load(self):
+        current = self._read_current()
+        if current is None:
+            return None
+        pref = self._parse(*current)
+        if pref is not None:
+            self.digest = content_digest(current[1])
+        return pref
+
+    def refresh(self):
+        current = self._read_current()
+        if current is None:
+            return None
+        digest = content_digest(current[1])
+        if digest == self.digest:
+            # rewritten with the same bytes; nothing to parse or diff
+            self.short_circuited += 1
+            stats.count(stats.COUNTER_SHORT_CIRCUITED)
+            return None
+        pref2 = self._parse(*current)
+        if pref2 is None:
+            # Half-written or already replaced again; a following event
+            # will bring us back here
+            return None
+        domain = byhost = None
+        if self.domain_index is not None:
+            entry = self.domain_index.get(self.plistpath)
+            if entry is not None:
+                domain, byhost = entry.domain, entry.byhost
+        diffs = PrefSniff(self.plistpath, pref1=self.pref, pref2=pref2,
+                          snapshot_cache=self.snapshot_cache,
+                          differ=self.differ, domain=domain, byhost=byhost)
+        # carry the parsed "after" forward as the next "before"
+        with self._lock:
+            self._raw = None
+            self._pref = diffs.pref2
+            self.digest = digest
+        return diffs
+
+
+class PrefsWatchEngine:
+    """
+    Watch any number of plist files with a single long-lived observer.
+
+    Each parent directory is scheduled once on a shared watchdog Observer, and
+    one dispatcher thread routes events to the WatchedPlist they belong to.
+    Change sets for all files are available, merged, via changesets().
+    """
+
+    def __init__(self, watchpaths: Iterable[str] = None, snapshot_cache: SnapshotCache = None,
+                 quiet_period=DebounceScheduler.DEFAULT_QUIET_PERIOD,
+                 max_delay=DebounceScheduler.DEFAULT_MAX_DELAY,
+                 max_pending=DebounceScheduler.DEFAULT_MAXSIZE,
+                 event_filter: PrefsPathFilter = None, event_queue=None,
+                 blob_store: BlobStore = None, domain_index: DomainIndex = None):
+        if snapshot_cache is None:
+            snapshot_cache = SnapshotCache()
+        self.snapshot_cache = snapshot_cache
+        # moves large <data> values out of parsed plists; see blobs.py
+        self.blob_store = blob_store
+        # every watched file's domain, kept current by route_event()
+        if domain_index is None:
+            domain_index = DomainIndex()
+        self.domain_index = domain_index
+        self.watched: Dict[str, WatchedPlist] = {}
+        # (directory, recursive, path filter) for each watched directory,
+        # so plists created after startup are picked up too
+        self._watched_trees = []
+        # files whose parallel baseline hasn't come back yet, and which of
+        # those have seen an event in the meantime
+        self._baselining = set()
+        self._deferred = set()
+        # plistpath -> reason, for files whose baseline couldn't be parsed
+        self.baseline_errors: Dict[str, str] = {}
+        self.baseline_done = threading.Event()
+        self.baseline_done.set()
+        self._lock = threading.Lock()
+        # coalesces each file's burst of events into one diff. A caller
+        # doing its own dispatch (see aio.py) can supply anything with
+        # put() and close() instead
+        if event_queue is None:
+            event_queue = DebounceScheduler(quiet_period=quiet_period,
+                                            max_delay=max_delay,
+                                            maxsize=max_pending)
+        self.scheduler = event_queue
+        # include/exclude patterns, applied by the event handlers before
+        # anything is queued; event_filter.counters has the rejected count
+        self.event_filter = event_filter
+        self._changesets = Queue()
+        self._watched_dirs = {}
+        self._observer = Observer()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch_events, daemon=True)
+        self._running = False
+        self._dispatching = False
+        if watchpaths:
+            self.add_paths(watchpaths)
+
+    def add_paths(self, watchpaths: Iterable[str]) -> List[WatchedPlist]:
+        added = []
+        for plistpath in expand_watchpaths(watchpaths):
+            added.append(self.add_path(plistpath))
+        return added
+
+    def add_path(self, plistpath: str, lazy=False, baseline=None,
+                 digest: ContentDigest = None) -> WatchedPlist:
+        plistpath = os.path.abspath(os.path.expanduser(plistpath))
+        with self._lock:
+            watched = self.watched.get(plistpath)
+            if watched is not None:
+                return watched
+            watched = WatchedPlist(
+                plistpath, snapshot_cache=self.snapshot_cache, lazy=lazy, baseline=baseline,
+                digest=digest, blob_store=self.blob_store, domain_index=self.domain_index)
+            self.watched[plistpath] = watched
+            self._schedule_dir(watched.plist_dir, recursive=False)
+        self.domain_index.add(plistpath)
+        return watched
+
+    def add_directory(self, prefsdir: str, recursive=True, path_filter=is_plist,
+                      baseline=BASELINE_LAZY, max_workers=None):
+        """
+        Watch every plist under `prefsdir`, including ones created later.
+
+        With baseline=BASELINE_LAZY, existing files' bytes are read now and
+        only parsed if they change. With BASELINE_PARALLEL, they're parsed on
+        a process pool in the background; each file is watched as soon as its
+        baseline is ready, and baseline_done is set once all of them are.
+        """
+        prefsdir = os.path.abspath(os.path.expanduser(prefsdir))
+        with self._lock:
+            self._watched_trees.append((prefsdir, recursive, path_filter))
+            self._schedule_dir(prefsdir, recursive=recursive)
+        plistpaths = list(self._scan_directory(
+            prefsdir, recursive, path_filter))
+        if baseline == BASELINE_PARALLEL:
+            with self._lock:
+                self._baselining.update(plistpaths)
+            self.baseline_done.clear()
+            threading.Thread(target=self._baseline_parallel,
+                             args=(plistpaths, max_workers), daemon=True).start()
+        else:
+            for plistpath in plistpaths:
+                self.add_path(plistpath, lazy=True)
+
+    def _baseline_parallel(self, plistpaths, max_workers):
+        snapshotter = BaselineSnapshotter(max_workers=max_workers)
+        for result in snapshotter.snapshot(plistpaths):
+            plistpath = result.plistpath
+            if result.error is None:
+                self.snapshot_cache.put(plistpath, result.key, result.pref)
+                self.add_path(plistpath, baseline=result.pref, digest=result.digest)
+            else:
+                self.baseline_errors[plistpath] = result.error
+                self.add_path(plistpath, lazy=True)
+            with self._lock:
+                self._baselining.discard(plistpath)
+                replay = plistpath in self._deferred
+                self._deferred.discard(plistpath)
+            if replay:
+                # It changed while we were reading it, so we can't tell
+                # which version we got. Diff it again; at worst the diff is
+                # empty
+                self.scheduler.put(("modified", FileModifiedEvent(plistpath)))
+        with self._lock:
+            if not self._baselining:
+                self.baseline_done.set()
+
+    def _scan_directory(self, prefsdir, recursive, path_filter):
+        for dirpath, dirnames, filenames in os.walk(prefsdir):
+            for filename in sorted(filenames):
+                plistpath = os.path.join(dirpath, filename)
+                if path_filter(plistpath) and not os.path.islink(plistpath):
+                    yield plistpath
+            if not recursive:
+                break
+
+    def _schedule_dir(self, plist_dir, recursive=False):
+        # caller holds self._lock
+        for watched_dir, scheduled in self._watched_dirs.items():
+            covered = (watched_dir == plist_dir or
+                       (scheduled.is_recursive and plist_dir.startswith(watched_dir + os.sep)))
+            if covered and (scheduled.is_recursive or not recursive):
+                return
+        scheduled = self._watched_dirs.pop(plist_dir, None)
+        if scheduled is not None:
+            self._observer.unschedule(scheduled)
+        event_handler = PrefChangedEventHandler(
+            None, self.scheduler, event_filter=self.event_filter)
+        self._watched_dirs[plist_dir] = self._observer.schedule(
+            event_handler, plist_dir, recursive=recursive)
+
+    def _in_watched_tree(self, plistpath):
+        for prefsdir, recursive, path_filter in self._watched_trees:
+            if recursive:
+                inside = plistpath.startswith(prefsdir + os.sep)
+            else:
+                inside = os.path.dirname(plistpath) == prefsdir
+            if inside and path_filter(plistpath):
+                return True
+        return False
+
+    def start(self, dispatch=True):
+        # With dispatch=False only the observer runs, and the caller takes
+        # events from self.scheduler and passes them to route_event()
+        if self._running:
+            return
+        self._running = True
+        self._observer.start()
+        if dispatch:
+            self._dispatching = True
+            self._dispatcher.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._observer.stop()
+        self._observer.join()
+        # hand over anything still pending, then wake the dispatcher so it
+        # notices we're done
+        self.scheduler.close()
+        if self._dispatching:
+            self._dispatching = False
+            self._dispatcher.join()
+
+    @property
+    def short_circuited(self):
+        # events dropped because the file's bytes hadn't changed
+        return sum(watched.short_circuited for watched in list(self.watched.values()))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def changesets(self, timeout=0.5):
+        # Poll with a timeout rather than blocking forever so that
+        # KeyboardInterrupt is delivered promptly
+        while self._running or not self._changesets.empty():
+            try:
+                yield self._changesets.get(True, timeout)
+            except QueueEmpty:
+                pass
+
+    def route_event(self, changed) -> WatchedPlist:
+        """
+        The WatchedPlist an ("event_type", event) item should refresh, or
+        None if the event doesn't call for a diff.
+        """
+        event_type, event = changed
+        if not event.is_directory:
+            self._update_index(changed)
+        if event_type not in CHANGE_EVENTS or event.is_directory:
+            return None
+        plistpath = os.path.abspath(event_path(changed))
+        with self._lock:
+            if plistpath in self._baselining:
+                self._deferred.add(plistpath)
+                return None
+            watched = self.watched.get(plistpath)
+            new_plist = watched is None and self._in_watched_tree(plistpath)
+        if new_plist:
+            # created since we started; nothing to diff against
+            watched = self.add_path(plistpath, baseline={})
+        return watched
+
+    def _update_index(self, changed):
+        # A file created or moved into place may have a new owner, or be a
+        # symlink now, so it's resolved again. Modifications change neither.
+        # Files new to the tree are indexed by add_path()
+        event_type, event = changed
+        plistpath = os.path.abspath(event_path(changed))
+        if event_type == "moved":
+            self.domain_index.discard(os.fsdecode(event.src_path))
+        if event_type == "deleted":
+            self.domain_index.discard(plistpath)
+        elif event_type in ("created", "moved") and plistpath in self.watched:
+            self.domain_index.add(plistpath)
+
+    def _dispatch_events(self):
+        while True:
+            changed = self.scheduler.get()
+            if changed is None:
+                break
+            watched = self.route_event(changed)
+            if watched is None:
+                continue
+            diffs = watched.refresh()
+            if diffs is not None:
+                self._changesets.put(diffs)
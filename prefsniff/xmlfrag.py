@@ -0,0 +1,136 @@
+import binascii
+import datetime
+import re
+
+from . import stats
+from .blobs import BlobRef
+
+# Characters str.splitlines() treats as line boundaries
+_LINE_BREAK_CHARS = re.compile("[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+# Same set plistlib refuses to write into a <string>
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _escape_text(text):
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = text.replace("&", "&amp;").replace(
+        "<", "&lt;").replace(">", "&gt;")
+    if not text.isascii():
+        text = text.encode("ascii", "xmlcharrefreplace").decode("ascii")
+    return text
+
+
+def _text_element(tag, text):
+    # The fragments defaults(1) gets have always been produced by
+    # pretty-printing an XML plist, stripping whitespace from every line
+    # and joining the lines. That also strips whitespace around line breaks
+    # inside strings, so the same is done here to keep output identical
+    if _CONTROL_CHARS.search(text) is not None:
+        raise ValueError("strings can't contain control characters; "
+                         "use bytes instead")
+    if _LINE_BREAK_CHARS.search(text) is not None:
+        element = "<%s>%s</%s>" % (tag, text, tag)
+        element = "".join(line.strip() for line in element.splitlines())
+        text = element[len(tag) + 2:-(len(tag) + 3)]
+    if not text:
+        return "<%s />" % tag
+    return "<%s>%s</%s>" % (tag, _escape_text(text), tag)
+
+
+class XmlFragmentRenderer:
+    """
+    Render a plist value as the compact XML fragment defaults(1) accepts,
+    e.g. "<dict><key>a</key><integer>1</integer></dict>".
+
+    Output is written directly from Python objects in one pass. Within one
+    render() call, a container that appears more than once in the value
+    (the same object) is only rendered once. Nothing is kept between calls,
+    so values may be mutated freely between renders.
+    """
+
+    def render(self, value) -> str:
+        with stats.stage_timer(stats.STAGE_XML_RENDER):
+            parts = []
+            # id -> (container, fragment), for this call only
+            self._render(value, parts, {})
+            return "".join(parts)
+
+    def _render(self, value, parts, memo):
+        if isinstance(value, str):
+            parts.append(_text_element("string", value))
+        elif value is True:
+            parts.append("<true />")
+        elif value is False:
+            parts.append("<false />")
+        elif isinstance(value, int):
+            if -1 << 63 <= value < 1 << 64:
+                parts.append("<integer>%d</integer>" % value)
+            else:
+                raise OverflowError(value)
+        elif isinstance(value, float):
+            parts.append("<real>%s</real>" % repr(value))
+        elif isinstance(value, datetime.datetime):
+            parts.append("<date>%04d-%02d-%02dT%02d:%02d:%02dZ</date>" % (
+                value.year, value.month, value.day,
+                value.hour, value.minute, value.second))
+        elif isinstance(value, (dict, list, tuple)):
+            self._render_container(value, parts, memo)
+        elif isinstance(value, (bytes, bytearray)):
+            self._render_data(value, parts)
+        elif isinstance(value, BlobRef):
+            # read back only now
+            self._render_data(value.load(), parts)
+        else:
+            raise TypeError("unsupported type: %s" % type(value))
+
+    def _render_container(self, value, parts, memo):
+        rendered = memo.get(id(value))
+        if rendered is not None:
+            parts.append(rendered[1])
+            return
+        subparts = []
+        if isinstance(value, dict):
+            self._render_dict(value, subparts, memo)
+        else:
+            self._render_array(value, subparts, memo)
+        fragment = "".join(subparts)
+        # holding the container keeps its id from being reused meanwhile
+        memo[id(value)] = (value, fragment)
+        parts.append(fragment)
+
+    def _render_dict(self, value, parts, memo):
+        if not value:
+            parts.append("<dict />")
+            return
+        parts.append("<dict>")
+        # plistlib writes keys sorted, so fragments always have been too
+        for k, v in sorted(value.items()):
+            if not isinstance(k, str):
+                raise TypeError("keys must be strings")
+            parts.append(_text_element("key", k))
+            self._render(v, parts, memo)
+        parts.append("</dict>")
+
+    def _render_array(self, value, parts, memo):
+        if not value:
+            parts.append("<array />")
+            return
+        parts.append("<array>")
+        for v in value:
+            self._render(v, parts, memo)
+        parts.append("</array>")
+
+    def _render_data(self, value, parts):
+        if not value:
+            parts.append("<data />")
+            return
+        encoded = binascii.b2a_base64(value, newline=False).decode("ascii")
+        parts.append("<data>%s</data>" % encoded)
+
+
+_default_renderer = XmlFragmentRenderer()
+
+
+def to_xmlfrag(value) -> str:
+    return _default_renderer.render(value)
@@ -0,0 +1,89 @@
+import os
+import stat
+
+import pytest
+
+from prefsniff.apply import PrefsApplyEngine
+from prefsniff.changetypes import (
+    PSChangeTypeInt,
+    PSChangeTypeKeyDeleted,
+    PSChangeTypeString
+)
+
+STUB = """#!/bin/sh
+echo "$*" >> "$DEFAULTS_LOG"
+[ "$1" = -currentHost ] && shift
+case "$3" in
+fail) echo "can't write $2 $3" >&2; exit 3 ;;
+slow) sleep 0.2 ;;
+esac
+echo "ok $3"
+"""
+
+
+@pytest.fixture
+def defaults_log(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    stub = bindir / "defaults"
+    stub.write_text(STUB)
+    stub.chmod(stub.stat().st_mode | stat.S_IXUSR)
+    log = tmp_path / "log"
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("DEFAULTS_LOG", str(log))
+    return log
+
+
+def _calls(log):
+    return [line.split() for line in log.read_text().splitlines()]
+
+
+def test_results_and_per_domain_order(defaults_log):
+    changes = [PSChangeTypeInt("com.example.a", False, "slow", 1),
+               PSChangeTypeInt("com.example.b", False, "one", 1),
+               PSChangeTypeString("com.example.a", False, "two", "x"),
+               PSChangeTypeKeyDeleted("com.example.b", True, "three"),
+               "not a change",
+               PSChangeTypeInt("com.example.a", False, "four", 4)]
+    results = PrefsApplyEngine(defaults_path="defaults").apply(changes)
+
+    assert [result.change for result in results] == changes
+    assert results[0].argv == ["defaults", "write", "com.example.a", "slow", "-int", "1"]
+    assert results[3].argv == ["defaults", "-currentHost", "delete", "com.example.b", "three"]
+    for result in results[:4] + results[5:]:
+        assert result.returncode == 0
+        assert result.stdout == "ok %s\n" % result.change.key
+        assert result.started is not None and result.elapsed > 0
+    assert results[0].elapsed >= 0.2
+    assert results[4].returncode is None and results[4].stderr == "not a change"
+
+    calls = _calls(defaults_log)
+    # writes to one domain stay in order; the other domain doesn't wait
+    assert [call[2] for call in calls if "com.example.a" in call] == ["slow", "two", "four"]
+    assert calls.index(["write", "com.example.b", "one", "-int", "1"]) < \
+        calls.index(["write", "com.example.a", "two", "-string", "x"])
+
+
+@pytest.mark.parametrize("stop_on_error", [False, True])
+def test_stop_on_error(defaults_log, stop_on_error):
+    changes = [PSChangeTypeInt("com.example.a", False, "fail", 1),
+               PSChangeTypeInt("com.example.a", False, "after", 2),
+               PSChangeTypeInt("com.example.b", False, "other", 3)]
+    results = PrefsApplyEngine(defaults_path="defaults", stop_on_error=stop_on_error).apply(changes)
+
+    assert results[0].returncode == 3
+    assert results[0].stderr == "can't write com.example.a fail\n"
+    if stop_on_error:
+        assert results[1].returncode is None
+        assert results[1].stderr == "skipped after earlier failure"
+    else:
+        assert results[1].returncode == 0
+    # other domains carry on either way
+    assert results[2].returncode == 0
+    assert ("after" in [call[2] for call in _calls(defaults_log)]) is not stop_on_error
+
+
+def test_missing_binary(tmp_path):
+    results = PrefsApplyEngine(defaults_path=str(tmp_path / "nope")).apply(
+        [PSChangeTypeInt("com.example.a", False, "k", 1)])
+    assert results[0].returncode == -1 and results[0].stderr
@@ -0,0 +1,97 @@
+import os
+import plistlib
+import time
+from xml.parsers.expat import ExpatError
+
+import pytest
+
+from prefsniff.blobs import BlobRef, BlobStore
+from prefsniff.watch import WatchedPlist
+
+BIG = bytes(range(256)) * 4
+
+
+def _pref():
+    return {"big": BIG, "small": b"\x01\x02", "nested": {"list": [BIG[::-1], 1, "x"]}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"), threshold=64)
+
+
+@pytest.mark.parametrize("fmt", [plistlib.FMT_BINARY, plistlib.FMT_XML])
+def test_loads(store, fmt):
+    pref = _pref()
+    loaded = store.loads(plistlib.dumps(pref, fmt=fmt))
+    assert loaded == pref
+    assert isinstance(loaded["big"], BlobRef) and loaded["big"].load() == BIG
+    assert isinstance(loaded["nested"]["list"][0], BlobRef)
+    assert type(loaded["small"]) is bytes
+    assert store.stored == 2
+
+
+def test_binary_loads_bypasses_plistlib(store, monkeypatch):
+    data = plistlib.dumps(_pref(), fmt=plistlib.FMT_BINARY)
+
+    def loads(data):
+        raise AssertionError("parsed with plistlib")
+
+    monkeypatch.setattr(plistlib, "loads", loads)
+    assert store.loads(data)["big"] == BIG
+
+
+@pytest.mark.parametrize("data", [
+    b"bplist00",
+    plistlib.dumps(_pref(), fmt=plistlib.FMT_BINARY)[:-40],
+    b"<?xml version",
+])
+def test_loads_invalid(store, data):
+    with pytest.raises((plistlib.InvalidFileException, ExpatError, ValueError)):
+        store.loads(data)
+
+
+def test_put_refreshes_blob(store):
+    ref = store.put(BIG)
+    os.utime(ref.path, (0, 0))
+    assert store.put(BIG) == ref and store.stored == 1
+    assert os.stat(ref.path).st_mtime > time.time() - 60
+
+
+def test_prune(store):
+    kept, used, stale = store.put(BIG), store.put(BIG[::-1]), store.put(BIG * 2)
+    os.utime(kept.path, (0, 0))
+    os.utime(stale.path, (0, 0))
+    leftover = os.path.join(os.path.dirname(stale.path), ".blob-x")
+    unrelated = os.path.join(store.path, "notes.txt")
+    for path in (leftover, unrelated):
+        with open(path, "wb"):
+            pass
+    assert store.prune(keep=[kept.digest], max_age=3600) == 1
+    assert not os.path.exists(stale.path)
+    assert os.path.exists(kept.path) and os.path.exists(used.path)
+    assert os.path.exists(leftover) and os.path.exists(unrelated)
+    # only removed once old enough
+    os.utime(leftover, (0, 0))
+    assert store.prune(keep=[kept.digest], max_age=3600) == 0
+    assert not os.path.exists(leftover)
+    assert store.prune() == 2
+    assert os.path.exists(unrelated)
+    assert sorted(os.listdir(store.path)) == ["notes.txt"]
+
+
+def test_prune_missing_store(tmp_path):
+    assert BlobStore(str(tmp_path / "nothing")).prune() == 0
+
+
+def test_watched_binary_plist_goes_to_store(store, tmp_path):
+    plistpath = tmp_path / "com.example.one.plist"
+    with open(plistpath, "wb") as f:
+        plistlib.dump({"big": BIG}, f, fmt=plistlib.FMT_BINARY)
+    watched = WatchedPlist(str(plistpath), blob_store=store)
+    assert isinstance(watched.pref["big"], BlobRef)
+    with open(plistpath, "wb") as f:
+        plistlib.dump({"big": BIG[::-1]}, f, fmt=plistlib.FMT_BINARY)
+    diffs = watched.refresh()
+    assert len(diffs.changes) == 1
+    assert isinstance(watched.pref["big"], BlobRef) and watched.pref["big"] == BIG[::-1]
@@ -0,0 +1,142 @@
+import datetime
+import plistlib
+import random
+
+import pytest
+
+from prefsniff.bplist import (
+    BinaryPlistReader,
+    LazyArray,
+    LazyData,
+    LazyDict,
+    lazy_equal,
+    load_lazy,
+    materialize
+)
+
+
+def _lazy(value):
+    return BinaryPlistReader(plistlib.dumps(value, fmt=plistlib.FMT_BINARY, sort_keys=False)).top()
+
+
+def _strict_equal(a, b):
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_strict_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_strict_equal(v, w) for v, w in zip(a, b))
+    return a == b
+
+
+def _round_trip(value):
+    data = plistlib.dumps(value, fmt=plistlib.FMT_BINARY, sort_keys=False)
+    decoded = materialize(BinaryPlistReader(data).top())
+    assert _strict_equal(decoded, plistlib.loads(data))
+    return decoded
+
+
+@pytest.mark.parametrize("value", [
+    0, 1, 255, 256, 65535, 65536, 2 ** 31, 2 ** 32, 2 ** 63 - 1, 2 ** 63, 2 ** 64 - 1,
+    -1, -255, -65536, -2 ** 31, -2 ** 63,
+])
+def test_int_widths(value):
+    assert _round_trip({"i": value, "l": [value]})["i"] == value
+
+
+@pytest.mark.parametrize("value", [
+    "", "ascii", "héllo", "日本語", "emoji \U0001F600 outside the BMP", " ", "x" * 14, "x" * 15,
+])
+def test_strings(value):
+    assert _round_trip([value]) == [value]
+
+
+@pytest.mark.parametrize("length", [14, 15, 16, 255, 256, 65535, 65536])
+def test_long_length_markers(length):
+    value = {"s": "a" * length, "u": "é" * length, "d": b"\x01" * length,
+             "a": list(range(min(length, 1000)))}
+    _round_trip(value)
+
+
+def test_other_types():
+    value = {"t": True, "f": False, "r": 1.5, "z": 0.0, "n": -2.25,
+             "date": datetime.datetime(2023, 2, 13, 12, 30, 1), "old": datetime.datetime(1970, 1, 1),
+             "data": b"\x00\xff", "empty": b"", "uid": plistlib.UID(7), "e": {}, "el": []}
+    _round_trip(value)
+
+
+def test_many_objects():
+    # more than 255 and 65535 objects, so wider object references
+    _round_trip({"k%d" % i: "v%d" % i for i in range(300)})
+    _round_trip([{"k": "v%d" % i, "n": i} for i in range(40000)])
+
+
+def _random_value(rng, depth):
+    kind = rng.randrange(10 if depth < 4 else 8)
+    if kind == 0:
+        return rng.choice([True, False])
+    if kind == 1:
+        return rng.choice([rng.randrange(-2 ** 63, 2 ** 64), rng.randrange(-300, 300)])
+    if kind == 2:
+        return rng.uniform(-1e9, 1e9)
+    if kind == 3:
+        return "".join(rng.choice("abé日\U0001F600") for _ in range(rng.randrange(40)))
+    if kind == 4:
+        return rng.randbytes(rng.randrange(40))
+    if kind == 5:
+        return datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=rng.randrange(10 ** 9))
+    if kind in (6, 7):
+        return "k%d" % rng.randrange(5)
+    if kind == 8:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randrange(20))]
+    return {"k%d" % i: _random_value(rng, depth + 1) for i in range(rng.randrange(20))}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_plists(seed):
+    rng = random.Random(seed)
+    _round_trip({"root": _random_value(rng, 0)})
+
+
+def test_lazy_views():
+    top = _lazy({"d": {"a": [1, b"xy"]}, "s": "s"})
+    assert isinstance(top, LazyDict) and sorted(top) == ["d", "s"]
+    assert isinstance(top["d"]["a"], LazyArray)
+    data = top["d"]["a"][1]
+    assert isinstance(data, LazyData) and len(data) == 2 and bytes(data) == b"xy"
+    assert top["d"]["a"][:1] == [1]
+
+
+@pytest.mark.parametrize("a, b, equal", [
+    ({"a": 1}, {"a": 1}, True),
+    ({"a": 1, "b": [1, "x"]}, {"b": [1, "x"], "a": 1}, True),
+    ({"a": 1}, {"a": True}, False),
+    ({"a": 1}, {"a": 1.0}, False),
+    ({"a": [0]}, {"a": [False]}, False),
+    ({"a": {"b": 1}}, {"a": {"b": 2}}, False),
+    ({"a": 1}, {"a": 1, "b": 1}, False),
+    ({"a": b"\x00"}, {"a": b"\x00"}, True),
+    ({"a": b"\x00"}, {"a": "\x00"}, False),
+    ({"a": "é" * 20}, {"a": "é" * 20}, True),
+    ({"a": 300}, {"a": 300}, True),
+])
+def test_lazy_equal(a, b, equal):
+    assert lazy_equal(_lazy(a), _lazy(b)) is equal
+    # and against ordinary values
+    assert lazy_equal(_lazy(a), b) is equal
+    assert lazy_equal(a, _lazy(b)) is equal
+
+
+def test_load_lazy(tmp_path):
+    binary, xml = tmp_path / "b.plist", tmp_path / "x.plist"
+    binary.write_bytes(plistlib.dumps({"a": [1]}, fmt=plistlib.FMT_BINARY))
+    xml.write_bytes(plistlib.dumps({"a": [1]}))
+    assert isinstance(load_lazy(str(binary)), LazyDict)
+    assert materialize(load_lazy(str(binary), use_mmap=False)) == {"a": [1]}
+    assert load_lazy(str(xml)) == {"a": [1]}
+
+
+@pytest.mark.parametrize("data", [b"", b"bplist00", b"bplist00" + b"\x00" * 40, b"<plist/>"])
+def test_invalid(data):
+    with pytest.raises(plistlib.InvalidFileException):
+        BinaryPlistReader(data)
@@ -0,0 +1,49 @@
+import copy
+import pickle
+
+import pytest
+
+from prefsniff.changetypes import (
+    PSChangeTypeArray,
+    PSChangeTypeArrayAdd,
+    PSChangeTypeBool,
+    PSChangeTypeData,
+    PSChangeTypeDict,
+    PSChangeTypeDictAdd,
+    PSChangeTypeDictMerge,
+    PSChangeTypeFloat,
+    PSChangeTypeInt,
+    PSChangeTypeKeyDeleted,
+    PSChangeTypeString
+)
+
+CHANGES = [
+    lambda: PSChangeTypeString("com.example", False, "k", "value with spaces"),
+    lambda: PSChangeTypeKeyDeleted("com.example", False, "k"),
+    lambda: PSChangeTypeFloat("com.example", False, "k", 2.5),
+    lambda: PSChangeTypeInt("com.example", True, "k", 5),
+    lambda: PSChangeTypeBool("com.example", False, "k", True),
+    lambda: PSChangeTypeArray("com.example", False, "k", [1, "two", {"three": 3.0}]),
+    lambda: PSChangeTypeArrayAdd("com.example", False, "k", ["a", "b"]),
+    lambda: PSChangeTypeDict("com.example", False, "k", {"a": [1, 2], "b": {"c": True}}),
+    lambda: PSChangeTypeDictAdd("com.example", False, "k", "subkey", {"a": 1}),
+    lambda: PSChangeTypeDictMerge("com.example", False, "k", {"a": 1, "b": "two"}),
+    lambda: PSChangeTypeData("com.example", False, "k", b"\x00\x01binary"),
+]
+
+
+@pytest.mark.parametrize("make_change", CHANGES)
+@pytest.mark.parametrize("rendered", [False, True])
+@pytest.mark.parametrize("clone", [lambda ch: pickle.loads(pickle.dumps(ch)), copy.deepcopy, copy.copy],
+                         ids=["pickle", "deepcopy", "copy"])
+def test_copies_render_like_the_original(make_change, rendered, clone):
+    original = make_change()
+    if rendered:
+        original.shell_command()
+    copied = clone(original)
+    fresh = make_change()
+    assert type(copied) is type(fresh)
+    assert copied.shell_command() == fresh.shell_command()
+    assert copied.argv(quote=False) == fresh.argv(quote=False)
+    assert copied.converted_value == fresh.converted_value
+    assert getattr(copied, "subkey", None) == getattr(fresh, "subkey", None)
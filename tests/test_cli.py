@@ -0,0 +1,12 @@
+from prefsniff.prefsniff import parse_args
+
+
+def test_stats_flag_does_not_take_the_watchpath():
+    args = parse_args(["--stats", "x.plist"])
+    assert args.stats and args.stats_interval == 0
+    assert args.watchpath == ["x.plist"]
+
+
+def test_stats_interval():
+    args = parse_args(["--stats-interval", "30", "x.plist"])
+    assert not args.stats and args.stats_interval == 30
@@ -0,0 +1,165 @@
+import json
+import plistlib
+import socket
+import threading
+import time
+
+import pytest
+
+from prefsniff.daemon import DaemonClient, PrefsDaemon, _Client, _encode
+from prefsniff.domains import DomainIndex
+from prefsniff.exceptions import PrefsDaemonException
+from prefsniff.prefsniff import PrefSniff
+from prefsniff.watch import PrefsWatchEngine, WatchedPlist
+
+
+@pytest.fixture
+def prefsdir(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    # root's plists are addressed by path rather than by domain
+    monkeypatch.setattr(DomainIndex, "owner", lambda self, uid: "tester")
+    prefsdir = tmp_path / "Library" / "Preferences"
+    prefsdir.mkdir(parents=True)
+    for domain, pref in (("com.example.one", {"a": 1}), ("com.example.two", {"b": "x"})):
+        with open(prefsdir / (domain + ".plist"), "wb") as f:
+            plistlib.dump(pref, f)
+    return prefsdir
+
+
+@pytest.fixture
+def daemon(prefsdir, tmp_path):
+    engine = PrefsWatchEngine()
+    engine.add_paths([str(prefsdir / "*.plist")])
+    with PrefsDaemon(engine, str(tmp_path / "d.sock")) as daemon:
+        yield daemon
+
+
+def _connect(daemon):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(daemon.socket_path)
+    sock.settimeout(5)
+    return sock, sock.makefile("rb")
+
+
+def _changeset(prefsdir, domain, pref1, pref2):
+    return PrefSniff(str(prefsdir / (domain + ".plist")), pref1=pref1, pref2=pref2,
+                     domain=domain, byhost=False)
+
+
+def test_snapshot_and_list(daemon, prefsdir):
+    with DaemonClient(daemon.socket_path) as client:
+        reply = client.snapshot(domain="com.example.one")
+        assert reply["plist"] == str(prefsdir / "com.example.one.plist")
+        assert reply["value"] == {"a": 1}
+        reply = client.snapshot(plistpath=str(prefsdir / "com.example.two.plist"))
+        assert (reply["domain"], reply["value"]) == ("com.example.two", {"b": "x"})
+        assert [p["domain"] for p in client.plists()] == ["com.example.one", "com.example.two"]
+        with pytest.raises(PrefsDaemonException, match="No watched plist"):
+            client.snapshot(domain="com.example.none")
+
+
+def test_bad_requests_get_errors(daemon):
+    sock, replies = _connect(daemon)
+    with sock, replies:
+        for request in (b"not json\n", b"[1]\n", b'{"op": "frobnicate"}\n',
+                        b'{"op": "subscribe", "include": ["re:("]}\n'):
+            sock.sendall(request)
+            assert json.loads(replies.readline())["op"] == "error"
+        sock.sendall(b'{"op": "list"}\n')
+        assert json.loads(replies.readline())["op"] == "list"
+
+
+def test_unexpected_failure_closes_only_that_connection(daemon):
+    sock, replies = _connect(daemon)
+    with sock, replies:
+        # too deeply nested for the JSON decoder
+        sock.sendall(b"[" * 30000 + b"]" * 30000 + b"\n")
+        reply = json.loads(replies.readline())
+        assert reply["op"] == "error" and "RecursionError" in reply["error"]
+        assert replies.readline() == b""
+    with DaemonClient(daemon.socket_path) as client:
+        assert len(client.plists()) == 2
+
+
+def test_subscription_filters(daemon, prefsdir):
+    subscribers = []
+    for request in ({"op": "subscribe"},
+                    {"op": "subscribe", "include": ["com.example.one"]},
+                    {"op": "subscribe", "exclude": ["re:example\\.one"]},
+                    {"op": "subscribe", "paths": [str(prefsdir / "*two*")]}):
+        sock, replies = _connect(daemon)
+        sock.sendall(_encode(request))
+        assert json.loads(replies.readline()) == {"op": "subscribe"}
+        subscribers.append((sock, replies))
+    daemon.publish(_changeset(prefsdir, "com.example.one", {"a": 1}, {"a": 2}))
+    daemon.publish(_changeset(prefsdir, "com.example.two", {"b": "x"}, {"b": "y"}))
+    daemon.publish(_changeset(prefsdir, "com.example.two", {"b": "y"}, {"b": "y"}))
+    received = []
+    for sock, replies in subscribers:
+        sock.sendall(b'{"op": "list"}\n')
+        domains = []
+        while True:
+            record = json.loads(replies.readline())
+            if record.get("op") == "list":
+                break
+            domains.append(record["domain"])
+        received.append(domains)
+        replies.close()
+        sock.close()
+    assert received == [["com.example.one", "com.example.two"], ["com.example.one"],
+                        ["com.example.two"], ["com.example.two"]]
+    assert daemon.published == 2
+
+
+class _FakeSocket:
+    def __init__(self):
+        self.sent = bytearray()
+        self.room = 0
+
+    def send(self, data):
+        sent = min(len(data), self.room)
+        self.room -= sent
+        self.sent += data[:sent]
+        return sent
+
+
+def test_slow_client_gets_an_overflow_notice():
+    sock = _FakeSocket()
+    client = _Client(sock, max_buffer=100)
+    record = b"x" * 59 + b"\n"
+    # nothing queued, so the first always goes in whatever its size
+    assert client.queue(record * 3, "/p/one.plist")
+    assert not client.queue(record, "/p/two.plist")
+    assert not client.queue(record, "/p/one.plist")
+    # replies aren't dropped
+    assert client.queue(b"{}\n")
+    sock.room = 100
+    client.send()
+    assert not client.queue(record, "/p/two.plist")
+    sock.room = 10000
+    client.send()
+    lines = bytes(sock.sent).splitlines()
+    assert lines[:4] == [record.strip()] * 3 + [b"{}"]
+    assert json.loads(lines[4]) == {"op": "overflow", "changesets": 3,
+                                    "plists": ["/p/one.plist", "/p/two.plist"]}
+    assert client.buffered == 0 and not client.dropped
+    assert client.queue(record, "/p/one.plist")
+
+
+def test_pref_is_parsed_once_across_threads(prefsdir, monkeypatch):
+    loads = plistlib.loads
+
+    def slow_loads(data):
+        time.sleep(0.05)
+        return loads(data)
+
+    watched = WatchedPlist(str(prefsdir / "com.example.one.plist"), lazy=True)
+    monkeypatch.setattr(plistlib, "loads", slow_loads)
+    prefs = []
+    threads = [threading.Thread(target=lambda: prefs.append(watched.pref)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert prefs == [{"a": 1}] * 4
+    assert all(pref is prefs[0] for pref in prefs)
@@ -0,0 +1,110 @@
+import datetime
+import plistlib
+
+import pytest
+
+from benchmarks.plistgen import generate_plist, mutate
+from prefsniff.blobs import BlobStore
+from prefsniff.bplist import load_lazy
+from prefsniff.diff import ADDED, MODIFIED, REMOVED, PlistDiffer, values_equal
+from prefsniff.prefsniff import PrefSniff
+
+
+def _strict_equal(a, b):
+    # reference implementation
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_strict_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_strict_equal(v, w) for v, w in zip(a, b))
+    return a == b
+
+
+@pytest.mark.parametrize("a, b", [
+    (True, 1),
+    (1, 1.0),
+    (False, 0.0),
+    ({"a": [1, {"b": True}]}, {"a": [1, {"b": 1}]}),
+    ([1, 2, 3], [1, 2, 3.0]),
+])
+def test_values_of_different_plist_types_differ(a, b):
+    assert a == b
+    assert not values_equal(a, b)
+    assert PlistDiffer().diff({"k": a}, {"k": b})
+
+
+def test_key_order_is_ignored():
+    a = {"x": 1, "y": True, "z": {"p": [1, 2], "q": "s"}}
+    b = {"z": {"q": "s", "p": [1, 2]}, "y": True, "x": 1}
+    assert values_equal(a, b)
+    assert PlistDiffer().diff(a, b) == []
+    assert not values_equal(a, dict(b, y=1))
+
+
+def test_changes_are_reported_by_key_path():
+    before = {"same": {"a": 1}, "changed": {"a": {"b": 1, "c": 2}}, "gone": 1,
+              "date": datetime.datetime(2023, 1, 1)}
+    after = {"same": {"a": 1}, "changed": {"a": {"b": 1, "c": 3}}, "new": b"\x00",
+             "date": datetime.datetime(2023, 1, 1)}
+    changes = {(ch.kind, ch.path) for ch in PlistDiffer().diff(before, after)}
+    assert changes == {(MODIFIED, ("changed", "a", "c")), (ADDED, ("new",)), (REMOVED, ("gone",))}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_reference_equality(seed):
+    before = generate_plist(keys=40, depth=3, seed=seed)
+    after = mutate(before, seed=seed + 100)
+    # round trip so no objects are shared between the two sides
+    before = plistlib.loads(plistlib.dumps(before))
+    after = plistlib.loads(plistlib.dumps(after))
+    for key in before.keys() & after.keys():
+        assert values_equal(before[key], after[key]) == _strict_equal(before[key], after[key])
+    changed = {ch.path[0] for ch in PlistDiffer().diff(before, after)}
+    expected = {k for k in before.keys() | after.keys()
+                if k not in before or k not in after or not _strict_equal(before[k], after[k])}
+    assert changed == expected
+
+
+def test_lazy_plists(tmp_path):
+    lazy = []
+    for name, pref in (("before", {"a": {"b": [1, 2, 3]}, "c": b"\x00" * 100}),
+                       ("after", {"a": {"b": [1, 2, 4]}, "c": b"\x00" * 100})):
+        path = tmp_path / (name + ".plist")
+        path.write_bytes(plistlib.dumps(pref, fmt=plistlib.FMT_BINARY))
+        lazy.append(load_lazy(str(path)))
+    lazy_before, lazy_after = lazy
+    assert [ch.path for ch in PlistDiffer().diff(lazy_before, lazy_after)] == [("a", "b")]
+
+
+def test_blob_refs_equal_their_bytes(tmp_path):
+    store = BlobStore(str(tmp_path), threshold=10)
+    data = bytes(range(100))
+    externalized = store.externalize({"d": [data], "e": data})
+    assert values_equal({"d": [data], "e": data}, externalized)
+    assert not values_equal({"d": [data[:-1]], "e": data}, externalized)
+
+
+def test_array_edits():
+    edits = PlistDiffer().array_edits([1, 2, 3, 4], [1, 3, 4, 5])
+    assert [(e.op, e.index) for e in edits] == [("delete", 1), ("insert", 3)]
+    assert PlistDiffer().array_edits([1, True], [1, True]) == []
+    assert PlistDiffer().array_edits([True], [1])
+
+
+@pytest.mark.parametrize("before, after, paths", [
+    ({"x": {"p": 1}, "y": {"p": True}}, {"y": {"p": 1}, "x": {"p": True}}, {("x", "p"), ("y", "p")}),
+    ({"x": [1], "y": [1.0]}, {"y": [1], "x": [1.0]}, {("x",), ("y",)}),
+])
+def test_reordered_keys_are_compared_by_key(before, after, paths):
+    assert not values_equal(before, after)
+    assert {ch.path for ch in PlistDiffer().diff(before, after)} == paths
+
+
+def test_reordered_equal_plists():
+    before = {"top": {"x": {"p": 1}, "y": {"q": True}}}
+    after = {"top": {"y": {"q": True}, "x": {"p": 1}}}
+    assert values_equal(before, after)
+    assert PlistDiffer().diff(before, after) == []
+    diffs = PrefSniff(None, pref1=before, pref2=after, domain="d", byhost=False)
+    assert diffs.changes == []
@@ -0,0 +1,103 @@
+import os
+import plistlib
+
+import pytest
+
+from prefsniff.domains import DomainIndex
+
+HOST_UUID = "000E4DFD-62C8-5DC5-A2A4-42AFE04AAB87"
+
+
+@pytest.fixture
+def prefsdir(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    # root's plists are addressed by path rather than by domain
+    monkeypatch.setattr(DomainIndex, "owner", lambda self, uid: "tester")
+    prefsdir = tmp_path / "Library" / "Preferences"
+    (prefsdir / "ByHost").mkdir(parents=True)
+    for name in ("com.example.one.plist",
+                 ".GlobalPreferences.plist",
+                 "ByHost/com.example.one.%s.plist" % HOST_UUID,
+                 "ByHost/com.example.two.%s.plist" % HOST_UUID,
+                 "notes.txt"):
+        with open(prefsdir / name, "wb") as f:
+            plistlib.dump({}, f)
+    return prefsdir
+
+
+def test_add_and_discard(prefsdir):
+    index = DomainIndex()
+    plistpath = str(prefsdir / "com.example.one.plist")
+    entry = index.add(plistpath)
+    assert (entry.domain, entry.byhost, entry.owner) == ("com.example.one", False, "tester")
+    assert plistpath in index and len(index) == 1
+    assert index.get(plistpath) is entry
+    index.discard(plistpath)
+    assert plistpath not in index
+    assert index.path_for("com.example.one") is None
+    index.discard(plistpath)
+
+
+def test_add_missing_file_forgets_it(prefsdir):
+    index = DomainIndex()
+    plistpath = prefsdir / "com.example.one.plist"
+    index.add(str(plistpath))
+    plistpath.unlink()
+    assert index.add(str(plistpath)) is None
+    assert str(plistpath) not in index
+    assert index.entries_for("com.example.one") == []
+
+
+def test_get_resolves_once(prefsdir):
+    index = DomainIndex()
+    plistpath = str(prefsdir / "com.example.one.plist")
+    assert index.get(plistpath).domain == "com.example.one"
+    index.get(plistpath)
+    assert index.resolved == 1
+    assert index.get(str(prefsdir / "com.example.gone.plist")) is None
+
+
+def test_scan(prefsdir):
+    index = DomainIndex()
+    assert index.scan(str(prefsdir), recursive=False) == 2
+    assert index.scan(str(prefsdir)) == 4
+    assert len(index) == 4
+    assert index.path_for("NSGlobalDomain") == str(prefsdir / ".GlobalPreferences.plist")
+
+
+def test_byhost_reverse_lookup(prefsdir):
+    index = DomainIndex()
+    index.scan(str(prefsdir))
+    plain = str(prefsdir / "com.example.one.plist")
+    byhost = str(prefsdir / "ByHost" / ("com.example.one.%s.plist" % HOST_UUID))
+    assert index.path_for("com.example.one") == plain
+    assert index.path_for("com.example.one", byhost=True) == byhost
+    # in path order, both kinds
+    assert [(e.plistpath, e.byhost) for e in index.entries_for("com.example.one")] == [
+        (byhost, True), (plain, False)]
+    # only a ByHost file backs com.example.two
+    assert index.path_for("com.example.two") is None
+    [entry] = index.entries_for("com.example.two", byhost=True)
+    assert entry.byhost and entry.domain == "com.example.two"
+
+
+def test_moved_file_is_reindexed(prefsdir):
+    index = DomainIndex()
+    src = prefsdir / "com.example.one.plist"
+    dest = prefsdir / "com.example.renamed.plist"
+    index.add(str(src))
+    os.rename(src, dest)
+    index.discard(str(src))
+    index.add(str(dest))
+    assert index.path_for("com.example.one") is None
+    assert index.path_for("com.example.renamed") == str(dest)
+
+
+def test_symlink_is_resolved_to_its_target(prefsdir, tmp_path):
+    target = tmp_path / "elsewhere.plist"
+    with open(target, "wb") as f:
+        plistlib.dump({}, f)
+    link = prefsdir / "com.example.link.plist"
+    os.symlink(target, link)
+    entry = DomainIndex().add(str(link))
+    assert entry.real_path == os.path.realpath(str(target))
@@ -0,0 +1,52 @@
+import pytest
+
+from prefsniff.filters import PrefsPathFilter
+
+
+@pytest.mark.parametrize("includes, excludes, basename, passes", [
+    ((), (), "com.apple.dock.plist", True),
+    (["com.apple.dock"], (), "com.apple.dock.plist", True),
+    (["com.apple.dock"], (), "com.apple.dockling.plist", False),
+    (["NSGlobalDomain"], (), ".GlobalPreferences.plist", True),
+    (["com.apple.*"], ["com.apple.dock"], "com.apple.dock.plist", False),
+    (["com.apple.*"], ["com.apple.dock"], "com.apple.finder.plist", True),
+    (["glob:*.dock.plist"], (), "com.apple.dock.plist", True),
+    # inline flags apply to their own pattern only
+    (["com.example.app", "re:(?i)DOCK"], (), "com.apple.dock.plist", True),
+    (["com.example.app", "re:(?i)DOCK"], (), "com.example.app.plist", True),
+    (["re:(?i)DOCK", "re:Finder"], (), "com.apple.finder.plist", False),
+    # backreferences count groups within their own pattern
+    (["re:(a)x", "re:(b)\\1"], (), "com.bb.plist", True),
+    (["re:(a)x", "re:(b)\\1"], (), "com.ba.plist", False),
+    ((), ["re:(?x) dock  # spaces ignored"], "com.apple.dock.plist", False),
+    ((), ["re:(?x) dock", "com.apple.finder"], "com.apple.finder.plist", False),
+])
+def test_matches(includes, excludes, basename, passes):
+    assert PrefsPathFilter(includes, excludes).matches(basename) is passes
+
+
+def test_counters():
+    path_filter = PrefsPathFilter(["com.apple.dock"])
+    assert path_filter
+    assert not PrefsPathFilter()
+    assert path_filter(b"/prefs/com.apple.dock.plist")
+    assert not path_filter("/prefs/com.apple.finder.plist")
+    assert path_filter.counters == {"accepted": 1, "rejected": 1}
+
+
+@pytest.mark.parametrize("path, passes", [
+    ("/prefs/com.apple.plist", False),
+    # other domains whose last label happens to be hex letters
+    ("/prefs/com.apple.ad.plist", True),
+    ("/prefs/com.apple.face.plist", True),
+    ("/prefs/ByHost/com.apple.face.plist", True),
+    # host suffixes, only in ByHost
+    ("/prefs/ByHost/com.apple.0E4DFD62-C85D-4C5A-A2A4-42AFE04AAB87.plist", False),
+    ("/prefs/ByHost/com.apple.000e4dfd62c8.plist", False),
+    ("/prefs/com.apple.000e4dfd62c8.plist", True),
+    ("/prefs/ByHost/com.apple.000e4dfd.plist", True),
+])
+def test_byhost_suffix(path, passes):
+    path_filter = PrefsPathFilter(excludes=["com.apple"])
+    assert path_filter.matches_path(path) is passes
+    assert path_filter(path) is passes
@@ -0,0 +1,30 @@
+import json
+
+from prefsniff.blobs import BlobStore
+from prefsniff.output import NdjsonChangeSetWriter
+from prefsniff.prefsniff import PrefSniff
+
+
+def _records(pref1, pref2):
+    diffs = PrefSniff(None, pref1=pref1, pref2=pref2, domain="com.example.app", byhost=False)
+    return [json.loads(line) for line in "".join(NdjsonChangeSetWriter().format_changeset(diffs)).splitlines()]
+
+
+def test_record():
+    record, = _records({"a": 1}, {"a": 2})
+    assert record["argv"] == ["defaults", "write", "com.example.app", "a", "-int", "2"]
+    assert record["value"] == 2 and "blob" not in record
+
+
+def test_blob_is_not_inlined(tmp_path):
+    store = BlobStore(str(tmp_path), threshold=16)
+    data = bytes(range(256)) * 4
+    after = store.externalize({"d": data, "small": b"\x01"})
+    records = {tuple(r["key_path"]): r for r in _records({}, after)}
+    record = records[("d",)]
+    assert record["argv"] == ["defaults", "write", "com.example.app", "d", "-data", "$blob"]
+    assert record["value"]["path"] == record["blob"] and record["value"]["size"] == len(data)
+    with open(record["blob"], "rb") as f:
+        assert f.read() == data
+    assert data.hex() not in json.dumps(record)
+    assert records[("small",)]["argv"][-1] == "01"
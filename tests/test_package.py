@@ -0,0 +1,10 @@
+import types
+
+import prefsniff
+import prefsniff.watch
+
+
+def test_submodules_are_not_shadowed():
+    assert isinstance(prefsniff.watch, types.ModuleType)
+    assert prefsniff.watch.PrefsWatchEngine
+    assert isinstance(prefsniff.awatch(["/nonexistent.plist"]), prefsniff.AsyncPrefsWatch)
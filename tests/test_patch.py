@@ -0,0 +1,45 @@
+import copy
+
+import pytest
+
+from prefsniff.exceptions import PlistPatchException
+from prefsniff.patch import (
+    EDIT_APPEND,
+    EDIT_DELETE,
+    EDIT_INSERT,
+    OP_ARRAY_EDIT,
+    OP_DELETE,
+    OP_DICT_MERGE,
+    OP_SET,
+    PatchOp,
+    apply_op
+)
+
+
+def test_apply_ops():
+    pref = {"a": {"b": 1}, "l": [1, 2, 3]}
+    apply_op(pref, PatchOp(OP_SET, ["a", "c"], [True]))
+    apply_op(pref, PatchOp(OP_DELETE, ["a", "b"], None))
+    apply_op(pref, PatchOp(OP_DICT_MERGE, ["d"], {"x": 1}))
+    edits = [(EDIT_DELETE, 0, 1), (EDIT_INSERT, 1, [9]), (EDIT_APPEND, [4])]
+    apply_op(pref, PatchOp(OP_ARRAY_EDIT, ["l"], edits))
+    assert pref == {"a": {"c": [True]}, "d": {"x": 1}, "l": [2, 9, 3, 4]}
+    with pytest.raises(PlistPatchException):
+        apply_op(pref, PatchOp(OP_SET, [], 1))
+
+
+@pytest.mark.parametrize("op", [
+    PatchOp(OP_SET, ["k"], {"v": [1]}),
+    PatchOp(OP_DICT_MERGE, ["k"], {"v": [1]}),
+    PatchOp(OP_ARRAY_EDIT, ["k"], [(EDIT_APPEND, [{"v": [1]}])]),
+])
+def test_applied_values_are_not_shared(op):
+    original = copy.deepcopy(op.value)
+    first, second = {}, {}
+    apply_op(first, op)
+    apply_op(second, op)
+    assert first == second
+    first_value = first["k"] if isinstance(first["k"], dict) else first["k"][0]
+    first_value["v"].append(2)
+    assert second != first
+    assert op.value == original
@@ -0,0 +1,136 @@
+import threading
+from collections import namedtuple
+from queue import Empty as QueueEmpty
+
+import pytest
+
+from prefsniff import scheduler
+from prefsniff.scheduler import DebounceScheduler
+
+Event = namedtuple("Event", ["src_path", "dest_path"])
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(scheduler, "time", clock)
+    return clock
+
+
+def _item(path, event_type="modified"):
+    if event_type == "moved":
+        return (event_type, Event("/tmp/x", path))
+    return (event_type, Event(path, None))
+
+
+def _get(events):
+    try:
+        return events.get(block=False)
+    except QueueEmpty:
+        return None
+
+
+def test_coalesces_within_quiet_period(clock):
+    events = DebounceScheduler(quiet_period=1, max_delay=10)
+    events.put(_item("/p/a.plist", "created"))
+    clock.now += 0.5
+    events.put(_item("/p/a.plist", "modified"))
+    clock.now += 0.5
+    last = _item("/p/a.plist", "moved")
+    events.put(last)
+    clock.now += 0.75
+    assert _get(events) is None
+    clock.now += 0.25
+    # the most recent event of the burst, once
+    assert _get(events) is last
+    assert _get(events) is None
+    assert events.counters == {"received": 3, "coalesced": 2, "dropped": 0,
+                               "overflows": 0, "pending": 0}
+
+
+def test_paths_are_kept_apart(clock):
+    events = DebounceScheduler(quiet_period=1)
+    a, b = _item("/p/a.plist"), _item("/p/b.plist")
+    events.put(a)
+    clock.now += 0.5
+    events.put(b)
+    clock.now += 0.5
+    assert _get(events) is a
+    assert _get(events) is None
+    clock.now += 0.5
+    assert _get(events) is b
+
+
+def test_max_delay_flushes_a_busy_path(clock):
+    events = DebounceScheduler(quiet_period=1, max_delay=4)
+    for _ in range(5):
+        events.put(_item("/p/a.plist"))
+        assert _get(events) is None
+        clock.now += 0.75
+    last = _item("/p/a.plist")
+    events.put(last)
+    # quiet for only 0.25s, but 4s since the first event
+    clock.now += 0.25
+    assert _get(events) is last
+    assert events.coalesced == 5
+
+
+def test_overflow_expedites_the_oldest_path(clock):
+    events = DebounceScheduler(quiet_period=1, maxsize=2)
+    a, b = _item("/p/a.plist"), _item("/p/b.plist")
+    events.put(a)
+    clock.now += 0.5
+    events.put(b)
+    # already pending paths still coalesce when full
+    events.put(_item("/p/b.plist"))
+    events.put(_item("/p/c.plist"), block=False)
+    assert events.counters == {"received": 4, "coalesced": 1, "dropped": 1,
+                               "overflows": 1, "pending": 2}
+    # handed out without waiting for its quiet period
+    assert _get(events) is a
+    assert _get(events) is None
+
+
+def test_put_timeout_drops(clock):
+    events = DebounceScheduler(maxsize=1, put_timeout=0)
+    events.put(_item("/p/a.plist"))
+    events.put(_item("/p/b.plist"))
+    assert events.dropped == 1 and len(events) == 1
+
+
+def test_full_put_waits_for_the_consumer(clock):
+    events = DebounceScheduler(quiet_period=1, maxsize=1)
+    a, b = _item("/p/a.plist"), _item("/p/b.plist")
+    events.put(a)
+    producer = threading.Thread(target=events.put, args=(b,))
+    producer.start()
+    # the blocked put() expedites a, so get() doesn't wait for the clock
+    assert events.get(timeout=5) is a
+    producer.join(5)
+    assert not producer.is_alive()
+    assert events.dropped == 0 and events.overflows == 1
+    clock.now += 1
+    assert _get(events) is b
+
+
+def test_close_hands_out_what_is_pending(clock):
+    events = DebounceScheduler(quiet_period=1)
+    a = _item("/p/a.plist")
+    events.put(a)
+    events.close()
+    assert events.get() is a
+    assert events.get() is None
+
+
+def test_get_times_out(clock):
+    events = DebounceScheduler()
+    with pytest.raises(QueueEmpty):
+        events.get(block=False)
@@ -0,0 +1,77 @@
+from prefsniff.prefsniff import PrefSniff
+from prefsniff.session import SessionRecorder
+
+
+def _session(*prefs, domain="com.example.app"):
+    # each successive pair of plists is one recorded change set
+    recorder = SessionRecorder()
+    for pref1, pref2 in zip(prefs, prefs[1:]):
+        recorder.write_changeset(PrefSniff(None, pref1=pref1, pref2=pref2, domain=domain, byhost=False))
+    return recorder
+
+
+def _commands(recorder):
+    return [command for changeset in recorder.compact() for command in changeset.commands]
+
+
+def test_last_write_wins():
+    recorder = _session({"n": 1}, {"n": 2}, {"n": 3}, {"n": 4})
+    assert recorder.recorded_changes() == 3
+    assert _commands(recorder) == ["defaults write com.example.app n -int 4"]
+
+
+def test_created_then_deleted_is_dropped():
+    assert _commands(_session({}, {"n": 1}, {"n": 2}, {})) == []
+
+
+def test_existing_key_deleted_keeps_the_delete():
+    assert _commands(_session({"n": 1}, {"n": 2}, {})) == ["defaults delete com.example.app n"]
+
+
+def test_revert_to_original_is_dropped():
+    assert _commands(_session({"n": 1, "s": "a"}, {"n": 2, "s": "b"}, {"n": 1, "s": "b"})) == [
+        "defaults write com.example.app s -string b"]
+
+
+def test_revert_must_match_type():
+    assert _commands(_session({"n": 1}, {"n": 2}, {"n": True})) == [
+        "defaults write com.example.app n -bool True"]
+
+
+def test_nested_type_change_is_not_a_revert():
+    original = {"k": {"a": {"b": 1}}, "l": [1]}
+    commands = _commands(_session(original, {"k": {"a": {"b": 2}}, "l": [2]},
+                                  {"k": {"a": {"b": True}}, "l": [1.0]}))
+    assert commands == [
+        "defaults write com.example.app k -dict-add a '<dict><key>b</key><true /></dict>'",
+        "defaults write com.example.app l '<array><real>1.0</real></array>'"]
+
+
+def test_dict_adds_merge():
+    original = {"k": {"a": 1, "b": 1}}
+    commands = _commands(_session(original, {"k": {"a": 2, "b": 1}}, {"k": {"a": 2, "b": 2}},
+                                  {"k": {"a": 2, "b": 2, "c": 3}}))
+    assert commands == ["defaults write com.example.app k -dict-add "
+                        "a '<integer>2</integer>' b '<integer>2</integer>' c '<integer>3</integer>'"]
+    # sub-keys put back as they were drop out, leaving a single -dict-add
+    commands = _commands(_session(original, {"k": {"a": 2, "b": 1}}, {"k": {"a": 2, "b": 2}},
+                                  {"k": {"a": 2, "b": 1}}))
+    assert commands == ["defaults write com.example.app k -dict-add a '<integer>2</integer>'"]
+
+
+def test_array_adds_merge():
+    commands = _commands(_session({"l": [1]}, {"l": [1, 2]}, {"l": [1, 2, 3]}))
+    assert commands == ["defaults write com.example.app l -array-add "
+                        "'<integer>2</integer>' '<integer>3</integer>'"]
+    # into a preceding write of the whole array
+    commands = _commands(_session({"l": [1]}, {"l": [5]}, {"l": [5, 6]}))
+    assert commands == ["defaults write com.example.app l "
+                        "'<array><integer>5</integer><integer>6</integer></array>'"]
+
+
+def test_plists_are_kept_apart():
+    recorder = _session({"n": 1}, {"n": 2})
+    recorder.write_changeset(PrefSniff(None, pref1={}, pref2={"m": "x"}, domain="com.example.other",
+                                       byhost=True))
+    assert [(changeset.pref_domain, changeset.byhost) for changeset in recorder.compact()] == [
+        ("com.example.app", False), ("com.example.other", True)]
@@ -0,0 +1,88 @@
+import datetime
+import os
+import plistlib
+import sqlite3
+
+import pytest
+
+from prefsniff.exceptions import SnapshotStoreException
+from prefsniff.store import SnapshotStore, store_main
+
+
+def _write(path, pref):
+    with open(path, "wb") as f:
+        plistlib.dump(pref, f)
+
+
+@pytest.fixture
+def prefsdir(tmp_path):
+    prefsdir = tmp_path / "prefs"
+    prefsdir.mkdir()
+    _write(prefsdir / "com.example.one.plist", {"a": 1, "d": datetime.datetime(2023, 1, 1)})
+    _write(prefsdir / "com.example.two.plist", {"b": [1, {"c": b"\x00"}]})
+    return prefsdir
+
+
+def test_compare(prefsdir, tmp_path):
+    with SnapshotStore(str(tmp_path / "store.db")) as store:
+        before = store.capture([str(prefsdir)])
+        _write(prefsdir / "com.example.one.plist", {"a": 2, "d": datetime.datetime(2023, 1, 1)})
+        os.unlink(prefsdir / "com.example.two.plist")
+        after = store.capture([str(prefsdir)])
+        changes = {os.path.basename(diffs.plistpath): [(ch.change_type, ch.key) for ch in diffs.changes]
+                   for diffs in store.compare(before, after)}
+    assert changes == {"com.example.one.plist": [("int", "a")],
+                       "com.example.two.plist": [("deleted", "b")]}
+    # default rollback journal; no -wal/-shm files left next to the store
+    assert sorted(os.listdir(tmp_path)) == ["prefs", "store.db"]
+
+
+def test_content_is_stored_as_plist(prefsdir, tmp_path):
+    with SnapshotStore(str(tmp_path / "store.db")) as store:
+        capture = store.capture([str(prefsdir)])
+        for captured in store.captured_files(capture).values():
+            with open(captured.path, "rb") as f:
+                assert store.load_content(captured.content_hash) == plistlib.load(f)
+        stored = store.conn.execute("SELECT pref FROM contents").fetchall()
+    assert all(row[0].startswith(b"bplist00") for row in stored)
+
+
+def test_unparseable_file_is_skipped_by_compare(prefsdir, tmp_path, capsys):
+    plistpath = prefsdir / "com.example.one.plist"
+    with SnapshotStore(str(tmp_path / "store.db")) as store:
+        before = store.capture([str(prefsdir)])
+        with open(plistpath, "wb") as f:
+            f.write(b"<?xml version=\"1.0\"?><plist><dict><key>a</key>")
+        _write(prefsdir / "com.example.two.plist", {"b": [2]})
+        after = store.capture([str(prefsdir)])
+        captured = store.captured_files(after)[str(plistpath)]
+        assert captured.error
+        assert store.unparseable == [(str(plistpath), captured.error)]
+        assert [diffs.plistpath for diffs in store.compare(before, after)] == [
+            str(prefsdir / "com.example.two.plist")]
+        assert store.skipped == [(str(plistpath), after.capture_id, captured.error)]
+        # reporting them is up to the caller
+        assert capsys.readouterr().err == ""
+        # unchanged since, so carried over with its error
+        assert store.captured_files(store.capture([str(prefsdir)]))[str(plistpath)].error == captured.error
+
+
+def test_older_store_is_refused(tmp_path):
+    path = str(tmp_path / "store.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA user_version = 1")
+    conn.close()
+    with pytest.raises(SnapshotStoreException):
+        SnapshotStore(path)
+
+
+def test_store_main_reports_unparseable_files(prefsdir, tmp_path, capsys):
+    plistpath = prefsdir / "com.example.one.plist"
+    store_args = ["--store", str(tmp_path / "store.db")]
+    store_main(["capture", str(prefsdir)] + store_args)
+    with open(plistpath, "wb") as f:
+        f.write(b"not a plist")
+    store_main(["capture", str(prefsdir)] + store_args)
+    assert "Can't parse %s" % plistpath in capsys.readouterr().err
+    store_main(["compare"] + store_args)
+    assert "Skipping %s: couldn't be parsed in capture 2" % plistpath in capsys.readouterr().err
@@ -0,0 +1,58 @@
+import plistlib
+
+import pytest
+
+from prefsniff import stats
+from prefsniff.watch import WatchedPlist
+
+
+def _write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_identical_rewrite_is_not_parsed(tmp_path, monkeypatch, lazy):
+    plistpath = tmp_path / "com.example.one.plist"
+    data = plistlib.dumps({"a": 1, "b": [1, 2]})
+    _write(plistpath, data)
+    watched = WatchedPlist(str(plistpath), lazy=lazy)
+
+    def loads(data):
+        raise AssertionError("parsed unchanged bytes")
+
+    monkeypatch.setattr(plistlib, "loads", loads)
+    pipeline_stats = stats.PipelineStats()
+    monkeypatch.setattr(stats, "_active", pipeline_stats)
+    _write(plistpath, data)
+    assert watched.refresh() is None
+    assert watched.refresh() is None
+    assert watched.short_circuited == 2
+    snapshot = pipeline_stats.snapshot()
+    assert snapshot["counters"][stats.COUNTER_SHORT_CIRCUITED] == 2
+    assert stats.STAGE_PARSE not in snapshot["stages"]
+
+
+def test_changed_bytes_are_diffed(tmp_path):
+    plistpath = tmp_path / "com.example.one.plist"
+    _write(plistpath, plistlib.dumps({"a": 1}))
+    watched = WatchedPlist(str(plistpath))
+    _write(plistpath, plistlib.dumps({"a": 2}))
+    diffs = watched.refresh()
+    assert diffs is not None and len(diffs.changes) == 1
+    # the new bytes become the ones to compare against
+    _write(plistpath, plistlib.dumps({"a": 2}))
+    assert watched.refresh() is None
+    assert watched.short_circuited == 1
+
+
+def test_same_content_in_other_bytes_is_diffed(tmp_path):
+    # only identical bytes are skipped; a reformatted file is parsed, and
+    # found to be unchanged
+    plistpath = tmp_path / "com.example.one.plist"
+    _write(plistpath, plistlib.dumps({"a": 1}))
+    watched = WatchedPlist(str(plistpath))
+    _write(plistpath, plistlib.dumps({"a": 1}, fmt=plistlib.FMT_BINARY))
+    diffs = watched.refresh()
+    assert diffs is not None and diffs.changes == []
+    assert watched.short_circuited == 0
@@ -0,0 +1,36 @@
+import datetime
+
+import pytest
+
+from prefsniff.xmlfrag import XmlFragmentRenderer, to_xmlfrag
+
+
+@pytest.mark.parametrize("value, fragment", [
+    ({"b": [1, 2.5], "a": True}, "<dict><key>a</key><true /><key>b</key>"
+                                 "<array><integer>1</integer><real>2.5</real></array></dict>"),
+    ([b"\x00\x01", b"", {}], "<array><data>AAE=</data><data /><dict /></array>"),
+    ({"d": datetime.datetime(2023, 2, 13, 1, 2, 3), "s": "a<b & c"},
+     "<dict><key>d</key><date>2023-02-13T01:02:03Z</date>"
+     "<key>s</key><string>a&lt;b &amp; c</string></dict>"),
+])
+def test_render(value, fragment):
+    assert to_xmlfrag(value) == fragment
+
+
+def test_mutated_values_render_afresh():
+    value = {"a": 1, "b": [1], "c": bytearray(b"\x00")}
+    assert to_xmlfrag(value) == ("<dict><key>a</key><integer>1</integer><key>b</key>"
+                                 "<array><integer>1</integer></array><key>c</key><data>AA==</data></dict>")
+    value["a"] = 2
+    value["b"].append(2)
+    value["c"][0] = 1
+    assert to_xmlfrag(value) == ("<dict><key>a</key><integer>2</integer><key>b</key>"
+                                 "<array><integer>1</integer><integer>2</integer></array>"
+                                 "<key>c</key><data>AQ==</data></dict>")
+
+
+def test_shared_subtrees():
+    shared = {"x": [1, 2]}
+    assert XmlFragmentRenderer().render([shared, shared, {"x": [1, 2]}]) == (
+        "<array>" + "<dict><key>x</key><array><integer>1</integer><integer>2</integer></array></dict>" * 3 +
+        "</array>")